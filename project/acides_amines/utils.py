@@ -1,170 +1,156 @@
-import numpy as np
-from scipy.spatial.distance import cosine
 import logging
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+
+from metabolites.generation import current_generation
 
 logger = logging.getLogger('metabolites')
 
-def calculate_amino_acid_similarity(plant_aa_data, plants_data, amino_acids, ref_plant_id, normalization='sum'):
+# Acides aminés du profil (format d'affichage) ; les métabolites sont enregistrés en majuscules
+AMINO_ACIDS = [
+    'Alanine', 'Arginine', 'Asparagine', 'Aspartic acid', 'Cysteine',
+    'Glutamic acid', 'Glutamine', 'Glycine', 'Histidine', 'Isoleucine',
+    'Leucine', 'Lysine', 'Methionine', 'Phenylalanine', 'Proline',
+    'Serine', 'Threonine', 'Tryptophan', 'Tyrosine', 'Valine'
+]
+
+_matrix = None
+_matrix_lock = threading.Lock()
+
+
+def normalize_profiles(profiles, normalization='sum'):
+    """
+    Normalise chaque ligne (profil d'une plante) de la matrice : 'sum' (somme = 1),
+    'zscore' (centrée-réduite) ou 'none'.
+    """
+    profiles = np.asarray(profiles, dtype=np.float64)
+    if normalization == 'sum':
+        totals = profiles.sum(axis=1, keepdims=True)
+        return np.divide(profiles, totals, out=profiles.copy(), where=totals > 0)
+    if normalization == 'zscore':
+        means = profiles.mean(axis=1, keepdims=True)
+        stds = profiles.std(axis=1, keepdims=True)
+        return np.divide(profiles - means, stds, out=np.zeros_like(profiles), where=stds > 0)
+    return profiles.copy()
+
+
+class AminoAcidMatrix:
+    """
+    Matrice plantes × acides aminés des concentrations moyennes (PlantMetaboliteConcentration),
+    chargée une seule fois par processus.
+    """
+
+    def __init__(self, generation=None):
+        start_time = time.time()
+        self.built_at = start_time
+        # Génération du jeu de données chargée (lue avant le chargement)
+        self.generation = generation
+        self._load()
+        logger.info(
+            f"Matrice des acides aminés chargée en {time.time() - start_time:.3f}s : "
+            f"{len(self.plant_ids)} plantes avec des données"
+        )
+
+    def _load(self):
+        columns = {aa.upper(): index for index, aa in enumerate(AMINO_ACIDS)}
+        placeholders = ', '.join(['%s'] * len(columns))
+        with connection.cursor() as cursor:
+            # Concentrations agrégées sur les parties de plantes (PlantMetaboliteConcentration)
+            cursor.execute(f"""
+                SELECT pc.plant_id, m.name, pc.mean_concentration, pc.parts_count
+                FROM metabolites_plantmetaboliteconcentration pc
+                JOIN metabolites_metabolite m ON m.id = pc.metabolite_id
+                WHERE m.name IN ({placeholders})
+            """, list(columns))
+            rows = cursor.fetchall()
+
+        self.plant_ids = np.array(sorted({row[0] for row in rows}), dtype=np.int64)
+        self.plant_rows = {int(plant_id): index for index, plant_id in enumerate(self.plant_ids)}
+
+        self.means = np.zeros((len(self.plant_ids), len(AMINO_ACIDS)), dtype=np.float64)
+        self.counts = np.zeros((len(self.plant_ids), len(AMINO_ACIDS)), dtype=np.int64)
+        for plant_id, name, mean_concentration, parts_count in rows:
+            self.means[self.plant_rows[plant_id], columns[name]] = mean_concentration
+            self.counts[self.plant_rows[plant_id], columns[name]] = parts_count
+
+    def profiles(self, plant_ids):
+        """Concentrations moyennes alignées sur plant_ids (zéros pour les plantes sans données)"""
+        plant_ids = np.asarray(plant_ids, dtype=np.int64)
+        profiles = np.zeros((len(plant_ids), len(AMINO_ACIDS)), dtype=np.float64)
+        if len(self.plant_ids) and len(plant_ids):
+            positions = np.searchsorted(self.plant_ids, plant_ids)
+            positions = np.minimum(positions, len(self.plant_ids) - 1)
+            found = self.plant_ids[positions] == plant_ids
+            profiles[found] = self.means[positions[found]]
+        return profiles
+
+    def similarities(self, ref_plant_id, plant_ids, normalization='sum'):
+        """
+        Similarité cosinus entre le profil normalisé de la plante de référence et celui de chaque plante
+        de plant_ids, en un seul calcul vectorisé. Retourne un tableau aligné sur plant_ids.
+
+        Les plantes sans données valent 0, la plante de référence 1. Tout vaut 0 si la
+        plante de référence n'a aucune concentration.
+        """
+        plant_ids = np.asarray(plant_ids, dtype=np.int64)
+        similarities = np.zeros(len(plant_ids), dtype=np.float64)
+
+        ref_raw = self.profiles([ref_plant_id])
+        if not (ref_raw > 0).any():
+            logger.warning(f"Aucune donnée d'acide aminé pour la plante de référence {ref_plant_id}")
+            return similarities
+
+        raw = self.profiles(plant_ids)
+        vectors = normalize_profiles(raw, normalization)
+        ref_vector = normalize_profiles(ref_raw, normalization)[0]
+
+        norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(ref_vector)
+        with_data = raw.any(axis=1) & (norms > 0)
+        similarities[with_data] = (vectors[with_data] @ ref_vector) / norms[with_data]
+        similarities[plant_ids == ref_plant_id] = 1.0
+
+        logger.debug(f"Similarités d'acides aminés calculées pour {len(plant_ids)} plantes ({int(with_data.sum())} avec des données)")
+        return similarities
+
+
+def get_amino_acid_matrix():
+    """Retourne la matrice du processus, reconstruite si elle est absente, expirée ou si le jeu de données a changé"""
+    global _matrix
+    ttl = getattr(settings, 'AMINO_ACID_MATRIX_TTL', 600)
+    generation = current_generation()
+
+    def is_stale(matrix):
+        return matrix is None or matrix.generation != generation or time.time() - matrix.built_at > ttl
+
+    matrix = _matrix
+    if is_stale(matrix):
+        with _matrix_lock:
+            matrix = _matrix
+            if is_stale(matrix):
+                matrix = _matrix = AminoAcidMatrix(generation)
+    return matrix
+
+
+def invalidate_amino_acid_matrix():
+    """Force la reconstruction de la matrice au prochain appel"""
+    global _matrix
+    _matrix = None
+
+
+def calculate_amino_acid_similarity(ref_plant_id, plant_ids, normalization='sum'):
     """
     Calcule la similarité cosinus entre les profils d'acides aminés des plantes.
-    
+
     Args:
-        plant_aa_data: Dictionnaire {plant_name: {acide_aminé: [instances]}} contenant les données d'acides aminés
-        plants_data: Liste de dictionnaires ou d'objets représentant les plantes
-        amino_acids: Liste des acides aminés à considérer
         ref_plant_id: ID de la plante de référence
+        plant_ids: IDs des plantes à comparer
         normalization: Type de normalisation à appliquer ('sum', 'zscore' ou 'none')
-    
+
     Returns:
-        Un dictionnaire {plant_id: similarité} avec les valeurs de similarité calculées
+        Un tableau numpy des similarités, aligné sur plant_ids
     """
-    # Dictionnaire pour stocker les concentrations brutes
-    raw_concentrations = {}
-    
-    # Dictionnaire pour stocker le profil de référence
-    ref_amino_acid_profile = {}
-    ref_plant_name = None
-    
-    # Identifier la plante de référence
-    for plant_data in plants_data:
-        if isinstance(plant_data, dict):
-            plant_id = plant_data['id']
-            plant_name = plant_data['name']
-        else:
-            plant_id = plant_data.id
-            plant_name = plant_data.name
-            
-        if plant_id == ref_plant_id:
-            ref_plant_name = plant_name
-            break
-    
-    if not ref_plant_name:
-        logger.warning(f"Plante de référence avec ID {ref_plant_id} non trouvée")
-        return {}
-    
-    logger.debug(f"Calcul de similarité avec plante de référence: {ref_plant_name} (ID: {ref_plant_id})")
-    
-    # Nombre de plantes traitées
-    plant_count = 0
-    plant_with_aa_count = 0
-    
-    # Calculer les concentrations moyennes pour chaque plante
-    for plant_data in plants_data:
-        if isinstance(plant_data, dict):
-            plant_id = plant_data['id']
-            plant_name = plant_data['name']
-        else:
-            plant_id = plant_data.id
-            plant_name = plant_data.name
-        
-        plant_count += 1
-        
-        # Créer un profil pour cette plante
-        mean_concentrations = {}
-        has_amino_acid_data = False
-        
-        if plant_name in plant_aa_data:
-            has_amino_acid_data = True
-            plant_with_aa_count += 1
-            
-            for aa in amino_acids:
-                if aa in plant_aa_data[plant_name]:
-                    instances = plant_aa_data[plant_name][aa]
-                    aa_avg_value = 0
-                    count = 0
-                    
-                    for inst in instances:
-                        # Convertir en float
-                        low = float(inst['low']) if inst['low'] is not None else 0.0
-                        high = float(inst['high']) if inst['high'] is not None else (low if low > 0.0 else 0.0)
-                        
-                        if low == 0.0 and high == 0.0:
-                            # Ignorer les instances sans valeurs
-                            continue
-                        
-                        # Calculer la moyenne pour cette instance
-                        instance_avg = (low + high) / 2.0 if high > 0.0 else low
-                        
-                        # Ajouter à la moyenne globale
-                        aa_avg_value += instance_avg
-                        count += 1
-                    
-                    if count > 0:
-                        mean_concentrations[aa] = aa_avg_value / count
-                    else:
-                        mean_concentrations[aa] = 0.0
-                else:
-                    mean_concentrations[aa] = 0.0
-        
-        # Stocker les concentrations brutes pour cette plante
-        raw_concentrations[plant_id] = [float(mean_concentrations.get(aa, 0.0)) for aa in amino_acids]
-        
-        # Stocker le profil de référence
-        if plant_id == ref_plant_id:
-            ref_amino_acid_profile = mean_concentrations
-            logger.debug(f"Profil de la plante de référence {plant_name}: {mean_concentrations}")
-    
-    logger.info(f"Traitement des plantes terminé: {plant_count} plantes traitées, {plant_with_aa_count} avec des données d'acides aminés")
-    
-    # Vérifier si le profil de référence contient des données
-    has_ref_profile = any(value > 0 for value in ref_amino_acid_profile.values())
-    
-    if not has_ref_profile:
-        logger.warning(f"Aucune donnée d'acide aminé pour la plante de référence {ref_plant_name}")
-        return {}
-    
-    # Appliquer la normalisation
-    normalized_concentrations = {}
-    
-    for plant_id, concentrations in raw_concentrations.items():
-        if normalization == 'sum':
-            # Normalisation par somme pour que la somme = 1 (100%)
-            total = sum(concentrations)
-            if total > 0:
-                normalized_concentrations[plant_id] = [float(c) / total for c in concentrations]
-            else:
-                normalized_concentrations[plant_id] = concentrations
-        elif normalization == 'zscore':
-            # Standardisation (centrer-réduire)
-            mean = np.mean(concentrations)
-            std = np.std(concentrations)
-            if std > 0:
-                normalized_concentrations[plant_id] = [(float(c) - mean) / std for c in concentrations]
-            else:
-                normalized_concentrations[plant_id] = [0] * len(concentrations)
-        else:
-            # Pas de normalisation
-            normalized_concentrations[plant_id] = [float(c) for c in concentrations]
-    
-    # Calculer la similarité cosinus
-    similarities = {}
-    
-    if ref_plant_id in normalized_concentrations:
-        ref_vector = normalized_concentrations[ref_plant_id]
-        
-        for plant_id, vector in normalized_concentrations.items():
-            if plant_id == ref_plant_id:
-                similarities[plant_id] = 1.0  # Similarité avec soi-même
-                continue
-                
-            # Vérifier si les vecteurs ont des valeurs
-            if sum(ref_vector) == 0 or sum(vector) == 0:
-                similarities[plant_id] = 0.0
-                continue
-                
-            try:
-                similarity = 1 - cosine(ref_vector, vector)
-                similarities[plant_id] = float(similarity)
-            except Exception as e:
-                logger.error(f"Erreur dans le calcul de similarité cosinus: {e}")
-                logger.error(f"ref_vector: {ref_vector}, vector: {vector}")
-                similarities[plant_id] = 0.0
-    
-    logger.info(f"Calcul de similarité terminé: {len(similarities)} similarités calculées")
-    
-    # Afficher les 10 premières similarités pour le débogage
-    top_similarities = sorted([(k, v) for k, v in similarities.items() if v > 0], key=lambda x: x[1], reverse=True)[:10]
-    if top_similarities:
-        logger.debug(f"Top 10 des similarités: {top_similarities}")
-    
-    return similarities 
\ No newline at end of file
+    return get_amino_acid_matrix().similarities(ref_plant_id, plant_ids, normalization)
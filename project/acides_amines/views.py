@@ -1,21 +1,15 @@
 from django.shortcuts import render
 from django.db.models import Q, F, Sum, Case, When, Value, FloatField
-from metabolites.models import Plant, Metabolite, MetabolitePlant
+from metabolites.models import Plant, Metabolite, MetabolitePlant, PlantMetaboliteConcentration
 import numpy as np
-from scipy.spatial.distance import cosine
 from decimal import Decimal
-from .utils import calculate_amino_acid_similarity
+from .utils import AMINO_ACIDS, calculate_amino_acid_similarity, normalize_profiles
 
 # Create your views here.
 
 def amino_acid_profile(request):
     # Liste des acides aminés (format mixte pour l'affichage)
-    amino_acids_display = [
-        'Alanine', 'Arginine', 'Asparagine', 'Aspartic acid', 'Cysteine',
-        'Glutamic acid', 'Glutamine', 'Glycine', 'Histidine', 'Isoleucine',
-        'Leucine', 'Lysine', 'Methionine', 'Phenylalanine', 'Proline',
-        'Serine', 'Threonine', 'Tryptophan', 'Tyrosine', 'Valine'
-    ]
+    amino_acids_display = AMINO_ACIDS
     
     # Créer une version uppercase pour la recherche dans la base de données
     amino_acids_upper = [aa.upper() for aa in amino_acids_display]
@@ -41,136 +35,70 @@ def amino_acid_profile(request):
         # Récupérer toutes les plantes sans limitation
         all_plants = Plant.objects.all().order_by('name')
         
-        # Récupérer tous les métabolites d'acides aminés en une seule requête, en conservant les parties de plantes
-        all_aa_instances = MetabolitePlant.objects.filter(
-            metabolite_id__in=amino_acid_ids.values()
-        ).values('plant_name', 'metabolite__name', 'plant_part', 'low', 'high', 'reference')
+        # Identifiant du métabolite de chaque acide aminé (nom d'affichage)
+        aa_metabolite_ids = {amino_acid_mapping[name]: metabolite_id for name, metabolite_id in amino_acid_ids.items()}
         
-        # Organiser les données par plante et par acide aminé
+        # Concentrations moyennes précalculées (PlantMetaboliteConcentration), par plante et par acide aminé
         plant_aa_data = {}
-        plants_with_amino_acids = set()
+        concentration_rows = PlantMetaboliteConcentration.objects.filter(
+            metabolite_id__in=amino_acid_ids.values()
+        ).values_list('plant_id', 'metabolite__name', 'mean_concentration', 'parts_count')
+        for plant_id, metabolite_name, mean_concentration, parts_count in concentration_rows:
+            plant_aa_data.setdefault(plant_id, {})[amino_acid_mapping[metabolite_name]] = (mean_concentration, parts_count)
         
-        for instance in all_aa_instances:
-            plant_name = instance['plant_name']
-            plants_with_amino_acids.add(plant_name)
-            
-            if plant_name not in plant_aa_data:
-                plant_aa_data[plant_name] = {}
-                
-            metabolite_name = instance['metabolite__name']
-            display_name = amino_acid_mapping.get(metabolite_name)
-            
-            if display_name not in plant_aa_data[plant_name]:
-                plant_aa_data[plant_name][display_name] = []
-                
-            plant_aa_data[plant_name][display_name].append({
-                'plant_part': instance['plant_part'] or 'Non spécifié',
-                'low': instance['low'],
-                'high': instance['high'],
-                'reference': instance['reference']
-            })
+        # Détail par partie de plante des valeurs retenues
+        part_details = PlantMetaboliteConcentration.part_details(None, amino_acid_ids.values())
         
         # Préparer les données pour les plantes
         plant_data = []
         
         for plant in all_plants:
-            # Si la plante n'a pas d'acides aminés et n'est pas la plante sélectionnée, skip
-            if plant.name not in plants_with_amino_acids and plant.id != int(selected_plant_id):
+            # Seules les plantes avec au moins une valeur d'acide aminé sont affichées, plus la plante sélectionnée
+            if plant.id not in plant_aa_data and plant.id != int(selected_plant_id):
                 continue
             
             # Dictionnaire pour stocker les concentrations et les détails pour chaque acide aminé
             amino_acid_concentrations = {}
             mean_concentrations = {}
             has_missing_data = False
-            has_any_value = False
             
-            # Pour chaque acide aminé, calculer la moyenne des concentrations de toutes les parties
             for aa in amino_acids_display:
-                if plant.name in plant_aa_data and aa in plant_aa_data[plant.name]:
-                    # La plante a des données pour cet acide aminé
-                    instances = plant_aa_data[plant.name][aa]
-                    aa_avg_value = 0
-                    count = 0
-                    
-                    # Stocker les détails par partie de plante
-                    details = []
-                    
-                    for inst in instances:
-                        # Convertir en float
-                        low = float(inst['low']) if inst['low'] is not None else 0.0
-                        high = float(inst['high']) if inst['high'] is not None else (low if low > 0.0 else 0.0)
-                        
-                        if low == 0.0 and high == 0.0:
-                            # Ignorer les instances sans valeurs
-                            continue
-                        
-                        # Calculer la moyenne pour cette instance
-                        instance_avg = (low + high) / 2.0 if high > 0.0 else low
-                        
-                        # Ajouter à la moyenne globale
-                        aa_avg_value += instance_avg
-                        count += 1
-                        
-                        # Ajouter aux détails
-                        details.append({
-                            'plant_part': inst['plant_part'],
-                            'low': low,
-                            'high': high,
-                            'reference': inst['reference']
-                        })
-                    
-                    if count > 0:
-                        # Il y a au moins une valeur non nulle
-                        has_any_value = True
-                        mean_value = aa_avg_value / count
-                    else:
-                        mean_value = 0.0
-                        has_missing_data = True
-                    
-                    # Stocker la concentration moyenne et les détails
-                    amino_acid_concentrations[aa] = {
-                        'average': mean_value,
-                        'details': details,
-                        'count': count
-                    }
-                    mean_concentrations[aa] = mean_value
-                    
-                else:
-                    # La plante n'a pas de données pour cet acide aminé
+                mean_value, count = plant_aa_data.get(plant.id, {}).get(aa, (0.0, 0))
+                if count == 0:
+                    # La plante n'a pas de valeur pour cet acide aminé
                     has_missing_data = True
-                    amino_acid_concentrations[aa] = {
-                        'average': 0.0,
-                        'details': [],
-                        'count': 0
-                    }
-                    mean_concentrations[aa] = 0.0
+                
+                amino_acid_concentrations[aa] = {
+                    'average': mean_value,
+                    'details': part_details.get((plant.id, aa_metabolite_ids.get(aa)), []),
+                    'count': count
+                }
+                mean_concentrations[aa] = mean_value
             
-            # Si c'est la plante sélectionnée, on l'ajoute toujours
-            # Sinon, on ajoute seulement si elle a au moins une valeur
-            if plant.id == int(selected_plant_id) or has_any_value:
-                plant_data.append({
-                    'plant': plant,
-                    'concentrations': amino_acid_concentrations,
-                    'mean_concentrations': mean_concentrations,
-                    'has_missing_data': has_missing_data,
-                    'is_selected': plant.id == int(selected_plant_id)
-                })
+            plant_data.append({
+                'plant': plant,
+                'concentrations': amino_acid_concentrations,
+                'mean_concentrations': mean_concentrations,
+                'has_missing_data': has_missing_data,
+                'is_selected': plant.id == int(selected_plant_id)
+            })
         
-        # Utiliser la fonction commune pour calculer les similarités
+        # Similarités calculées en un seul appel vectorisé sur la matrice en cache
         similarities = calculate_amino_acid_similarity(
-            plant_aa_data=plant_aa_data,
-            plants_data=all_plants,
-            amino_acids=amino_acids_display,
             ref_plant_id=int(selected_plant_id),
+            plant_ids=[plant_data_item['plant'].id for plant_data_item in plant_data],
             normalization=normalization
         )
         
-        # Trier les plantes par similarité (du plus proche au plus éloigné)
-        # et ajouter la similarité à chaque plante
-        for plant_data_item in plant_data:
-            plant_id = plant_data_item['plant'].id
-            if plant_id in similarities:
-                plant_data_item['similarity'] = similarities[plant_id]
+        # Sans donnée pour la plante de référence, aucune similarité n'est affichée
+        reference_has_data = any(
+            value > 0
+            for plant_data_item in plant_data if plant_data_item['is_selected']
+            for value in plant_data_item['mean_concentrations'].values()
+        )
+        if reference_has_data:
+            for plant_data_item, similarity in zip(plant_data, similarities):
+                plant_data_item['similarity'] = float(similarity)
         
         # Tri des plantes par similarité, en gardant la plante sélectionnée en premier
         sorted_plant_data = [item for item in plant_data if item['is_selected']]
@@ -181,39 +109,15 @@ def amino_acid_profile(request):
         )
         sorted_plant_data.extend(other_plants)
         
-        # Pour l'affichage, ajouter les valeurs normalisées
-        raw_concentrations = {}
-        for plant_data_item in plant_data:
-            plant_id = plant_data_item['plant'].id
-            raw_concentrations[plant_id] = [float(plant_data_item['mean_concentrations'].get(aa, 0.0)) for aa in amino_acids_display]
-        
-        # Appliquer la normalisation pour l'affichage
-        normalized_concentrations = {}
-        for plant_id, concentrations in raw_concentrations.items():
-            if normalization == 'sum':
-                # Normalisation par somme pour que la somme = 1 (100%)
-                total = sum(concentrations)
-                if total > 0:
-                    normalized_concentrations[plant_id] = [float(c) / total for c in concentrations]
-                else:
-                    normalized_concentrations[plant_id] = concentrations
-            elif normalization == 'zscore':
-                # Standardisation (centrer-réduire)
-                mean = np.mean(concentrations)
-                std = np.std(concentrations)
-                if std > 0:
-                    normalized_concentrations[plant_id] = [(float(c) - mean) / std for c in concentrations]
-                else:
-                    normalized_concentrations[plant_id] = [0] * len(concentrations)
-            else:
-                # Pas de normalisation
-                normalized_concentrations[plant_id] = [float(c) for c in concentrations]
+        # Pour l'affichage, ajouter les valeurs normalisées (toutes les plantes en une seule opération)
+        raw_concentrations = np.array([
+            [float(plant_data_item['mean_concentrations'].get(aa, 0.0)) for aa in amino_acids_display]
+            for plant_data_item in plant_data
+        ], dtype=np.float64).reshape(len(plant_data), len(amino_acids_display))
+        normalized_concentrations = normalize_profiles(raw_concentrations, normalization)
         
-        # Préparer les données normalisées pour l'affichage
-        for plant_data_item in sorted_plant_data:
-            plant_id = plant_data_item['plant'].id
-            if plant_id in normalized_concentrations:
-                plant_data_item['normalized_values'] = dict(zip(amino_acids_display, normalized_concentrations[plant_id]))
+        for plant_data_item, normalized_values in zip(plant_data, normalized_concentrations):
+            plant_data_item['normalized_values'] = dict(zip(amino_acids_display, normalized_values.tolist()))
         
         context = {
             'plants': plants,
@@ -20,7 +20,8 @@ class MetaboliteActivityInline(admin.TabularInline):
 class MetabolitePlantInline(admin.TabularInline):
     model = MetabolitePlant
     extra = 1
-    fields = ('plant_name', 'plant_part', 'low', 'high', 'deviation', 'reference')
+    fields = ('plant', 'plant_part', 'low', 'high', 'deviation', 'reference')
+    autocomplete_fields = ('plant',)
 
 class MetaboliteAdmin(admin.ModelAdmin):
     list_display = ('name', 'is_ubiquitous', 'get_activities_count', 'get_plants_count')
@@ -58,10 +59,11 @@ class MetaboliteActivityAdmin(admin.ModelAdmin):
 
 
 class MetabolitePlantAdmin(admin.ModelAdmin):
-    list_display = ('metabolite', 'plant_name', 'plant_part', 'low', 'high', 'deviation', 'reference')
-    list_filter = ('plant_name', 'plant_part',)
-    search_fields = ('metabolite__name','plant_name', 'plant_part', 'reference')
-    ordering = ('metabolite','plant_name', 'plant_part')
+    list_display = ('metabolite', 'plant', 'plant_part', 'low', 'high', 'deviation', 'reference')
+    list_filter = ('plant_part',)
+    search_fields = ('metabolite__name', 'plant__name', 'plant_part', 'reference')
+    ordering = ('metabolite', 'plant__name', 'plant_part')
+    autocomplete_fields = ('metabolite', 'plant')
 
 
 admin.site.register(Metabolite, MetaboliteAdmin)
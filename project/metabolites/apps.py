@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class MetabolitesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'metabolites'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from project.cache import single_flight
+
+logger = logging.getLogger('metabolites')
+
+_state = threading.local()
+
+
+def current_generation():
+    """
+    Génération courante du jeu de données (0 tant qu'aucune modification n'a été enregistrée).
+    Pendant un calcul de cached_for_generation, c'est celle de la clé en cours de remplissage.
+    """
+    computing = getattr(_state, 'computing', None)
+    if computing is not None:
+        return computing
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT value FROM metabolites_datasetgeneration WHERE id = 1")
+        row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def bump_generation():
+    """
+    Passe à la génération suivante : tous les résultats en cache deviennent obsolètes.
+    Dans un bloc deferred_generation(), l'incrément n'a lieu qu'une fois, en sortie de bloc.
+    """
+    if getattr(_state, 'deferred', None) is not None:
+        _state.deferred = True
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "UPDATE metabolites_datasetgeneration SET value = value + 1, updated_at = %s WHERE id = 1",
+            [timezone.now()]
+        )
+        if cursor.rowcount == 0:
+            # Première génération : valeur horodatée pour ne jamais réutiliser d'anciennes clés
+            cursor.execute(
+                "INSERT INTO metabolites_datasetgeneration (id, value, updated_at) VALUES (1, %s, %s)",
+                [int(time.time()), timezone.now()]
+            )
+    logger.debug("Nouvelle génération du jeu de données")
+
+
+@contextmanager
+def deferred_generation():
+    """Regroupe les incréments d'un import en un seul, en sortie de bloc"""
+    if getattr(_state, 'deferred', None) is not None:
+        yield
+        return
+
+    _state.deferred = False
+    try:
+        yield
+    finally:
+        changed, _state.deferred = _state.deferred, None
+        if changed:
+            bump_generation()
+
+
+def generation_cache_key(namespace, generation=None, **params):
+    """
+    Clé de cache d'un résultat : espace de noms, génération (courante par défaut) et empreinte des
+    paramètres normalisés (ordre des clés indifférent).
+    """
+    if generation is None:
+        generation = current_generation()
+    normalized = json.dumps(params, sort_keys=True, default=str)
+    digest = hashlib.md5(normalized.encode('utf-8')).hexdigest()
+    return f'{namespace}:{generation}:{digest}'
+
+
+def cached_for_generation(namespace, compute, **params):
+    """
+    Résultat de compute() mis en cache pour la génération courante et les paramètres donnés,
+    calculé une seule fois même sous requêtes concurrentes (single_flight)
+    """
+    generation = current_generation()
+    cache_key = generation_cache_key(namespace, generation, **params)
+
+    def compute_for_generation():
+        # Les lectures de la génération pendant le calcul (moteur d'incidence) ne refont pas de requête
+        previous, _state.computing = getattr(_state, 'computing', None), generation
+        try:
+            return compute()
+        finally:
+            _state.computing = previous
+
+    return single_flight(cache_key, compute_for_generation, getattr(settings, 'GENERATION_CACHE_TIMEOUT', 86400))
@@ -0,0 +1,405 @@
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+
+from django.db import connection, connections, transaction
+from django.db.models.constants import OnConflict
+from tqdm import tqdm
+
+logger = logging.getLogger('metabolites')
+
+# Taille par défaut d'un morceau de fichier analysé par un processus
+CHUNK_BYTES = 4 * 1024 * 1024
+
+# Modes d'écriture des lignes nouvelles (BulkLoader)
+LOADERS = ('orm', 'native')
+
+
+class RejectedRow(Exception):
+    """Levée par un parseur de ligne : la ligne est ignorée et le message journalisé"""
+
+
+class DryRunRollback(Exception):
+    """Levée en fin de simulation (dry_run_transaction) pour annuler toutes les écritures"""
+
+
+def fingerprint(*values):
+    """Empreinte 64 bits signée (BigIntegerField) de valeurs normalisées, None distinct de ''"""
+    text = '\x1f'.join('\x00' if value is None else str(value) for value in values)
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+
+def byte_ranges(path, chunk_bytes=CHUNK_BYTES, skip_header=True):
+    """
+    Découpe le fichier en intervalles d'octets [début, fin) alignés sur les débuts de ligne.
+
+    Les champs entre guillemets contenant un retour à la ligne ne sont pas pris en charge :
+    une coupure au milieu d'un tel champ fausserait les deux morceaux.
+    """
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as f:
+        if skip_header:
+            f.readline()
+        start = f.tell()
+        while start < size:
+            f.seek(min(start + max(chunk_bytes, 1) - 1, size))
+            f.readline()
+            end = f.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def parse_chunk(path, start, end, parse, encoding='utf-8'):
+    """
+    Analyse les lignes de l'intervalle [start, end) avec parse(row, warnings) (fonction de niveau
+    module, exécutée dans un processus de calcul). parse retourne la ligne normalisée, ajoute
+    ses avertissements à warnings ou lève RejectedRow.
+
+    Retourne (enregistrements, rejets, avertissements, nombre de lignes, durée, durée de parse).
+    """
+    start_time = time.time()
+    validate_seconds = 0.0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode(encoding)
+
+    records, rejects, warnings = [], [], []
+    rows = 0
+    for row in csv.reader(io.StringIO(text, newline=''), quotechar='"', doublequote=True, delimiter=','):
+        if not row:
+            continue  # Ligne vide
+        rows += 1
+        row_start = time.perf_counter()
+        try:
+            records.append(parse(row, warnings))
+        except RejectedRow as e:
+            rejects.append(str(e))
+        except Exception as e:
+            rejects.append(f"Erreur sur la ligne : \nContenu : {row}\nErreur : {str(e)}")
+        validate_seconds += time.perf_counter() - row_start
+    return records, rejects, warnings, rows, time.time() - start_time, validate_seconds
+
+
+class ParallelCSVReader:
+    """
+    Lecture d'un CSV analysée en parallèle : le fichier est découpé en morceaux (byte_ranges),
+    analysés par un pool de processus, et les enregistrements normalisés sont rendus au
+    processus principal, seul à écrire en base, dans l'ordre du fichier.
+
+    Le nombre de morceaux en cours est borné (deux par processus) pour que la mémoire reste
+    constante si l'écriture est plus lente que l'analyse. Progression, rejets, avertissements
+    et durées sont agrégés sur l'ensemble des processus ; rejets et avertissements sont
+    journalisés par le processus principal.
+    """
+
+    def __init__(self, path, parse, encoding='utf-8', workers=None, chunk_bytes=CHUNK_BYTES, skip_header=True,
+                 desc="Analyse du fichier"):
+        self.path = path
+        self.parse = parse
+        self.encoding = encoding
+        self.workers = max(workers or os.cpu_count() or 1, 1)
+        self.chunk_bytes = chunk_bytes
+        self.skip_header = skip_header
+        self.desc = desc
+
+        self.rows = 0
+        self.records = 0
+        self.rejected = 0
+        self.warnings = 0
+        self.parse_seconds = 0.0
+        self.validate_seconds = 0.0
+        self.started_at = None
+
+    def __iter__(self):
+        self.started_at = time.time()
+        ranges = byte_ranges(self.path, self.chunk_bytes, self.skip_header)
+        progress = tqdm(total=sum(end - start for start, end in ranges), desc=self.desc, unit='o', unit_scale=True)
+        try:
+            for (start, end), result in zip(ranges, self._results(ranges)):
+                records, rejects, warnings, rows, seconds, validate_seconds = result
+                self.rows += rows
+                self.records += len(records)
+                self.rejected += len(rejects)
+                self.warnings += len(warnings)
+                self.parse_seconds += seconds
+                self.validate_seconds += validate_seconds
+                for message in rejects:
+                    logger.error(message)
+                for message in warnings:
+                    logger.warning(message)
+                progress.update(end - start)
+                yield from records
+        finally:
+            progress.close()
+
+    def _results(self, ranges):
+        """Résultats de parse_chunk dans l'ordre des morceaux"""
+        if self.workers <= 1 or len(ranges) <= 1:
+            for start, end in ranges:
+                yield parse_chunk(self.path, start, end, self.parse, self.encoding)
+            return
+
+        # Les processus d'analyse n'ouvrent pas de connexion : pas de connexion héritée. Dans une
+        # transaction (simulation), la connexion est conservée : les processus n'y touchent pas
+        # et se terminent par os._exit, sans la fermer
+        if not connection.in_atomic_block:
+            connections.close_all()
+        remaining = iter(ranges)
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            # Fenêtre bornée de morceaux soumis en avance, résultats rendus dans l'ordre
+            pending = deque(
+                executor.submit(parse_chunk, self.path, start, end, self.parse, self.encoding)
+                for start, end in islice(remaining, self.workers * 2)
+            )
+            while pending:
+                result = pending.popleft().result()
+                for start, end in islice(remaining, 1):
+                    pending.append(executor.submit(parse_chunk, self.path, start, end, self.parse, self.encoding))
+                yield result
+
+    def batches(self, batch_size):
+        """Enregistrements regroupés par lots de batch_size, dans l'ordre du fichier"""
+        batch = []
+        for record in self:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def summary(self):
+        """
+        Lignes de résumé : rejets, débit (de l'ouverture du fichier à l'appel, écritures comprises)
+        et temps d'analyse cumulé des processus
+        """
+        elapsed = time.time() - self.started_at if self.started_at else 0
+        rate = self.rows / elapsed if elapsed else 0
+        return (
+            f"\n- Lignes lues : {self.rows} ({self.rejected} rejetées, {self.warnings} avertissements)"
+            f"\n- Débit : {self.rows} lignes en {elapsed:.1f}s ({rate:.0f} lignes/s, "
+            f"{self.workers} processus, analyse cumulée {self.parse_seconds:.1f}s)"
+        )
+
+
+class BulkLoader:
+    """
+    Insertion de lignes normalisées (tuples alignés sur fields) en ignorant les doublons.
+
+    - 'orm' (défaut) : instances du modèle et bulk_create(ignore_conflicts=True) ;
+    - 'native' : sans instance du modèle. Sous MySQL, les lignes sont écrites dans un TSV
+      temporaire chargé par LOAD DATA LOCAL INFILE (option local_infile requise côté client
+      et serveur) ; ailleurs, INSERT préparé exécuté par executemany.
+
+    Les valeurs passent par get_db_prep_save, comme avec l'ORM : les deux modes écrivent
+    les mêmes valeurs. Lignes et durées d'écriture sont cumulées pour le résumé.
+    """
+
+    def __init__(self, model, fields, method='orm'):
+        if method not in LOADERS:
+            raise ValueError(f"Mode d'écriture inconnu : {method}")
+        self.model = model
+        self.fields = fields
+        self.method = method
+        self.rows = 0
+        self.seconds = 0.0
+
+        self._fields = [model._meta.get_field(name) for name in fields]
+        self._prep = [field.get_db_prep_save for field in self._fields]
+        self._columns = [field.column for field in self._fields]
+
+    def insert(self, rows):
+        """Insère les lignes (dans la transaction en cours) ; doublons de clé unique ignorés"""
+        if not rows:
+            return
+        start_time = time.time()
+        if self.method == 'orm':
+            self.model.objects.bulk_create(
+                [self.model(**dict(zip(self.fields, row))) for row in rows],
+                batch_size=len(rows), ignore_conflicts=True
+            )
+        else:
+            values = [
+                [prep(value, connection) for prep, value in zip(self._prep, row)]
+                for row in rows
+            ]
+            if connection.vendor == 'mysql':
+                self._load_data(values)
+            else:
+                self._executemany(values)
+        self.rows += len(rows)
+        self.seconds += time.time() - start_time
+
+    def summary(self):
+        rate = self.rows / self.seconds if self.seconds else 0
+        return (
+            f"\n- Écriture ({self.method}) : {self.rows} lignes insérées en {self.seconds:.2f}s "
+            f"({rate:.0f} lignes/s)"
+        )
+
+    def _executemany(self, values):
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        columns = ', '.join(connection.ops.quote_name(column) for column in self._columns)
+        sql = (
+            f"{connection.ops.insert_statement(on_conflict=OnConflict.IGNORE)} {table} ({columns}) "
+            f"VALUES ({', '.join(['%s'] * len(self._columns))}) "
+            f"{connection.ops.on_conflict_suffix_sql(self._fields, OnConflict.IGNORE, None, None)}"
+        )
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, values)
+
+    def _load_data(self, values):
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='\n', suffix='.tsv', delete=False) as f:
+            for row in values:
+                f.write('\t'.join(tsv_value(value) for value in row))
+                f.write('\n')
+        try:
+            table = connection.ops.quote_name(self.model._meta.db_table)
+            columns = ', '.join(connection.ops.quote_name(column) for column in self._columns)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"LOAD DATA LOCAL INFILE %s IGNORE INTO TABLE {table} CHARACTER SET utf8mb4 "
+                    f"FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' ({columns})",
+                    [f.name]
+                )
+        finally:
+            os.remove(f.name)
+
+
+def tsv_value(value):
+    """Valeur au format texte de LOAD DATA : \\N pour NULL, caractères spéciaux échappés"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return (
+        str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    )
+
+
+@contextmanager
+def dry_run_transaction(enabled):
+    """Si enabled, exécute le bloc dans une transaction annulée en sortie (simulation complète de l'import)"""
+    if not enabled:
+        yield
+        return
+    try:
+        with transaction.atomic():
+            yield
+            raise DryRunRollback()
+    except DryRunRollback:
+        logger.info("Simulation : toutes les écritures ont été annulées")
+
+
+def peak_memory_mb():
+    """Pic de mémoire résidente (Mo) de ce processus et du plus gros processus fils terminé"""
+    # ru_maxrss est en octets sous macOS, en kilo-octets ailleurs
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit,
+    )
+
+
+class ImportProfile:
+    """
+    Durées par étape d'un import (parse, résolution des noms, écriture, recalculs...).
+
+    Les étapes peuvent s'imbriquer : chacune ne compte que son temps propre, hors étapes
+    internes. iterate() mesure le temps passé à attendre les éléments d'un itérable
+    (résultats de ParallelCSVReader). report() rassemble durées, débit, pic mémoire et
+    compteurs ; write() l'enregistre en JSON pour comparer deux versions d'un import.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages = {}
+        self._children = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        self._children.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed - self._children.pop()
+            if self._children:
+                self._children[-1] += elapsed
+
+    def iterate(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def report(self, command, options, reader=None, loader=None, **counters):
+        elapsed = time.perf_counter() - self.started_at
+        peak_self, peak_children = peak_memory_mb()
+        report = {
+            'command': command,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'options': options,
+            'elapsed_seconds': round(elapsed, 3),
+            'stages': {name: round(seconds, 3) for name, seconds in self.stages.items()},
+            'peak_memory_mb': {'main': round(peak_self, 1), 'workers': round(peak_children, 1)},
+            'counters': counters,
+        }
+        if reader is not None:
+            report['rows'] = reader.rows
+            report['rows_per_second'] = round(reader.rows / elapsed) if elapsed else 0
+            # Temps cumulés dans les processus d'analyse (en parallèle de la boucle principale)
+            report['workers'] = {
+                'count': reader.workers,
+                'csv_seconds': round(reader.parse_seconds - reader.validate_seconds, 3),
+                'validation_seconds': round(reader.validate_seconds, 3),
+                'records': reader.records,
+                'rejected': reader.rejected,
+                'warnings': reader.warnings,
+            }
+        if loader is not None:
+            report['write'] = {'method': loader.method, 'rows': loader.rows, 'seconds': round(loader.seconds, 3)}
+        return report
+
+    def summary(self, report):
+        """Lignes de résumé d'un rapport : durée par étape, débit et pic mémoire"""
+        lines = "\n\nProfil :"
+        for name, seconds in report['stages'].items():
+            share = 100 * seconds / report['elapsed_seconds'] if report['elapsed_seconds'] else 0
+            lines += f"\n- {name} : {seconds:.2f}s ({share:.0f}%)"
+        if 'workers' in report:
+            workers = report['workers']
+            lines += (
+                f"\n- Processus d'analyse ({workers['count']}) : lecture CSV {workers['csv_seconds']:.2f}s, "
+                f"validation {workers['validation_seconds']:.2f}s (cumulés)"
+                f"\n- Débit : {report['rows_per_second']} lignes/s"
+            )
+        lines += (
+            f"\n- Durée totale : {report['elapsed_seconds']:.2f}s"
+            f"\n- Pic mémoire : {report['peak_memory_mb']['main']:.0f} Mo "
+            f"(processus d'analyse : {report['peak_memory_mb']['workers']:.0f} Mo)"
+        )
+        return lines
+
+    @staticmethod
+    def write(report, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False, default=str)
@@ -0,0 +1,378 @@
+import logging
+import threading
+import time
+
+import numpy as np
+from scipy import sparse
+from django.db import connection, transaction
+
+from .generation import current_generation
+from .ranking import CommonPlantCandidates, lexsort_keys, page_order
+
+logger = logging.getLogger('metabolites')
+
+# Nombre de lignes lues à chaque aller-retour lors du chargement
+FETCH_SIZE = 50000
+
+_engine = None
+_engine_lock = threading.Lock()
+_loading = False  # chargement en cours dans un thread d'arrière-plan
+
+
+class IncidenceEngine:
+    """
+    Matrice d'incidence creuse plantes × métabolites chargée une seule fois par processus.
+
+    Les comptages de métabolites en commun (avec ou sans activité, avec ou sans
+    ubiquitaires, filtrés par métabolites) sont obtenus par un seul produit
+    matrice creuse × vecteurs au lieu des tables temporaires MySQL.
+    """
+
+    def __init__(self, generation=None):
+        start_time = time.time()
+        # Génération du jeu de données chargée (lue avant le chargement)
+        self.generation = generation
+        self._load()
+        logger.info(
+            f"Matrice d'incidence chargée en {time.time() - start_time:.3f}s : "
+            f"{self.presence.shape[0]} plantes × {self.presence.shape[1]} métabolites, "
+            f"{self.presence.nnz} associations"
+        )
+
+    def _load(self):
+        # Lectures dans une seule transaction, pour un instantané cohérent des tables : sous MySQL
+        # la connexion est en READ COMMITTED (défaut Django), d'où REPEATABLE READ pour celle-ci
+        outermost = not connection.in_atomic_block
+        with transaction.atomic(), connection.cursor() as cursor:
+            if outermost and connection.vendor == 'mysql':
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+
+            # Métabolites et masque d'ubiquité
+            cursor.execute("SELECT id, is_ubiquitous FROM metabolites_metabolite ORDER BY id")
+            rows = cursor.fetchall()
+            self.metabolite_ids = np.array([row[0] for row in rows], dtype=np.int64)
+            self.ubiquitous = np.array([bool(row[1]) for row in rows], dtype=bool)
+            n_metabolites = len(self.metabolite_ids)
+
+            # Activités et métabolites associés
+            cursor.execute("SELECT id, name FROM metabolites_activity")
+            self.activity_ids = {name: activity_id for activity_id, name in cursor.fetchall()}
+
+            cursor.execute("SELECT DISTINCT activity_id, metabolite_id FROM metabolites_metaboliteactivity")
+            activity_metabolites = {}
+            for activity_id, metabolite_id in cursor.fetchall():
+                activity_metabolites.setdefault(activity_id, []).append(metabolite_id)
+            self.activity_masks = {}
+            for activity_id, metabolite_ids in activity_metabolites.items():
+                mask = np.zeros(n_metabolites, dtype=bool)
+                columns, known = self._known_columns(metabolite_ids)
+                mask[columns[known]] = True
+                self.activity_masks[activity_id] = mask
+
+            # Associations plante-métabolite (une ligne par partie de plante)
+            plant_ids = []
+            col_ids = []
+            concentrations = []
+            cursor.execute("""
+                SELECT plant_id, metabolite_id, COALESCE(high, low, 0)
+                FROM metabolites_metaboliteplant
+                WHERE plant_id IS NOT NULL
+            """)
+            while True:
+                chunk = cursor.fetchmany(FETCH_SIZE)
+                if not chunk:
+                    break
+                for plant_id, metabolite_id, concentration in chunk:
+                    plant_ids.append(plant_id)
+                    col_ids.append(metabolite_id)
+                    concentrations.append(float(concentration))
+
+            # Associations dont le métabolite est absent de la liste lue plus haut ignorées
+            # (searchsorted donnerait la colonne d'un autre métabolite)
+            cols, known = self._known_columns(col_ids)
+            cols = cols[known]
+            concentrations = np.array(concentrations, dtype=np.float64)[known]
+            row_plant_ids, rows = np.unique(np.array(plant_ids, dtype=np.int64)[known], return_inverse=True)
+            self.plant_rows = {plant_id: row for row, plant_id in enumerate(row_plant_ids.tolist())}
+            shape = (len(self.plant_rows), n_metabolites)
+
+            # Présence distincte (0/1) et somme des concentrations par couple plante-métabolite
+            presence = sparse.coo_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=shape).tocsr()
+            presence.sum_duplicates()
+            presence.data[:] = 1
+            self.presence = presence
+            self.presence_by_metabolite = presence.tocsc()
+            self.concentrations = sparse.coo_matrix((concentrations, (rows, cols)), shape=shape).tocsr()
+
+            self.totals_all = np.asarray(presence.sum(axis=1)).ravel()
+            self.totals_non_ubiquitous = presence @ (~self.ubiquitous).astype(np.int32)
+
+            # Plantes candidates (ayant au moins un métabolite), triées par nom
+            cursor.execute("SELECT id, name, french_name FROM metabolites_plant ORDER BY name")
+            candidates = [row for row in cursor.fetchall() if row[0] in self.plant_rows]
+
+        self.candidate_ids = np.array([row[0] for row in candidates], dtype=np.int64)
+        self.candidate_names = [row[1] for row in candidates]
+        self.candidate_french_names = [row[2] for row in candidates]
+        self.candidate_rows = np.array([self.plant_rows[row[0]] for row in candidates], dtype=np.int64)
+        self.candidate_lower_names = np.array([row[1].lower() for row in candidates], dtype=str)
+        _, self.candidate_name_rank = np.unique(self.candidate_lower_names, return_inverse=True)
+
+    def _columns(self, metabolite_ids):
+        """Convertit des IDs de métabolites en indices de colonnes"""
+        return np.searchsorted(self.metabolite_ids, np.asarray(metabolite_ids, dtype=np.int64))
+
+    def _known_columns(self, metabolite_ids):
+        """Indices de colonnes et masque des IDs présents parmi les métabolites chargés"""
+        metabolite_ids = np.asarray(metabolite_ids, dtype=np.int64)
+        if not len(self.metabolite_ids):
+            return np.zeros(len(metabolite_ids), dtype=np.int64), np.zeros(len(metabolite_ids), dtype=bool)
+        columns = np.minimum(self._columns(metabolite_ids), len(self.metabolite_ids) - 1)
+        return columns, self.metabolite_ids[columns] == metabolite_ids
+
+    def _metabolite_column(self, metabolite_id):
+        column = int(self._columns([metabolite_id])[0])
+        if column < len(self.metabolite_ids) and self.metabolite_ids[column] == metabolite_id:
+            return column
+        return None
+
+    def _plants_with_metabolite(self, metabolite_id):
+        """Masque des lignes (plantes) contenant le métabolite donné"""
+        mask = np.zeros(self.presence.shape[0], dtype=bool)
+        column = self._metabolite_column(int(metabolite_id))
+        if column is not None:
+            start, end = self.presence_by_metabolite.indptr[column], self.presence_by_metabolite.indptr[column + 1]
+            mask[self.presence_by_metabolite.indices[start:end]] = True
+        return mask
+
+    def _reference(self, plant_id, exclude_ubiquitous=False):
+        """Vecteur (masque des colonnes) des métabolites de la plante de référence"""
+        reference = np.zeros(len(self.metabolite_ids), dtype=bool)
+        reference_row = self.plant_rows.get(plant_id)
+        if reference_row is not None:
+            start, end = self.presence.indptr[reference_row], self.presence.indptr[reference_row + 1]
+            reference[self.presence.indices[start:end]] = True
+        if exclude_ubiquitous:
+            reference &= ~self.ubiquitous
+        return reference
+
+    def candidates(self, plant_id, activity_filter=None, exclude_ubiquitous=False, search_text='',
+                   search_type='contains', metabolite_filters=None):
+        """
+        Plantes ayant des métabolites en commun avec plant_id (mêmes conditions que la version SQL
+        de Plant.get_common_plants), dans l'ordre alphabétique, sous forme de CommonPlantCandidates.
+        """
+        n_metabolites = len(self.metabolite_ids)
+
+        reference = self._reference(plant_id, exclude_ubiquitous)
+        reference_count = int(reference.sum())
+
+        totals = self.totals_non_ubiquitous if exclude_ubiquitous else self.totals_all
+
+        activity_mask = None
+        if activity_filter:
+            activity_id = self.activity_ids.get(activity_filter)
+            if activity_id is None:
+                logger.warning(f"Activité inconnue : {activity_filter}")
+                empty = np.empty(0, dtype=np.int64)
+                return CommonPlantCandidates(
+                    empty, [], [], empty, empty, empty, reference_count,
+                    activity=(empty, empty, np.empty(0, dtype=np.float64)), reference_id=plant_id,
+                )
+            activity_mask = self.activity_masks.get(activity_id, np.zeros(n_metabolites, dtype=bool))
+
+        # Un seul produit matrice creuse × vecteurs pour tous les comptages
+        vectors = [reference]
+        if activity_mask is not None:
+            vectors += [activity_mask, reference & activity_mask]
+        counts = self.presence @ np.column_stack(vectors).astype(np.int32)
+
+        rows = self.candidate_rows
+        common = counts[rows, 0]
+
+        mask = self.candidate_ids != plant_id
+        mask &= totals[rows] > 1
+        if activity_mask is not None:
+            mask &= counts[rows, 1] > 0
+        else:
+            mask &= common > 0
+
+        if metabolite_filters:
+            for metabolite_id in metabolite_filters:
+                if metabolite_id:
+                    mask &= self._plants_with_metabolite(metabolite_id)[rows]
+
+        if search_text:
+            needle = search_text.lower()
+            if search_type == 'contains':
+                mask &= np.char.find(self.candidate_lower_names, needle) >= 0
+            else:  # starts_with
+                mask &= np.char.startswith(self.candidate_lower_names, needle)
+
+        selected = np.flatnonzero(mask)
+        activity = None
+        if activity_mask is not None:
+            total_concentration = self.concentrations @ activity_mask.astype(np.float64)
+            activity = (
+                counts[rows[selected], 1],
+                counts[rows[selected], 2],
+                total_concentration[rows[selected]],
+            )
+
+        return CommonPlantCandidates(
+            ids=self.candidate_ids[selected],
+            names=[self.candidate_names[index] for index in selected],
+            french_names=[self.candidate_french_names[index] for index in selected],
+            name_rank=self.candidate_name_rank[selected],
+            common=common[selected],
+            totals=totals[rows[selected]],
+            reference_count=reference_count,
+            activity=activity,
+            reference_id=plant_id,
+        )
+
+    def remede_candidates(self, plant_id, activity_id, exclude_ubiquitous=False, metabolite_filters=None):
+        """
+        Plantes pouvant accompagner plant_id dans un remède pour une activité (mêmes conditions que la
+        requête SQL de remedes.views.select_plants_for_remede) : toutes les autres plantes ayant des
+        métabolites, contenant chacun des métabolites de metabolite_filters.
+        """
+        reference = self._reference(plant_id, exclude_ubiquitous)
+        activity_mask = self.activity_masks.get(activity_id, np.zeros(len(self.metabolite_ids), dtype=bool))
+        counts = self.presence @ np.column_stack([reference, activity_mask, reference & activity_mask]).astype(np.int32)
+
+        rows = self.candidate_rows
+        mask = self.candidate_ids != plant_id
+        for metabolite_id in metabolite_filters or []:
+            mask &= self._plants_with_metabolite(metabolite_id)[rows]
+
+        selected = np.flatnonzero(mask)
+        selected_rows = rows[selected]
+        total_concentration = self.concentrations @ activity_mask.astype(np.float64)
+        return CommonPlantCandidates(
+            ids=self.candidate_ids[selected],
+            names=[self.candidate_names[index] for index in selected],
+            french_names=[self.candidate_french_names[index] for index in selected],
+            name_rank=self.candidate_name_rank[selected],
+            common=counts[selected_rows, 0],
+            totals=self.totals_all[selected_rows],
+            reference_count=int(reference.sum()),
+            activity=(counts[selected_rows, 1], counts[selected_rows, 2], total_concentration[selected_rows]),
+            reference_id=plant_id,
+        )
+
+    def activity_metabolite_ids(self, plant_id, reference_id, activity_id, exclude_ubiquitous=False):
+        """
+        IDs des métabolites de plant_id ayant l'activité : (en commun avec reference_id, complémentaires)
+        """
+        row = self.plant_rows.get(plant_id)
+        activity_mask = self.activity_masks.get(activity_id)
+        if row is None or activity_mask is None:
+            return [], []
+        columns = self.presence.indices[self.presence.indptr[row]:self.presence.indptr[row + 1]]
+        columns = columns[activity_mask[columns]]
+        in_reference = self._reference(reference_id, exclude_ubiquitous)[columns]
+        return self.metabolite_ids[columns[in_reference]].tolist(), self.metabolite_ids[columns[~in_reference]].tolist()
+
+    def common_plants(self, plant_id, activity_filter=None, page=1, per_page=50, sort_params=None,
+                      exclude_ubiquitous=False, search_text='', search_type='contains', metabolite_filters=None):
+        """
+        Équivalent en mémoire de la requête SQL de Plant.get_common_plants.
+
+        Retourne (results, total_count, reference_count) avec les mêmes clés que la version SQL.
+        """
+        candidates = self.candidates(
+            plant_id, activity_filter=activity_filter, exclude_ubiquitous=exclude_ubiquitous,
+            search_text=search_text, search_type=search_type, metabolite_filters=metabolite_filters,
+        )
+        total_count = candidates.total_count
+        reference_count = candidates.reference_count
+        if not total_count:
+            return [], 0, reference_count
+
+        # Clés de tri équivalentes aux clauses ORDER BY de la version SQL
+        common_sel = candidates.common.astype(np.float64)
+        totals_sel = candidates.totals.astype(np.float64)
+
+        def sort_key(field):
+            if field == 'name':
+                return candidates.name_rank.astype(np.float64)
+            if field == 'common_metabolites':
+                return common_sel
+            if field == 'common_percentage':
+                if reference_count:
+                    by_reference = common_sel * 100.0 / reference_count
+                else:
+                    by_reference = np.zeros(total_count)
+                return np.where(reference_count >= totals_sel, common_sel * 100.0 / totals_sel, by_reference)
+            if field == 'meta_percentage_score':
+                return common_sel * common_sel / totals_sel
+            if field == 'meta_root_score':
+                return np.sqrt(common_sel) * common_sel / totals_sel
+            if candidates.activity is not None:
+                total_activity, common_activity, total_concentration = candidates.activity
+                if field == 'common_activity_metabolites':
+                    return common_activity.astype(np.float64)
+                if field == 'total_activity_metabolites':
+                    return total_activity.astype(np.float64)
+                if field == 'total_concentration':
+                    return total_concentration
+            return None
+
+        # Un seul tri multi-clés, le premier paramètre de tri étant la clé principale
+        keys = lexsort_keys(sort_key, sort_params) or candidates.default_keys()
+        positions = page_order(keys, page, per_page)
+        return candidates.rows(positions), total_count, reference_count
+
+
+def get_incidence_engine(wait=False):
+    """
+    Retourne le moteur du processus chargé pour la génération courante du jeu de données, ou None
+    tant qu'il se charge : le chargement (premier appel, ou données modifiées depuis) a lieu dans un
+    thread d'arrière-plan et les appelants utilisent la version SQL en attendant. Avec wait=True
+    (commandes, tests), le moteur est chargé dans l'appel.
+    """
+    generation = current_generation()
+    engine = _engine
+    if engine is not None and engine.generation == generation:
+        return engine
+    if wait:
+        return _load_engine(generation)
+    _load_in_background(generation)
+    return None
+
+
+def _load_engine(generation):
+    global _engine
+    engine = IncidenceEngine(generation)
+    with _engine_lock:
+        _engine = engine
+    return engine
+
+
+def _load_in_background(generation):
+    """Lance le chargement du moteur, sauf s'il y en a déjà un en cours dans le processus"""
+    global _loading
+    with _engine_lock:
+        if _loading:
+            return
+        _loading = True
+
+    def load():
+        global _loading
+        try:
+            _load_engine(generation)
+        except Exception as e:
+            logger.error(f"Échec du chargement de la matrice d'incidence : {e}")
+        finally:
+            with _engine_lock:
+                _loading = False
+            connection.close()
+
+    threading.Thread(target=load, name='incidence-engine', daemon=True).start()
+
+
+def invalidate_incidence_engine():
+    """Écarte le moteur du processus : rechargé en arrière-plan au prochain appel"""
+    global _engine
+    _engine = None
@@ -0,0 +1,64 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from metabolites.models import MetabolitePlantChange
+from metabolites.pair_changes import apply_pending_changes, last_build_top_k
+import logging
+from datetime import datetime
+import os
+import time
+
+
+class Command(BaseCommand):
+    help = "Applique le journal des modifications plantes-métabolites aux voisins précalculés (PlantPairStats)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help="Tourne en continu et consomme le journal à intervalle régulier")
+        parser.add_argument('--interval', type=float, default=10,
+                            help="Secondes entre deux passages en mode --loop")
+        parser.add_argument('--rebuild-threshold', type=int, default=50000,
+                            help="Au-delà de ce nombre de changements en attente, recalcul complet (build_plant_pairs)")
+
+    def handle(self, *args, **options):
+        # Création du dossier logs s'il n'existe pas
+        logs_dir = "logs"
+        if not os.path.exists(logs_dir):
+            os.makedirs(logs_dir)
+
+        # Configuration des logs
+        log_filename = f"{logs_dir}/pair_changes_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+        logging.basicConfig(
+            filename=log_filename,
+            level=logging.INFO,
+            format='%(asctime)s - %(levelname)s - %(message)s'
+        )
+
+        self.stdout.write(self.style.SUCCESS("Début de l'application du journal des modifications..."))
+        logging.info("Début de l'application du journal des modifications")
+
+        while True:
+            try:
+                pending = MetabolitePlantChange.objects.count()
+                if pending > options['rebuild_threshold']:
+                    # Import massif : un recalcul complet est moins coûteux que les deltas
+                    self.stdout.write(f"{pending} changements en attente, recalcul complet des voisins")
+                    logging.info(f"{pending} changements en attente, recalcul complet des voisins")
+                    call_command('build_plant_pairs', top_k=last_build_top_k())
+                elif pending:
+                    applied, recomputed = apply_pending_changes()
+                    summary = (
+                        f"\nJournal appliqué !"
+                        f"\n- Changements appliqués : {applied}"
+                        f"\n- Plantes recalculées : {recomputed}"
+                    )
+                    self.stdout.write(self.style.SUCCESS(summary))
+                    logging.info(summary)
+
+            except Exception as e:
+                error_msg = f"Erreur lors de l'application du journal : {str(e)}"
+                self.stdout.write(self.style.ERROR(error_msg))
+                logging.error(error_msg)
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
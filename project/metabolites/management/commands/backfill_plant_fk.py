@@ -0,0 +1,179 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Min
+from metabolites.models import MetabolitePlant, Plant
+from remedes.models import Remede
+from tabs_numbering.models import PlantNumbering
+from tqdm import tqdm
+import logging
+from datetime import datetime
+import os
+
+# Nombre d'associations mises à jour par requête UPDATE
+BATCH_SIZE = 20000
+
+
+class Command(BaseCommand):
+    help = ("Renseigne la clé étrangère plant des associations plantes-métabolites à partir de plant_name. "
+            "À lancer avant migrate (fusion des plantes en double), puis après l'ajout de la clé plant nullable ; "
+            "la migration suivante rend la colonne NOT NULL")
+
+    def handle(self, *args, **options):
+        # Création du dossier logs s'il n'existe pas
+        logs_dir = "logs"
+        if not os.path.exists(logs_dir):
+            os.makedirs(logs_dir)
+
+        # Configuration des logs
+        log_filename = f"{logs_dir}/backfill_plant_fk_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+        logging.basicConfig(
+            filename=log_filename,
+            level=logging.INFO,
+            format='%(asctime)s - %(levelname)s - %(message)s'
+        )
+
+        self.stdout.write(self.style.SUCCESS("Début du renseignement de la clé plant..."))
+        logging.info("Début du renseignement de la clé plant")
+
+        try:
+            duplicates_merged = self.merge_duplicate_plants()
+            if not self.has_plant_column():
+                # Avant la migration : seule la fusion des doublons est possible
+                self.stdout.write(self.style.WARNING(
+                    f"Plantes en double fusionnées : {duplicates_merged}. "
+                    f"Appliquez les migrations puis relancez la commande."
+                ))
+                return
+            plants_created = self.create_missing_plants()
+            rows_updated = self.fill_plant_ids()
+            rows_missing = MetabolitePlant.objects.filter(plant__isnull=True).count()
+            if rows_updated:
+                # Les UPDATE en masse ne déclenchent pas les signaux : recalcul complet des compteurs
+                call_command('rebuild_plant_stats', stdout=self.stdout)
+
+            # Affichage du résumé
+            summary = (
+                f"\nRenseignement terminé !"
+                f"\n- Plantes en double fusionnées : {duplicates_merged}"
+                f"\n- Nouvelles plantes créées : {plants_created}"
+                f"\n- Associations mises à jour : {rows_updated}"
+                f"\n- Associations sans plante : {rows_missing}"
+            )
+            self.stdout.write(self.style.SUCCESS(summary))
+            logging.info(summary)
+            if rows_missing:
+                # La migration NOT NULL de la clé plant échouerait
+                warning = (f"{rows_missing} associations sans plante (plant_name vide) : "
+                           f"à corriger ou supprimer avant la migration NOT NULL de la clé plant")
+                self.stdout.write(self.style.WARNING(warning))
+                logging.warning(warning)
+
+        except Exception as e:
+            error_msg = f"Erreur lors du renseignement : {str(e)}"
+            self.stdout.write(self.style.ERROR(error_msg))
+            logging.error(error_msg)
+
+    def has_plant_column(self):
+        with connection.cursor() as cursor:
+            columns = connection.introspection.get_table_description(cursor, MetabolitePlant._meta.db_table)
+        return any(column.name == 'plant_id' for column in columns)
+
+    def merge_duplicate_plants(self):
+        """
+        Fusionne les plantes portant le même nom (prérequis de la contrainte unique sur Plant.name).
+        La plante d'ID le plus petit est conservée, les références sont redirigées vers elle.
+
+        En SQL brut sur les seules tables d'origine (plantes, remèdes, numérotations), sans signaux
+        ni suppression en cascade de l'ORM : la fusion se fait avant migrate, qui échoue tant que
+        des doublons existent, alors que les tables ajoutées par les migrations n'existent pas encore.
+        """
+        plant_table = Plant._meta.db_table
+        remede_table = Remede._meta.db_table
+        remede_plants_table = Remede.plants.through._meta.db_table
+        numbering_table = PlantNumbering._meta.db_table
+        has_plant_column = self.has_plant_column()
+
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT name, MIN(id) FROM {plant_table} GROUP BY name HAVING COUNT(*) > 1")
+            duplicates = cursor.fetchall()
+
+        merged = 0
+        for name, keep_id in duplicates:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(f"SELECT id, french_name FROM {plant_table} WHERE name = %s ORDER BY id", [name])
+                plants = cursor.fetchall()
+                other_ids = [plant_id for plant_id, _ in plants if plant_id != keep_id]
+                placeholders = ', '.join(['%s'] * len(other_ids))
+
+                cursor.execute(
+                    f"UPDATE {remede_table} SET target_plant_id = %s WHERE target_plant_id IN ({placeholders})",
+                    [keep_id] + other_ids
+                )
+
+                # Plantes des remèdes : un seul lien par remède vers la plante conservée
+                cursor.execute(
+                    f"SELECT DISTINCT remede_id FROM {remede_plants_table} WHERE plant_id IN ({placeholders})", other_ids
+                )
+                remede_ids = {row[0] for row in cursor.fetchall()}
+                cursor.execute(f"SELECT remede_id FROM {remede_plants_table} WHERE plant_id = %s", [keep_id])
+                remede_ids -= {row[0] for row in cursor.fetchall()}
+                cursor.executemany(
+                    f"INSERT INTO {remede_plants_table} (remede_id, plant_id) VALUES (%s, %s)",
+                    [(remede_id, keep_id) for remede_id in sorted(remede_ids)]
+                )
+                cursor.execute(f"DELETE FROM {remede_plants_table} WHERE plant_id IN ({placeholders})", other_ids)
+
+                cursor.execute(
+                    f"UPDATE {numbering_table} SET plant_id = %s WHERE plant_id IN ({placeholders})", [keep_id] + other_ids
+                )
+                if has_plant_column:
+                    cursor.execute(
+                        f"UPDATE metabolites_metaboliteplant SET plant_id = %s WHERE plant_id IN ({placeholders})",
+                        [keep_id] + other_ids
+                    )
+
+                # Nom français de la plante conservée, sinon celui du premier doublon qui en a un
+                french_name = next((french_name for plant_id, french_name in plants if plant_id == keep_id), None) \
+                    or next((french_name for _, french_name in plants if french_name), None)
+                cursor.execute(f"UPDATE {plant_table} SET french_name = %s WHERE id = %s", [french_name, keep_id])
+                cursor.execute(f"DELETE FROM {plant_table} WHERE id IN ({placeholders})", other_ids)
+
+                merged += len(other_ids)
+                logging.info(f"Plante fusionnée : {name} ({len(other_ids)} doublon(s))")
+        return merged
+
+    def create_missing_plants(self):
+        """Crée les plantes référencées par plant_name mais absentes de la table Plant"""
+        existing = set(Plant.objects.values_list('name', flat=True))
+        names = (
+            MetabolitePlant.objects.filter(plant__isnull=True)
+            .values_list('plant_name', flat=True).distinct()
+        )
+        missing = [name for name in names if name and name not in existing]
+        Plant.objects.bulk_create([Plant(name=name) for name in missing], batch_size=1000)
+        for name in missing:
+            logging.info(f"Nouvelle plante créée : {name}")
+        return len(missing)
+
+    def fill_plant_ids(self):
+        """Renseigne plant_id par tranches d'IDs pour limiter la taille des transactions"""
+        bounds = MetabolitePlant.objects.filter(plant__isnull=True).aggregate(low=Min('id'))
+        if bounds['low'] is None:
+            return 0
+        high = MetabolitePlant.objects.order_by('-id').values_list('id', flat=True).first()
+
+        updated = 0
+        with connection.cursor() as cursor:
+            for start in tqdm(range(bounds['low'], high + 1, BATCH_SIZE), desc="Mise à jour des associations"):
+                cursor.execute("""
+                    UPDATE metabolites_metaboliteplant
+                    SET plant_id = (
+                        SELECT p.id FROM metabolites_plant p
+                        WHERE p.name = metabolites_metaboliteplant.plant_name
+                    )
+                    WHERE plant_id IS NULL
+                    AND id >= %s AND id < %s
+                """, [start, start + BATCH_SIZE])
+                updated += cursor.rowcount
+        return updated
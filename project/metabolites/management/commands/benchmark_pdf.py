@@ -0,0 +1,131 @@
+from django.core.management.base import BaseCommand, CommandError
+from metabolites.models import Plant
+from metabolites.pdf import common_plants_pdf
+import json
+import random
+import re
+import statistics
+import time
+import tracemalloc
+
+PAGE_PATTERN = re.compile(rb'/Type /Page\b(?!s)')
+
+
+def synthetic_results(size, metabolite_ids=(), activity=False, seed=0):
+    """Résultats classés fictifs, de même structure que get_common_plants_page (enrichis comme la vue)"""
+    rng = random.Random(seed)
+    results = []
+    for index in range(size):
+        common_count = rng.randint(1, 400)
+        row = {
+            'id': index + 1,
+            'name': f"Plantus exemplaris var. {index:05d}",
+            'french_name': f"Plante exemple {index}" if index % 3 else None,
+            'common_metabolites_count': common_count,
+            'common_metabolites_percentage': round(rng.uniform(0, 100), 1),
+            'percentage_type': rng.choice(['blue', 'green']),
+            'amino_acid_similarity': rng.random(),
+            'meta_percentage_score': round(rng.uniform(0, 100), 2),
+            'meta_root_score': round(rng.uniform(0, 20), 2),
+            'numbering': index + 1 if index % 4 else None,
+            'metabolite_concentrations': {
+                metabolite_id: {'average': rng.uniform(0, 5000), 'details': [], 'count': rng.randint(0, 3)}
+                for metabolite_id in metabolite_ids
+            },
+        }
+        if activity:
+            row['common_activity_metabolites_count'] = rng.randint(0, common_count)
+            row['total_activity_metabolites_count'] = rng.randint(common_count, 800)
+            row['total_concentration'] = rng.uniform(0, 50000)
+        results.append(row)
+    return results
+
+
+class Command(BaseCommand):
+    help = ("Mesure la génération du PDF des plantes en commun (metabolites.pdf) : latence et mémoire "
+            "pour plusieurs nombres de lignes, sur des résultats fictifs ou le classement réel d'une plante")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[20, 100, 1000], help="Nombres de lignes mesurés")
+        parser.add_argument('--repeat', type=int, default=5, help="Générations mesurées par taille (médiane retenue)")
+        parser.add_argument('--metabolites', type=int, default=0,
+                            help="Nombre de colonnes de concentration (métabolites filtrés, 3 au plus)")
+        parser.add_argument('--activity', help="Ajoute les colonnes d'une activité filtrée (nom affiché)")
+        parser.add_argument('--numbered', action='store_true', help="Ajoute la colonne de numérotation")
+        parser.add_argument('--plant', type=int, help="Classement réel de cette plante (get_common_plants_page)")
+        parser.add_argument('--save-dir', help="Enregistre le PDF généré pour chaque taille dans ce dossier")
+        parser.add_argument('--output', help="Fichier JSON des mesures")
+
+    def handle(self, *args, **options):
+        filtered_metabolites = [
+            {'id': metabolite_id, 'name': f"Métabolite {metabolite_id}"}
+            for metabolite_id in range(1, min(options['metabolites'], 3) + 1)
+        ]
+        if options['plant']:
+            try:
+                plant = Plant.objects.get(id=options['plant'])
+            except Plant.DoesNotExist:
+                raise CommandError(f"Plante {options['plant']} introuvable")
+        else:
+            plant = Plant(name="Plantus exemplaris", french_name="Plante exemple")
+
+        measures = []
+        for size in options['sizes']:
+            if options['plant']:
+                results = plant.get_common_plants_page(page=1, per_page=size)['results']
+            else:
+                results = synthetic_results(size, [metabolite['id'] for metabolite in filtered_metabolites],
+                                            activity=bool(options['activity']))
+
+            def render():
+                return common_plants_pdf(
+                    plant, results, filtered_metabolites=filtered_metabolites,
+                    activity_filter=options['activity'], numbered=options['numbered'],
+                    filters_description=[], sorting_description=[], generated_at="benchmark",
+                )
+
+            # Latence : médiane de repeat générations (après une génération de chauffe)
+            pdf = render()
+            timings = []
+            for _ in range(max(options['repeat'], 1)):
+                start_time = time.perf_counter()
+                render()
+                timings.append(time.perf_counter() - start_time)
+
+            # Mémoire : pic des allocations Python pendant une génération, mesuré à part (tracemalloc ralentit)
+            tracemalloc.start()
+            render()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            if options['save_dir']:
+                with open(f"{options['save_dir']}/common_plants_{size}.pdf", 'wb') as f:
+                    f.write(pdf)
+
+            measure = {
+                'rows': len(results),
+                'median_ms': round(statistics.median(timings) * 1000, 1),
+                'min_ms': round(min(timings) * 1000, 1),
+                'ms_per_row': round(statistics.median(timings) * 1000 / max(len(results), 1), 2),
+                'peak_memory_mb': round(peak / 1024 / 1024, 2),
+                'pages': len(PAGE_PATTERN.findall(pdf)),
+                'pdf_kb': round(len(pdf) / 1024, 1),
+            }
+            measures.append(measure)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"\nPDF des plantes en commun ({'plante ' + str(plant.id) if options['plant'] else 'résultats fictifs'}, "
+            f"{len(filtered_metabolites)} concentrations{', activité' if options['activity'] else ''}"
+            f"{', numérotation' if options['numbered'] else ''}) :"
+        ))
+        self.stdout.write(f"{'lignes':>8} {'médiane':>10} {'min':>10} {'par ligne':>10} {'mémoire':>10} {'pages':>6} {'taille':>9}")
+        for measure in measures:
+            self.stdout.write(
+                f"{measure['rows']:>8} {measure['median_ms']:>8.1f}ms {measure['min_ms']:>8.1f}ms "
+                f"{measure['ms_per_row']:>8.2f}ms {measure['peak_memory_mb']:>8.2f}Mo {measure['pages']:>6} "
+                f"{measure['pdf_kb']:>7.1f}Ko"
+            )
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(measures, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,123 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+from metabolites.incidence import IncidenceEngine
+from metabolites.models import MetabolitePlantChange
+from metabolites.pairs import init_worker, compute_block, write_pair_rows, save_neighbour_counts
+from tqdm import tqdm
+import numpy as np
+import logging
+from datetime import datetime
+import os
+
+
+class Command(BaseCommand):
+    help = "Précalcule les plantes voisines (métabolites en commun) par produit creux P·Pᵀ par blocs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=settings.PLANT_PAIR_TOP_K,
+                            help="Voisins conservés par plante et par critère de tri (enregistré dans PlantStats : "
+                                 "seules les pages jusqu'à ce rang sont servies par le précalcul)")
+        parser.add_argument('--block-size', type=int, default=256,
+                            help="Nombre de plantes (lignes) calculées par bloc")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Nombre de processus de calcul (1 = calcul dans le processus courant)")
+
+    def handle(self, *args, **options):
+        # Création du dossier logs s'il n'existe pas
+        logs_dir = "logs"
+        if not os.path.exists(logs_dir):
+            os.makedirs(logs_dir)
+
+        # Configuration des logs
+        log_filename = f"{logs_dir}/plant_pairs_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+        logging.basicConfig(
+            filename=log_filename,
+            level=logging.INFO,
+            format='%(asctime)s - %(levelname)s - %(message)s'
+        )
+
+        self.stdout.write(self.style.SUCCESS("Début du calcul des plantes voisines..."))
+        logging.info("Début du calcul des plantes voisines")
+
+        try:
+            # Les modifications journalisées jusqu'ici sont intégrées au calcul complet ;
+            # celles enregistrées pendant le calcul seront appliquées par apply_pair_changes
+            computed_at = timezone.now()
+            last_change_id = MetabolitePlantChange.objects.order_by('-id').values_list('id', flat=True).first()
+            top_k = options['top_k']
+            block_size = options['block_size']
+
+            engine = IncidenceEngine()
+            n_rows = engine.presence.shape[0]
+            self.row_plant_ids = np.empty(n_rows, dtype=np.int64)
+            for plant_id, row in engine.plant_rows.items():
+                self.row_plant_ids[row] = plant_id
+
+            # Rang alphabétique et éligibilité (plante présente dans la table Plant) par ligne
+            name_rank = np.zeros(n_rows, dtype=np.int64)
+            name_rank[engine.candidate_rows] = engine.candidate_name_rank
+            eligible = np.zeros(n_rows, dtype=bool)
+            eligible[engine.candidate_rows] = True
+
+            variants = {
+                False: (engine.presence, engine.totals_all),
+                True: (engine.presence[:, ~engine.ubiquitous].tocsr(), engine.totals_non_ubiquitous),
+            }
+            tasks = [
+                (exclude_ubiquitous, np.arange(start, min(start + block_size, n_rows)), top_k)
+                for exclude_ubiquitous in variants
+                for start in range(0, n_rows, block_size)
+            ]
+            self.stdout.write(f"{n_rows} plantes, {len(tasks)} blocs, top-K = {top_k}")
+            logging.info(f"{n_rows} plantes, {len(tasks)} blocs, top-K = {top_k}")
+
+            self.pairs_written = 0
+            self.neighbour_counts = {False: {}, True: {}}
+            progress = tqdm(total=len(tasks), desc="Calcul des voisins")
+
+            if options['workers'] <= 1:
+                init_worker(variants, name_rank, eligible)
+                for task in tasks:
+                    self.write_block(*compute_block(*task))
+                    progress.update(1)
+            else:
+                # Seul le processus principal écrit en base : les processus de calcul n'ouvrent pas de connexion
+                connections.close_all()
+                with ProcessPoolExecutor(
+                    max_workers=options['workers'],
+                    initializer=init_worker,
+                    initargs=(variants, name_rank, eligible),
+                ) as executor:
+                    futures = [executor.submit(compute_block, *task) for task in tasks]
+                    for future in as_completed(futures):
+                        self.write_block(*future.result())
+                        progress.update(1)
+            progress.close()
+
+            for exclude_ubiquitous, neighbour_counts in self.neighbour_counts.items():
+                save_neighbour_counts(exclude_ubiquitous, neighbour_counts, computed_at, top_k)
+            if last_change_id is not None:
+                MetabolitePlantChange.objects.filter(id__lte=last_change_id).delete()
+
+            # Affichage du résumé
+            summary = (
+                f"\nCalcul terminé !"
+                f"\n- Plantes traitées : {n_rows}"
+                f"\n- Couples de voisins enregistrés : {self.pairs_written}"
+            )
+            self.stdout.write(self.style.SUCCESS(summary))
+            logging.info(summary)
+
+        except Exception as e:
+            error_msg = f"Erreur lors du calcul des voisins : {str(e)}"
+            self.stdout.write(self.style.ERROR(error_msg))
+            logging.error(error_msg)
+
+    def write_block(self, exclude_ubiquitous, rows):
+        """Remplace les voisins des plantes du bloc"""
+        neighbour_counts, pairs_written = write_pair_rows(self.row_plant_ids, exclude_ubiquitous, rows)
+        self.neighbour_counts[exclude_ubiquitous].update(neighbour_counts)
+        self.pairs_written += pairs_written
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from metabolites.models import Plant, PlantMetaboliteConcentration
+from metabolites.stats import refresh_plant_concentrations, CHUNK_SIZE
+from metabolites.generation import bump_generation
+from tqdm import tqdm
+import logging
+from datetime import datetime
+import os
+
+
+class Command(BaseCommand):
+    help = "Recalcule entièrement les concentrations agrégées par plante et métabolite (PlantMetaboliteConcentration)"
+
+    def handle(self, *args, **options):
+        # Création du dossier logs s'il n'existe pas
+        logs_dir = "logs"
+        if not os.path.exists(logs_dir):
+            os.makedirs(logs_dir)
+
+        # Configuration des logs
+        log_filename = f"{logs_dir}/rebuild_plant_concentrations_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+        logging.basicConfig(
+            filename=log_filename,
+            level=logging.INFO,
+            format='%(asctime)s - %(levelname)s - %(message)s'
+        )
+
+        self.stdout.write(self.style.SUCCESS("Début du recalcul des concentrations par plante..."))
+        logging.info("Début du recalcul des concentrations par plante")
+
+        try:
+            plant_ids = list(Plant.objects.order_by('id').values_list('id', flat=True))
+            for start in tqdm(range(0, len(plant_ids), CHUNK_SIZE), desc="Recalcul des concentrations"):
+                refresh_plant_concentrations(plant_ids[start:start + CHUNK_SIZE])
+
+            # Les résultats en cache ont pu être calculés à partir de données dérivées erronées
+            bump_generation()
+
+            # Affichage du résumé
+            summary = (
+                f"\nRecalcul terminé !"
+                f"\n- Plantes traitées : {len(plant_ids)}"
+                f"\n- Concentrations enregistrées : {PlantMetaboliteConcentration.objects.count()}"
+            )
+            self.stdout.write(self.style.SUCCESS(summary))
+            logging.info(summary)
+
+        except Exception as e:
+            error_msg = f"Erreur lors du recalcul : {str(e)}"
+            self.stdout.write(self.style.ERROR(error_msg))
+            logging.error(error_msg)
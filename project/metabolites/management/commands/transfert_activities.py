@@ -1,7 +1,11 @@
 from django.core.management.base import BaseCommand
-import csv
+from django.db import transaction
 from metabolites.models import Metabolite, MetaboliteActivity, Activity
-from tqdm import tqdm
+from metabolites.generation import bump_generation
+from metabolites.importing import (
+    LOADERS, BulkLoader, ImportProfile, ParallelCSVReader, RejectedRow, dry_run_transaction
+)
+from metabolites.stats import deferred_plant_stats, plants_with_metabolites, schedule_plant_stats
 import logging
 from datetime import datetime
 import os
@@ -9,17 +13,59 @@ import os
 # Chemin relatif depuis le dossier project/
 csv_file = "ressources/datas/all_chemicals_activities.csv"
 
+
+def parse_row(row, warnings):
+    """Ligne du CSV normalisée : (métabolite, type d'activité, dosage, référence)"""
+    # Vérification du nombre de colonnes
+    if len(row) != 4:
+        raise RejectedRow(
+            f"Ligne ignorée - nombre incorrect de colonnes ({len(row)} au lieu de 4) : \n"
+            f"Contenu de la ligne : {row}"
+        )
+
+    name, activity_type, dosage, reference = row
+
+    if not name or not activity_type:
+        raise RejectedRow(f"Ligne ignorée - nom ou type d'activité manquant : {row}")
+
+    # Nettoyage des données
+    return (
+        name.strip(),
+        activity_type.strip(),
+        dosage.strip() if dosage else None,
+        reference.strip() if reference else None,
+    )
+
+
 class Command(BaseCommand):
     help = "Importe les activités des métabolites depuis le fichier CSV"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=csv_file, help="Fichier CSV à importer")
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help="Nombre de lignes insérées par transaction")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Nombre de processus d'analyse du fichier")
+        parser.add_argument('--chunk-size', type=float, default=4,
+                            help="Taille (Mo) des morceaux de fichier analysés par processus")
+        parser.add_argument('--loader', choices=LOADERS, default='orm',
+                            help="Écriture des nouvelles activités : bulk_create (orm) ou chargement natif "
+                                 "(LOAD DATA LOCAL INFILE sous MySQL, executemany ailleurs)")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Exécute toutes les étapes dans une transaction annulée en fin d'import")
+        parser.add_argument('--profile', action='store_true',
+                            help="Affiche durée par étape, débit et pic mémoire, et les enregistre en JSON")
+        parser.add_argument('--profile-output', help="Fichier du rapport JSON (défaut : à côté du fichier de log)")
+
     def handle(self, *args, **options):
         # Création du dossier logs s'il n'existe pas
         logs_dir = "logs"
         if not os.path.exists(logs_dir):
             os.makedirs(logs_dir)
-            
+
         # Configuration des logs
-        log_filename = f"{logs_dir}/activities_import_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+        log_basename = f"{logs_dir}/activities_import_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        log_filename = f"{log_basename}.log"
         logging.basicConfig(
             filename=log_filename,
             level=logging.INFO,
@@ -30,98 +76,132 @@ class Command(BaseCommand):
         logging.info("Début de l'import des activités")
 
         try:
-            activities_created = 0
-            activity_types_created = 0
+            profile = ImportProfile()
+            self.activities_created = 0
+            self.activity_types_created = 0
             metabolites_not_found = 0
-            problematic_rows = 0
-
-            # Compte le nombre total de lignes pour la barre de progression
-            with open(csv_file, 'r', encoding='utf-8') as f:
-                total_rows = sum(1 for _ in f) - 1  # -1 pour l'en-tête si présent
-
-            # Lecture du fichier CSV
-            with open(csv_file, 'r', encoding='utf-8') as f:
-                reader = csv.reader(f, quotechar='"', doublequote=True, delimiter=',')
-                next(reader, None)  # Skip header if exists
-                
-                self.stdout.write(f"Nombre total d'activités à traiter : {total_rows}")
-
-                # Utilisation de tqdm pour afficher une barre de progression
-                for row in tqdm(reader, total=total_rows, desc="Traitement des activités"):
-                    try:
-                        # Vérification du nombre de colonnes
-                        if len(row) != 4:
-                            error_msg = (
-                                f"Ligne ignorée - nombre incorrect de colonnes ({len(row)} au lieu de 4) : \n"
-                                f"Contenu de la ligne : {row}"
-                            )
-                            logging.error(error_msg)
-                            problematic_rows += 1
-                            continue
-
-                        name, activity_type, dosage, reference = row
-
-                        if not name or not activity_type:
-                            error_msg = f"Ligne ignorée - nom ou type d'activité manquant : {row}"
-                            logging.error(error_msg)
-                            problematic_rows += 1
-                            continue
-
-                        # Nettoyage des données
-                        name = name.strip()
-                        activity_type = activity_type.strip()
-                        dosage = dosage.strip() if dosage else None
-                        reference = reference.strip() if reference else None
-
-                        # Récupère le métabolite
-                        try:
-                            metabolite = Metabolite.objects.get(name=name)
-                        except Metabolite.DoesNotExist:
-                            error_msg = f"Métabolite non trouvé : {name}"
-                            logging.error(error_msg)
-                            metabolites_not_found += 1
-                            continue
-
-                        # Crée ou récupère l'objet Activity
-                        activity, created = Activity.objects.get_or_create(
-                            name=activity_type
-                        )
-                        if created:
-                            activity_types_created += 1
-                            logging.info(f"Nouveau type d'activité créé : {activity_type}")
-
-                        # Crée l'activité
-                        _, created = MetaboliteActivity.objects.get_or_create(
-                            metabolite=metabolite,
-                            activity=activity,
-                            dosage=dosage,
-                            reference=reference
-                        )
-                        if created:
-                            activities_created += 1
-                            logging.debug(f"Activité créée pour {metabolite.name}: {activity_type}")
-
-                    except Exception as row_error:
-                        error_msg = (
-                            f"Erreur sur la ligne : \n"
-                            f"Contenu : {row}\n"
-                            f"Erreur : {str(row_error)}"
-                        )
-                        logging.error(error_msg)
-                        problematic_rows += 1
+            batch_size = max(options['batch_size'], 1)
+
+            # Correspondances nom -> id (sans tenir compte de la casse, comme la collation MySQL)
+            # et associations existantes chargées une seule fois
+            with profile.stage('preload'):
+                metabolites = {name.casefold(): metabolite_id for name, metabolite_id in Metabolite.objects.values_list('name', 'id')}
+                self.activities = {name.casefold(): activity_id for name, activity_id in Activity.objects.values_list('name', 'id')}
+                self.existing = set(
+                    MetaboliteActivity.objects.values_list('metabolite_id', 'activity_id', 'dosage', 'reference')
+                )
+            self.touched_metabolites = set()
+            self.loader = BulkLoader(
+                MetaboliteActivity, ('metabolite_id', 'activity_id', 'dosage', 'reference'), options['loader']
+            )
+
+            # Analyse en parallèle, écriture par lots dans ce processus uniquement
+            reader = ParallelCSVReader(
+                options['file'], parse_row, encoding='utf-8', workers=options['workers'],
+                chunk_bytes=int(options['chunk_size'] * 1024 * 1024), desc="Traitement des activités"
+            )
+
+            # Les écritures en masse ne déclenchent pas les signaux : compteurs et génération
+            # sont mis à jour par la commande elle-même (recalculs en sortie de deferred_plant_stats)
+            with dry_run_transaction(options['dry_run']), profile.stage('stats'), deferred_plant_stats():
+                for records in profile.iterate('parse', reader.batches(batch_size)):
+                    with profile.stage('resolve'):
+                        batch = []
+                        for name, activity_type, dosage, reference in records:
+                            # Récupère le métabolite
+                            metabolite_id = metabolites.get(name.casefold())
+                            if metabolite_id is None:
+                                logging.error(f"Métabolite non trouvé : {name}")
+                                metabolites_not_found += 1
+                                continue
+                            batch.append((metabolite_id, activity_type, dosage, reference))
+                    if batch:
+                        with profile.stage('write'):
+                            self._write_batch(batch)
+
+                # Compteurs par activité des plantes contenant les métabolites concernés
+                if self.touched_metabolites:
+                    schedule_plant_stats(plants_with_metabolites(self.touched_metabolites))
+                if self.touched_metabolites or self.activity_types_created:
+                    bump_generation()
 
             # Affichage du résumé
             summary = (
-                f"\nImport terminé !"
-                f"\n- Activités créées : {activities_created}"
-                f"\n- Types d'activités créés : {activity_types_created}"
+                f"\nImport terminé !{' (simulation : aucune modification enregistrée)' if options['dry_run'] else ''}"
+                f"\n- Activités créées : {self.activities_created}"
+                f"\n- Types d'activités créés : {self.activity_types_created}"
                 f"\n- Métabolites non trouvés : {metabolites_not_found}"
-                f"\n- Lignes problématiques : {problematic_rows}"
+                f"\n- Lignes problématiques : {reader.rejected}"
+                f"{reader.summary()}"
+                f"{self.loader.summary()}"
             )
+
+            if options['profile']:
+                report = profile.report(
+                    'transfert_activities',
+                    {name: options[name] for name in ('file', 'batch_size', 'workers', 'chunk_size', 'loader', 'dry_run')},
+                    reader, self.loader,
+                    created=self.activities_created, activity_types_created=self.activity_types_created,
+                    metabolites_not_found=metabolites_not_found,
+                )
+                report_path = options['profile_output'] or f"{log_basename}_profile.json"
+                ImportProfile.write(report, report_path)
+                summary += f"{profile.summary(report)}\n- Rapport : {report_path}"
+
             self.stdout.write(self.style.SUCCESS(summary))
             logging.info(summary)
 
         except Exception as e:
             error_msg = f"Erreur lors de l'import : {str(e)}"
             self.stdout.write(self.style.ERROR(error_msg))
-            logging.error(error_msg) 
\ No newline at end of file
+            logging.error(error_msg)
+
+    def _create_activities(self, activity_types):
+        """
+        Crée en une requête les types d'activités absents (quelle que soit la casse, première
+        orthographe rencontrée dans le fichier) et relit leurs ids : bulk_create ne les retourne pas
+        sous MySQL, et ignore les noms que la collation confond avec un type existant.
+        Seuls les types réellement créés sont comptés.
+        """
+        new_types = {}
+        for activity_type in activity_types:
+            if activity_type.casefold() not in self.activities:
+                new_types.setdefault(activity_type.casefold(), activity_type)
+        if not new_types:
+            return
+
+        known_ids = set(self.activities.values())
+        Activity.objects.bulk_create([Activity(name=name) for name in new_types.values()], ignore_conflicts=True)
+        created = []
+        for activity_id, name in Activity.objects.filter(name__in=new_types.values()).values_list('id', 'name'):
+            self.activities[name.casefold()] = activity_id
+            if activity_id not in known_ids:
+                known_ids.add(activity_id)
+                created.append(name)
+
+        # Nom relu sous une autre orthographe (accents selon la collation) : résolu par la base
+        for folded, activity_type in new_types.items():
+            if folded not in self.activities:
+                self.activities[folded] = Activity.objects.filter(name=activity_type).values_list('id', flat=True).get()
+
+        self.activity_types_created += len(created)
+        for activity_type in sorted(created):
+            logging.info(f"Nouveau type d'activité créé : {activity_type}")
+
+    def _write_batch(self, batch):
+        """Écrit un lot de lignes (métabolite, type d'activité, dosage, référence) en une transaction"""
+        with transaction.atomic():
+            self._create_activities(activity_type for _, activity_type, _, _ in batch)
+
+            to_create = []
+            for metabolite_id, activity_type, dosage, reference in batch:
+                key = (metabolite_id, self.activities[activity_type.casefold()], dosage, reference)
+                if key in self.existing:
+                    continue
+                self.existing.add(key)
+                to_create.append(key)
+
+            self.loader.insert(to_create)
+
+        self.activities_created += len(to_create)
+        self.touched_metabolites.update(metabolite_id for metabolite_id, _, _, _ in to_create)
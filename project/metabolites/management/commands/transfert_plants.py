@@ -1,8 +1,18 @@
-from django.core.management.base import BaseCommand
-import csv
-from metabolites.models import Metabolite, MetabolitePlant, Plant
-from tqdm import tqdm
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from metabolites.models import ImportFingerprint, Metabolite, MetabolitePlant, Plant
+from metabolites.generation import bump_generation
+from metabolites.importing import (
+    LOADERS, BulkLoader, ImportProfile, ParallelCSVReader, RejectedRow, dry_run_transaction, fingerprint
+)
+from metabolites.pair_changes import log_presence_changes
+from metabolites.staging import StagingTable
+from metabolites.stats import deferred_plant_stats, schedule_plant_stats, schedule_plant_concentrations
 from decimal import Decimal, InvalidOperation
+from functools import reduce
+from operator import or_
+import numpy as np
 import logging
 from datetime import datetime
 import os
@@ -10,17 +20,103 @@ import os
 # Chemin relatif depuis le dossier project/
 csv_file = "ressources/datas/all_chemicals_plants.csv"
 
+# Valeurs numériques absentes dans le CSV
+MISSING_VALUES = ('', 'not available')
+
+# Source des empreintes (ImportFingerprint) de l'import incrémental
+FINGERPRINT_SOURCE = 'transfert_plants'
+
+# Nombre de lignes source disparues supprimées par requête
+DELETE_CHUNK_SIZE = 500
+
+# Colonnes des associations insérées (BulkLoader)
+INSERT_FIELDS = ('metabolite_id', 'plant_id', 'plant_name', 'plant_part', 'low', 'high', 'deviation', 'reference')
+
+
+def parse_decimal(value):
+    """Valeur numérique du CSV, None si elle est absente (InvalidOperation si elle est invalide)"""
+    value = value.strip()
+    if value.lower() in MISSING_VALUES:
+        return None
+    return Decimal(value)
+
+
+def parse_row(row, warnings):
+    """Ligne du CSV normalisée : (métabolite, plante, partie, (low, high, deviation), référence)"""
+    # Vérification du nombre de colonnes
+    if len(row) != 7:
+        raise RejectedRow(
+            f"Ligne ignorée - nombre incorrect de colonnes ({len(row)} au lieu de 7) : \n"
+            f"Contenu de la ligne : {row}"
+        )
+
+    chemical_name, plant_name, plant_part, low, high, deviation, reference = row
+
+    # Nettoyage et préparation des données
+    plant_name = plant_name.strip()
+    if not plant_name:
+        raise RejectedRow(f"Ligne ignorée - nom de plante vide : {row}")
+
+    # Conversion des valeurs numériques avec gestion des "not available"
+    try:
+        values = parse_decimal(low), parse_decimal(high), parse_decimal(deviation)
+    except InvalidOperation:
+        warnings.append(
+            f"Valeur numérique invalide pour {chemical_name} dans {plant_name}: low={low}, high={high}, deviation={deviation}"
+        )
+        values = (None, None, None)
+
+    return chemical_name.strip(), plant_name, plant_part.strip(), values, reference.strip() or None
+
+
+def parse_fingerprinted_row(row, warnings):
+    """
+    Ligne normalisée et ses empreintes (clé : métabolite, plante, partie ; contenu : ligne entière).
+
+    La clé ignore la casse des noms, comme leur rapprochement avec la base : un changement de casse
+    seul ne fait pas disparaître la ligne, il ne change que l'empreinte du contenu.
+    """
+    record = parse_row(row, warnings)
+    chemical_name, plant_name, plant_part, values, reference = record
+    key_hash = fingerprint(chemical_name.casefold(), plant_name.casefold(), plant_part)
+    return record, (key_hash, fingerprint(chemical_name, plant_name, plant_part, *values, reference))
+
+
 class Command(BaseCommand):
     help = "Importe les données plantes-métabolites depuis le fichier CSV"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=csv_file, help="Fichier CSV à importer")
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help="Nombre de lignes insérées par transaction")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Nombre de processus d'analyse du fichier")
+        parser.add_argument('--chunk-size', type=float, default=4,
+                            help="Taille (Mo) des morceaux de fichier analysés par processus")
+        parser.add_argument('--incremental', action='store_true',
+                            help="N'applique que les lignes ajoutées, modifiées ou supprimées depuis le dernier "
+                                 "import incrémental (empreintes ImportFingerprint)")
+        parser.add_argument('--loader', choices=LOADERS, default='orm',
+                            help="Écriture des nouvelles associations : bulk_create (orm) ou chargement natif "
+                                 "(LOAD DATA LOCAL INFILE sous MySQL, executemany ailleurs)")
+        parser.add_argument('--staging', action='store_true',
+                            help="Charge les données dans une table de même schéma, y construit les index puis "
+                                 "la substitue atomiquement à la table live (pas de verrou long pendant l'import)")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Exécute toutes les étapes dans une transaction annulée en fin d'import")
+        parser.add_argument('--profile', action='store_true',
+                            help="Affiche durée par étape, débit et pic mémoire, et les enregistre en JSON")
+        parser.add_argument('--profile-output', help="Fichier du rapport JSON (défaut : à côté du fichier de log)")
+
     def handle(self, *args, **options):
         # Création du dossier logs s'il n'existe pas
         logs_dir = "logs"
         if not os.path.exists(logs_dir):
             os.makedirs(logs_dir)
-            
+
         # Configuration des logs
-        log_filename = f"{logs_dir}/plants_import_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+        log_basename = f"{logs_dir}/plants_import_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        log_filename = f"{log_basename}.log"
         logging.basicConfig(
             filename=log_filename,
             level=logging.INFO,
@@ -30,116 +126,336 @@ class Command(BaseCommand):
         self.stdout.write(self.style.SUCCESS("Début de l'import des données plantes..."))
         logging.info("Début de l'import des données plantes")
 
+        if options['incremental'] and options['staging']:
+            raise CommandError("Les options --incremental et --staging ne peuvent pas être combinées")
+        if options['dry_run'] and options['staging']:
+            # Sous MySQL, les ordres DDL valident implicitement la transaction
+            raise CommandError("Les options --dry-run et --staging ne peuvent pas être combinées")
+
         try:
-            plants_created = 0
-            plant_objects_created = 0
+            profile = ImportProfile()
+            incremental = options['incremental']
+            staging = StagingTable(MetabolitePlant) if options['staging'] else None
+            # Table écrite par l'import : la table de chargement en mode --staging
+            self.model = staging.model if staging else MetabolitePlant
+            # En mode --staging, les apparitions sont journalisées après l'échange des tables
+            self.presence_changes = [] if staging else None
+            self.loader = BulkLoader(self.model, INSERT_FIELDS, options['loader'])
+            self.plants_created = 0
+            self.plant_objects_created = 0
+            self.rows_updated = 0
+            self.rows_unchanged = 0
+            self.rows_deleted = 0
+            self.duplicates = 0
             metabolites_not_found = 0
-            problematic_rows = 0
-
-            # Compte le nombre total de lignes pour la barre de progression
-            with open(csv_file, 'r', encoding='latin-1') as f:
-                total_rows = sum(1 for _ in f) - 1  # -1 pour l'en-tête si présent
-
-            # Lecture du fichier CSV
-            with open(csv_file, 'r', encoding='latin-1') as f:
-                reader = csv.reader(f, quotechar='"', doublequote=True, delimiter=',')
-                next(reader, None)  # Skip header if exists
-                
-                self.stdout.write(f"Nombre total de données à traiter : {total_rows}")
-                logging.info(f"Nombre total de données à traiter : {total_rows}")
-
-                # Utilisation de tqdm pour afficher une barre de progression
-                for row in tqdm(reader, total=total_rows, desc="Traitement des données plantes"):
-                    try:
-                        # Vérification du nombre de colonnes
-                        if len(row) != 7:
-                            error_msg = (
-                                f"Ligne ignorée - nombre incorrect de colonnes ({len(row)} au lieu de 7) : \n"
-                                f"Contenu de la ligne : {row}"
-                            )
-                            logging.error(error_msg)
-                            problematic_rows += 1
-                            continue
-
-                        chemical_name, plant_name, plant_part, low, high, deviation, reference = row
-
-                        # Récupère le métabolite
-                        try:
-                            metabolite = Metabolite.objects.get(name=chemical_name.strip())
-                        except Metabolite.DoesNotExist:
-                            error_msg = f"Métabolite non trouvé : {chemical_name}"
-                            logging.error(error_msg)
-                            metabolites_not_found += 1
-                            continue
-
-                        # Nettoyage et préparation des données
-                        plant_name = plant_name.strip()
-                        plant_part = plant_part.strip()
-                        
-                        # Conversion des valeurs numériques avec gestion des "not available"
-                        try:
-                            low = Decimal(low.strip()) if low.strip() and low.strip().lower() != "not available" else None
-                            high = Decimal(high.strip()) if high.strip() and high.strip().lower() != "not available" else None
-                            deviation = Decimal(deviation.strip()) if deviation.strip() and deviation.strip().lower() != "not available" else None
-                        except InvalidOperation:
-                            error_msg = f"Valeur numérique invalide pour {chemical_name} dans {plant_name}: low={low}, high={high}, deviation={deviation}"
-                            logging.warning(error_msg)
-                            low = high = deviation = None
-
-                        # Créé l'entrée Plant
-                        plant, created = Plant.objects.get_or_create(name=plant_name)
-                        if created:
-                            plant_objects_created += 1
-                            logging.info(f"Nouvelle plante créée : {plant_name}")
-
-                        # Crée l'entrée MetabolitePlant
-                        metabolite_plant, created = MetabolitePlant.objects.get_or_create(
-                            metabolite=metabolite,
-                            plant_name=plant_name,
-                            plant_part=plant_part,
-                            defaults={  # Utiliser defaults pour les champs qui peuvent varier
-                                'low': low,
-                                'high': high,
-                                'deviation': deviation,
-                                'reference': reference.strip() if reference else None
-                            }
-                        )
+            batch_size = max(options['batch_size'], 1)
 
-                        if not created and any([
-                            metabolite_plant.low != low,
-                            metabolite_plant.high != high,
-                            metabolite_plant.deviation != deviation,
-                            metabolite_plant.reference != (reference.strip() if reference else None)
-                        ]):
-                            logging.warning(
-                                f"Doublon détecté avec des valeurs différentes pour {metabolite.name} - {plant_name} ({plant_part})"
-                            )
-
-                        if created:
-                            plants_created += 1
-                            logging.debug(f"Association créée : {metabolite.name} - {plant_name} ({plant_part})")
-
-                    except Exception as row_error:
-                        error_msg = (
-                            f"Erreur sur la ligne : \n"
-                            f"Contenu : {row}\n"
-                            f"Erreur : {str(row_error)}"
-                        )
-                        logging.error(error_msg)
-                        problematic_rows += 1
+            # Correspondances nom -> id chargées une seule fois, sans tenir compte de la casse
+            # (comme la collation MySQL : "Rosmarinus" et "rosmarinus" désignent la même ligne)
+            with profile.stage('preload'):
+                self.metabolites = {
+                    name.casefold(): (metabolite_id, is_ubiquitous)
+                    for metabolite_id, name, is_ubiquitous in Metabolite.objects.values_list('id', 'name', 'is_ubiquitous')
+                }
+                self.plants = {}
+                self.plant_names = {}
+                for plant_id, name in Plant.objects.values_list('id', 'name'):
+                    self.plants[name.casefold()] = plant_id
+                    self.plant_names[plant_id] = name
+                self.touched_plants = set()
+                self.stdout.write(f"{len(self.metabolites)} métabolites et {len(self.plants)} plantes chargés")
+
+                if incremental:
+                    self._load_fingerprints()
+                    self.stdout.write(f"{len(self.old_keys)} empreintes du dernier import chargées")
+
+            # Analyse en parallèle, écriture par lots dans ce processus uniquement
+            reader = ParallelCSVReader(
+                options['file'], parse_fingerprinted_row if incremental else parse_row, encoding='latin-1',
+                workers=options['workers'], chunk_bytes=int(options['chunk_size'] * 1024 * 1024),
+                desc="Traitement des données plantes"
+            )
+
+            # Les écritures en masse ne déclenchent pas les signaux : compteurs, concentrations,
+            # journal des présences et génération sont mis à jour par la commande elle-même.
+            # Les recalculs ont lieu en sortie de deferred_plant_stats (étape 'stats')
+            with dry_run_transaction(options['dry_run']), profile.stage('stats'), deferred_plant_stats():
+                if staging:
+                    with profile.stage('swap'):
+                        staging.create()
+                    self.stdout.write(f"Table de chargement {staging.table} créée")
+                try:
+                    for records in profile.iterate('parse', reader.batches(batch_size)):
+                        with profile.stage('resolve'):
+                            records = self._delta(records) if incremental else [(record, None) for record in records]
+                            batch, fingerprints = [], []
+                            for (chemical_name, plant_name, plant_part, values, reference), row_fingerprint in records:
+                                # Récupère le métabolite
+                                metabolite = self.metabolites.get(chemical_name.casefold())
+                                if metabolite is None:
+                                    logging.error(f"Métabolite non trouvé : {chemical_name}")
+                                    metabolites_not_found += 1
+                                    continue
+                                batch.append((metabolite, plant_name, plant_part, values, reference))
+                                fingerprints.append(row_fingerprint)
+                        if batch:
+                            with profile.stage('write'):
+                                self._write_batch(batch, fingerprints if incremental else None)
+
+                    if incremental:
+                        with profile.stage('write'):
+                            self._delete_missing()
+
+                    if staging:
+                        # Index construits sur la table chargée, puis échange : la table live n'est
+                        # verrouillée que le temps du renommage
+                        with profile.stage('swap'):
+                            staging.build_indexes()
+                            staging.swap()
+                            log_presence_changes(self.presence_changes)
+                except BaseException:
+                    if staging:
+                        staging.drop()
+                    raise
+
+                schedule_plant_stats(self.touched_plants)
+                schedule_plant_concentrations(self.touched_plants)
+                if self.touched_plants:
+                    bump_generation()
 
             # Affichage du résumé
             summary = (
-                f"\nImport terminé !"
-                f"\n- Associations plantes-métabolites créées : {plants_created}"
-                f"\n- Nouvelles plantes créées : {plant_objects_created}"
+                f"\nImport terminé !{' (simulation : aucune modification enregistrée)' if options['dry_run'] else ''}"
+                f"\n- Associations plantes-métabolites créées : {self.plants_created}"
+                f"\n- Nouvelles plantes créées : {self.plant_objects_created}"
+            )
+            if incremental:
+                summary += (
+                    f"\n- Associations modifiées : {self.rows_updated}"
+                    f"\n- Associations supprimées (absentes du fichier) : {self.rows_deleted}"
+                    f"\n- Lignes inchangées depuis le dernier import : {self.rows_unchanged}"
+                    f"\n- Lignes en double dans le fichier : {self.duplicates}"
+                )
+            else:
+                summary += f"\n- Associations déjà présentes : {self.duplicates}"
+            summary += (
                 f"\n- Métabolites non trouvés : {metabolites_not_found}"
-                f"\n- Lignes problématiques : {problematic_rows}"
+                f"\n- Lignes problématiques : {reader.rejected}"
+                f"{reader.summary()}"
+                f"{self.loader.summary()}"
             )
+
+            if options['profile']:
+                report = profile.report(
+                    'transfert_plants',
+                    {name: options[name] for name in (
+                        'file', 'batch_size', 'workers', 'chunk_size', 'loader', 'incremental', 'staging', 'dry_run'
+                    )},
+                    reader, self.loader,
+                    created=self.plants_created, plants_created=self.plant_objects_created,
+                    updated=self.rows_updated, deleted=self.rows_deleted, unchanged=self.rows_unchanged,
+                    duplicates=self.duplicates, metabolites_not_found=metabolites_not_found,
+                )
+                report_path = options['profile_output'] or f"{log_basename}_profile.json"
+                ImportProfile.write(report, report_path)
+                summary += f"{profile.summary(report)}\n- Rapport : {report_path}"
+
             self.stdout.write(self.style.SUCCESS(summary))
             logging.info(summary)
 
         except Exception as e:
             error_msg = f"Erreur lors de l'import : {str(e)}"
             self.stdout.write(self.style.ERROR(error_msg))
-            logging.error(error_msg)
\ No newline at end of file
+            logging.error(error_msg)
+
+    def _load_fingerprints(self):
+        """Empreintes du dernier import, triées par clé pour les recherches vectorisées"""
+        rows = np.array(
+            list(ImportFingerprint.objects.filter(source=FINGERPRINT_SOURCE).values_list('key_hash', 'row_hash')),
+            dtype=np.int64
+        ).reshape(-1, 2)
+        order = np.argsort(rows[:, 0])
+        self.old_keys = rows[order, 0]
+        self.old_rows = rows[order, 1]
+        self.seen_keys = set()
+        # Associations (métabolite, plante, partie) écrites avec une empreinte pendant cet import
+        self.fingerprinted = set()
+
+    def _delta(self, records):
+        """
+        Lignes du lot nouvelles ou modifiées depuis le dernier import, avec leurs empreintes.
+
+        Comparaison vectorisée avec les empreintes chargées ; comme pour l'import complet,
+        seule la première occurrence d'une clé dans le fichier est prise en compte.
+        """
+        keys = np.fromiter((key_hash for _, (key_hash, _) in records), dtype=np.int64, count=len(records))
+        hashes = np.fromiter((row_hash for _, (_, row_hash) in records), dtype=np.int64, count=len(records))
+        unchanged = np.zeros(len(records), dtype=bool)
+        if len(self.old_keys):
+            positions = np.minimum(np.searchsorted(self.old_keys, keys), len(self.old_keys) - 1)
+            unchanged = (self.old_keys[positions] == keys) & (self.old_rows[positions] == hashes)
+
+        delta = []
+        for (record, row_fingerprint), is_unchanged in zip(records, unchanged.tolist()):
+            if row_fingerprint[0] in self.seen_keys:
+                self.duplicates += 1
+                continue
+            self.seen_keys.add(row_fingerprint[0])
+            if is_unchanged:
+                self.rows_unchanged += 1
+                continue
+            delta.append((record, row_fingerprint))
+        return delta
+
+    def _delete_missing(self):
+        """
+        Supprime les associations dont la ligne source a disparu du fichier.
+
+        Peu nombreuses, elles passent par QuerySet.delete() : les signaux journalisent les
+        disparitions et planifient le recalcul des compteurs et concentrations, regroupé en
+        sortie de deferred_plant_stats() avec un seul incrément de génération. Une association
+        reprise sous une autre clé (empreintes d'avant la clé insensible à la casse) est conservée,
+        seule l'ancienne empreinte est supprimée.
+        """
+        seen = np.fromiter(self.seen_keys, dtype=np.int64, count=len(self.seen_keys))
+        missing = self.old_keys[~np.isin(self.old_keys, seen)].tolist()
+        with deferred_plant_stats():
+            for start in range(0, len(missing), DELETE_CHUNK_SIZE):
+                key_hashes = missing[start:start + DELETE_CHUNK_SIZE]
+                fingerprints = ImportFingerprint.objects.filter(source=FINGERPRINT_SOURCE, key_hash__in=key_hashes)
+                with transaction.atomic():
+                    condition = reduce(or_, (
+                        Q(metabolite_id=metabolite_id, plant_id=plant_id, plant_part=plant_part)
+                        for metabolite_id, plant_id, plant_part in fingerprints.values_list(
+                            'metabolite_id', 'plant_id', 'plant_part'
+                        )
+                        if (metabolite_id, plant_id, plant_part) not in self.fingerprinted
+                    ), Q(pk__in=[]))
+                    self.rows_deleted += MetabolitePlant.objects.filter(condition).delete()[0]
+                    fingerprints.delete()
+        if missing:
+            logging.info(f"{len(missing)} lignes source disparues, {self.rows_deleted} associations supprimées")
+
+    def _create_plants(self, plant_names):
+        """
+        Crée en une requête les plantes absentes (quelle que soit la casse, première orthographe
+        rencontrée dans le fichier) et relit leurs ids :
+        bulk_create ne les retourne pas sous MySQL, et ignore les noms que la collation confond
+        avec une plante existante. Seules les plantes réellement créées sont comptées.
+        """
+        new_names = {}
+        for plant_name in plant_names:
+            if plant_name.casefold() not in self.plants:
+                new_names.setdefault(plant_name.casefold(), plant_name)
+        if not new_names:
+            return
+
+        known_ids = set(self.plant_names)
+        Plant.objects.bulk_create([Plant(name=name) for name in new_names.values()], ignore_conflicts=True)
+        created = []
+        for plant_id, name in Plant.objects.filter(name__in=new_names.values()).values_list('id', 'name'):
+            self.plants[name.casefold()] = plant_id
+            self.plant_names[plant_id] = name
+            if plant_id not in known_ids:
+                known_ids.add(plant_id)
+                created.append(name)
+
+        # Nom relu sous une autre orthographe (accents selon la collation) : résolu par la base
+        for folded, plant_name in new_names.items():
+            if folded not in self.plants:
+                plant_id, name = Plant.objects.filter(name=plant_name).values_list('id', 'name').get()
+                self.plants[folded] = plant_id
+                self.plant_names[plant_id] = name
+
+        self.plant_objects_created += len(created)
+        if created:
+            logging.info(f"Nouvelles plantes créées : {', '.join(sorted(created))}")
+
+    def _write_batch(self, batch, fingerprints=None):
+        """
+        Écrit un lot de lignes (métabolite, plante, partie, valeurs, référence) en une transaction.
+
+        Comme l'ancien get_or_create, une seule ligne est conservée par métabolite, plante et
+        partie : les lignes déjà en base (ou plus haut dans le fichier) sont ignorées. En import
+        incrémental (fingerprints : empreintes alignées sur batch), les lignes déjà en base sont
+        mises à jour et les empreintes enregistrées.
+        """
+        with transaction.atomic():
+            self._create_plants(plant_name for _, plant_name, _, _, _ in batch)
+
+            plant_ids = {self.plants[plant_name.casefold()] for _, plant_name, _, _, _ in batch}
+            metabolite_ids = {metabolite_id for (metabolite_id, _), _, _, _, _ in batch}
+            existing = {}
+            for row_id, metabolite_id, plant_id, plant_part, *values in self.model.objects.filter(
+                plant_id__in=plant_ids, metabolite_id__in=metabolite_ids
+            ).values_list('id', 'metabolite_id', 'plant_id', 'plant_part', 'low', 'high', 'deviation', 'reference'):
+                existing.setdefault((metabolite_id, plant_id, plant_part), (row_id, values))
+            present = {(plant_id, metabolite_id) for metabolite_id, plant_id, _ in existing}
+
+            to_create = []
+            to_update = []
+            appearances = {}
+            for (metabolite_id, is_ubiquitous), plant_name, plant_part, (low, high, deviation), reference in batch:
+                plant_id = self.plants[plant_name.casefold()]
+                key = (metabolite_id, plant_id, plant_part)
+                values = [low, high, deviation, reference]
+                if key in existing:
+                    row_id, current = existing[key]
+                    if fingerprints is not None and row_id is not None:
+                        # Import incrémental : la ligne source fait foi
+                        if current != values:
+                            to_update.append(self.model(
+                                id=row_id, plant_id=plant_id, low=low, high=high, deviation=deviation, reference=reference
+                            ))
+                            existing[key] = (row_id, values)
+                        continue
+                    if current != values:
+                        logging.warning(
+                            f"Doublon détecté avec des valeurs différentes pour {metabolite_id} - {plant_name} ({plant_part})"
+                        )
+                    self.duplicates += 1
+                    continue
+
+                existing[key] = (None, values)
+                to_create.append((
+                    metabolite_id, plant_id, self.plant_names[plant_id], plant_part, low, high, deviation, reference
+                ))
+                # Première partie de plante pour ce métabolite : apparition
+                if (plant_id, metabolite_id) not in present:
+                    appearances[(plant_id, metabolite_id)] = not is_ubiquitous
+
+            self.loader.insert(to_create)
+            self.model.objects.bulk_update(
+                to_update, ['low', 'high', 'deviation', 'reference'], batch_size=len(to_update) or None
+            )
+            changes = [
+                (plant_id, metabolite_id, 1, non_ubiquitous)
+                for (plant_id, metabolite_id), non_ubiquitous in appearances.items()
+            ]
+            if self.presence_changes is not None:
+                self.presence_changes.extend(changes)
+            else:
+                log_presence_changes(changes)
+
+            if fingerprints is not None:
+                ImportFingerprint.objects.bulk_create([
+                    ImportFingerprint(
+                        source=FINGERPRINT_SOURCE,
+                        key_hash=key_hash,
+                        row_hash=row_hash,
+                        metabolite_id=metabolite_id,
+                        plant_id=self.plants[plant_name.casefold()],
+                        plant_part=plant_part,
+                    )
+                    for ((metabolite_id, _), plant_name, plant_part, _, _), (key_hash, row_hash) in zip(batch, fingerprints)
+                ], batch_size=len(batch), update_conflicts=True, unique_fields=['source', 'key_hash'],
+                    update_fields=['row_hash', 'metabolite_id', 'plant_id', 'plant_part', 'updated_at'])
+                self.fingerprinted.update(
+                    (metabolite_id, self.plants[plant_name.casefold()], plant_part)
+                    for (metabolite_id, _), plant_name, plant_part, _, _ in batch
+                )
+
+        self.plants_created += len(to_create)
+        self.rows_updated += len(to_update)
+        self.touched_plants.update(plant_id for _, plant_id, *_ in to_create)
+        self.touched_plants.update(metabolite_plant.plant_id for metabolite_plant in to_update)
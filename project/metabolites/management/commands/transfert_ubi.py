@@ -1,24 +1,59 @@
 from django.core.management.base import BaseCommand
+from django.db import transaction
 import pandas as pd
 from metabolites.models import Metabolite
-from tqdm import tqdm
+from metabolites.generation import bump_generation
+from metabolites.importing import (
+    LOADERS, BulkLoader, ImportProfile, ParallelCSVReader, RejectedRow, dry_run_transaction
+)
+from metabolites.pair_changes import log_ubiquity_change
+from metabolites.stats import deferred_plant_stats, plants_with_metabolites, schedule_plant_stats
 import logging
 from datetime import datetime
 import os
 
 csv_file = "ressources/datas/chemicals_ubiquitous.csv"
 
+
+def parse_row(row, warnings):
+    """Ligne du CSV normalisée : (nom, is_ubiquitous), 'Yes' seul valant True"""
+    if len(row) > 2:
+        raise RejectedRow(f"Ligne ignorée - nombre incorrect de colonnes ({len(row)} au lieu de 2) : {row}")
+    name = row[0].strip()
+    if not name:
+        raise RejectedRow(f"Ligne ignorée - nom de métabolite manquant : {row}")
+    return name, len(row) == 2 and row[1].strip() == 'Yes'
+
+
 class Command(BaseCommand):
     help = "Importe les données d'ubiquité des métabolites depuis le fichier CSV"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=csv_file, help="Fichier CSV à importer")
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help="Nombre de métabolites écrits par requête")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Nombre de processus d'analyse du fichier")
+        parser.add_argument('--chunk-size', type=float, default=4,
+                            help="Taille (Mo) des morceaux de fichier analysés par processus")
+        parser.add_argument('--loader', choices=LOADERS, default='orm',
+                            help="Écriture des nouveaux métabolites : bulk_create (orm) ou chargement natif "
+                                 "(LOAD DATA LOCAL INFILE sous MySQL, executemany ailleurs)")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Exécute toutes les étapes dans une transaction annulée en fin d'import")
+        parser.add_argument('--profile', action='store_true',
+                            help="Affiche durée par étape, débit et pic mémoire, et les enregistre en JSON")
+        parser.add_argument('--profile-output', help="Fichier du rapport JSON (défaut : à côté du fichier de log)")
+
     def handle(self, *args, **options):
         # Création du dossier logs s'il n'existe pas
         logs_dir = "logs"
         if not os.path.exists(logs_dir):
             os.makedirs(logs_dir)
-            
+
         # Configuration des logs
-        log_filename = f"{logs_dir}/ubiquitous_import_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+        log_basename = f"{logs_dir}/ubiquitous_import_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        log_filename = f"{log_basename}.log"
         logging.basicConfig(
             filename=log_filename,
             level=logging.INFO,
@@ -29,64 +64,102 @@ class Command(BaseCommand):
         logging.info("Début de l'import des données d'ubiquité")
 
         try:
-            updates_count = 0
-            created_count = 0
-            problematic_rows = 0
+            profile = ImportProfile()
+            batch_size = max(options['batch_size'], 1)
+            loader = BulkLoader(Metabolite, ('name', 'is_ubiquitous'), options['loader'])
 
             # Charge le csv
             try:
-                df_ubi = pd.read_csv(csv_file, names=['name', 'is_ubiquitous'])
-                total_rows = len(df_ubi)
-                
-                # Nettoie les données
-                df_ubi['name'] = df_ubi['name'].str.strip()
-                df_ubi['is_ubiquitous'] = df_ubi['is_ubiquitous'].str.strip()
-                
-                # Convertit 'No'/'Yes' en False/True et gère les NaN
-                df_ubi['is_ubiquitous'] = df_ubi['is_ubiquitous'].map({
-                    'No': False, 
-                    'Yes': True
-                })
-                df_ubi['is_ubiquitous'] = df_ubi['is_ubiquitous'].fillna(False)
-                df_ubi = df_ubi.infer_objects(copy=False)  # Approche recommandée pour les versions futures
-                
-                self.stdout.write(f"Nombre total de données à traiter : {total_rows}")
-                logging.info(f"Nombre total de données à traiter : {total_rows}")
-
-                # Traitement des données avec barre de progression
-                for _, row in tqdm(df_ubi.iterrows(), total=total_rows, desc="Traitement des données d'ubiquité"):
-                    try:
-                        metab, created = Metabolite.objects.get_or_create(
-                            name=row['name']
-                        )
-                        
-                        if created:
-                            created_count += 1
-                            logging.info(f"Création - Métabolite: {metab.name} (is_ubiquitous: {row['is_ubiquitous']})")
-                        else:
-                            updates_count += 1
+                # Analyse en parallèle ; le fichier n'a pas d'en-tête
+                reader = ParallelCSVReader(
+                    options['file'], parse_row, encoding='utf-8', workers=options['workers'],
+                    chunk_bytes=int(options['chunk_size'] * 1024 * 1024), skip_header=False,
+                    desc="Traitement des données d'ubiquité"
+                )
+                with profile.stage('parse'):
+                    records = list(reader)
+                df_ubi = pd.DataFrame(records, columns=['name', 'is_ubiquitous'])
+                if not reader.rows:
+                    raise pd.errors.EmptyDataError()
+                total_rows = reader.rows
+                problematic_rows = reader.rejected
+
+                with profile.stage('resolve'):
+                    # Noms rapprochés sans tenir compte de la casse (comme la collation MySQL) ;
+                    # dernière valeur conservée pour un nom en double
+                    df_ubi['key'] = df_ubi['name'].str.casefold()
+                    df_ubi = df_ubi.drop_duplicates('key', keep='last')
+
+                    self.stdout.write(f"Nombre total de données à traiter : {total_rows}")
+                    logging.info(f"Nombre total de données à traiter : {total_rows}")
+
+                    # Différence avec les valeurs actuelles : seules les lignes modifiées sont écrites
+                    current = pd.DataFrame(
+                        list(Metabolite.objects.values_list('id', 'name', 'is_ubiquitous')),
+                        columns=['id', 'current_name', 'current']
+                    )
+                    current['key'] = current['current_name'].str.casefold()
+                    merged = df_ubi.merge(current.drop_duplicates('key'), on='key', how='left')
+                    new = merged[merged['id'].isna()]
+                    existing = merged[merged['id'].notna()]
+                    changed = existing[existing['current'].astype(bool) != existing['is_ubiquitous']]
+
+                # Les écritures en masse ne déclenchent pas les signaux : compteurs, journal
+                # des présences et génération sont mis à jour par la commande elle-même
+                # (recalculs en sortie de deferred_plant_stats)
+                with dry_run_transaction(options['dry_run']), profile.stage('stats'), deferred_plant_stats():
+                    with profile.stage('write'), transaction.atomic():
+                        rows = [(row.name, bool(row.is_ubiquitous)) for row in new.itertuples()]
+                        for start in range(0, len(rows), batch_size):
+                            loader.insert(rows[start:start + batch_size])
+                        created = self._created(new['name'].tolist(), set(current['id'].tolist()), batch_size)
+                        for is_ubiquitous, group in changed.groupby('is_ubiquitous'):
+                            ids = group['id'].astype(int).tolist()
+                            for start in range(0, len(ids), batch_size):
+                                Metabolite.objects.filter(id__in=ids[start:start + batch_size]).update(
+                                    is_ubiquitous=bool(is_ubiquitous)
+                                )
+
+                        for row in new.itertuples():
+                            if row.name in created:
+                                logging.info(f"Création - Métabolite: {row.name} (is_ubiquitous: {row.is_ubiquitous})")
+                            else:
+                                logging.warning(f"Métabolite ignoré (nom existant selon la collation) : {row.name}")
+                        for row in changed.itertuples():
                             logging.info(
-                                f"Mise à jour - Métabolite: {metab.name} "
-                                f"(ancien is_ubiquitous: {metab.is_ubiquitous}, "
-                                f"nouveau is_ubiquitous: {row['is_ubiquitous']})"
+                                f"Mise à jour - Métabolite: {row.current_name} "
+                                f"(ancien is_ubiquitous: {bool(row.current)}, "
+                                f"nouveau is_ubiquitous: {row.is_ubiquitous})"
                             )
-                        
-                        metab.is_ubiquitous = row['is_ubiquitous']
-                        metab.save()
+                            log_ubiquity_change(int(row.id), bool(row.is_ubiquitous))
 
-                    except Exception as row_error:
-                        error_msg = f"Erreur sur la ligne : {row.to_dict()} - {str(row_error)}"
-                        self.stdout.write(self.style.WARNING(error_msg))
-                        logging.error(error_msg)
-                        problematic_rows += 1
+                    # Seules les plantes contenant un métabolite modifié sont recalculées
+                    if len(changed):
+                        schedule_plant_stats(plants_with_metabolites(changed['id'].astype(int).tolist()))
+                    if created or len(changed):
+                        bump_generation()
 
                 # Affichage du résumé
                 summary = (
-                    f"\nImport terminé !"
-                    f"\n- Métabolites créés : {created_count}"
-                    f"\n- Métabolites mis à jour : {updates_count}"
+                    f"\nImport terminé !{' (simulation : aucune modification enregistrée)' if options['dry_run'] else ''}"
+                    f"\n- Métabolites créés : {len(created)}"
+                    f"\n- Métabolites mis à jour : {len(changed)}"
+                    f"\n- Métabolites inchangés : {len(existing) - len(changed)}"
                     f"\n- Lignes problématiques : {problematic_rows}"
+                    f"{reader.summary()}"
+                    f"{loader.summary()}"
                 )
+
+                if options['profile']:
+                    report = profile.report(
+                        'transfert_ubi',
+                        {name: options[name] for name in ('file', 'batch_size', 'workers', 'chunk_size', 'loader', 'dry_run')},
+                        reader, loader,
+                        created=len(created), updated=len(changed), unchanged=len(existing) - len(changed),
+                    )
+                    report_path = options['profile_output'] or f"{log_basename}_profile.json"
+                    ImportProfile.write(report, report_path)
+                    summary += f"{profile.summary(report)}\n- Rapport : {report_path}"
                 self.stdout.write(self.style.SUCCESS(summary))
                 logging.info(summary)
 
@@ -104,4 +177,20 @@ class Command(BaseCommand):
             self.stdout.write(self.style.ERROR(error_msg))
             logging.error(error_msg)
 
-        print('Tranfert effectué')
\ No newline at end of file
+        print('Tranfert effectué')
+
+    @staticmethod
+    def _created(names, known_ids, batch_size):
+        """
+        Noms réellement insérés : le chargement ignore ceux que la collation confond avec
+        un métabolite existant (accents), relus ici sous un id déjà connu
+        """
+        created = set()
+        for start in range(0, len(names), batch_size):
+            created.update(
+                name for metabolite_id, name in Metabolite.objects.filter(
+                    name__in=names[start:start + batch_size]
+                ).values_list('id', 'name')
+                if metabolite_id not in known_ids
+            )
+        return created
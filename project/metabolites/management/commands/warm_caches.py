@@ -0,0 +1,137 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connections
+from metabolites.models import AccessCount, Activity, Metabolite, Plant
+from remedes.models import Remede
+from remedes.selection import DEFAULT_SORT_PARAMS, get_plants_by_activity, saved_metabolite_ids, saved_sort_params
+from tqdm import tqdm
+import logging
+from datetime import datetime
+import os
+import time
+
+
+class Command(BaseCommand):
+    help = ("Précalcule les résultats en cache (plantes en commun, métabolites par plante, classements "
+            "des activités, sélections des remèdes) des éléments donnés ou des plus consultés")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--plants', type=int, nargs='+', default=[], help="IDs des plantes à réchauffer")
+        parser.add_argument('--activities', type=int, nargs='+', default=[], help="IDs des activités à réchauffer")
+        parser.add_argument('--remedes', type=int, nargs='+', default=[], help="IDs des remèdes à réchauffer")
+        parser.add_argument('--top', type=int, default=20,
+                            help="Sans liste explicite, nombre d'éléments les plus consultés réchauffés par type")
+        parser.add_argument('--pages', type=int, default=1,
+                            help="Nombre de pages de plantes en commun réchauffées par plante")
+        parser.add_argument('--db-concurrency', type=int, default=4,
+                            help="Nombre maximal de calculs (connexions à la base) simultanés")
+
+    def handle(self, *args, **options):
+        # Création du dossier logs s'il n'existe pas
+        logs_dir = "logs"
+        if not os.path.exists(logs_dir):
+            os.makedirs(logs_dir)
+
+        # Configuration des logs
+        log_filename = f"{logs_dir}/warm_caches_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+        logging.basicConfig(
+            filename=log_filename,
+            level=logging.INFO,
+            format='%(asctime)s - %(levelname)s - %(message)s'
+        )
+
+        self.stdout.write(self.style.SUCCESS("Début du réchauffement des caches..."))
+        logging.info("Début du réchauffement des caches")
+
+        try:
+            plant_ids, activity_ids, remede_ids = options['plants'], options['activities'], options['remedes']
+            if not (plant_ids or activity_ids or remede_ids):
+                # Éléments les plus consultés (AccessCount)
+                plant_ids = AccessCount.top(AccessCount.KIND_PLANT, options['top'])
+                activity_ids = AccessCount.top(AccessCount.KIND_ACTIVITY, options['top'])
+                remede_ids = AccessCount.top(AccessCount.KIND_REMEDE, options['top'])
+
+            tasks = self._tasks(plant_ids, activity_ids, remede_ids, options['pages'])
+            if not tasks:
+                self.stdout.write(self.style.WARNING("Aucun élément à réchauffer (pas encore de consultations enregistrées)"))
+                return
+
+            # Calculs en parallèle, limités à db_concurrency connexions simultanées
+            timings = []
+            errors = 0
+            start_time = time.time()
+            with ThreadPoolExecutor(max_workers=max(options['db_concurrency'], 1)) as executor:
+                futures = {executor.submit(self._run, compute): label for label, compute in tasks}
+                for future in tqdm(as_completed(futures), total=len(futures), desc="Réchauffement"):
+                    label = futures[future]
+                    try:
+                        elapsed = future.result()
+                        timings.append((label, elapsed))
+                        logging.info(f"{label} : {elapsed:.3f}s")
+                    except Exception as e:
+                        errors += 1
+                        self.stdout.write(self.style.ERROR(f"{label} : {str(e)}"))
+                        logging.error(f"{label} : {str(e)}")
+
+            # Durée par élément, les plus longs d'abord
+            for label, elapsed in sorted(timings, key=lambda timing: -timing[1]):
+                self.stdout.write(f"{elapsed:8.3f}s  {label}")
+
+            # Affichage du résumé
+            summary = (
+                f"\nRéchauffement terminé !"
+                f"\n- Plantes : {len(plant_ids)}, activités : {len(activity_ids)}, remèdes : {len(remede_ids)}"
+                f"\n- Résultats calculés : {len(timings)} (erreurs : {errors})"
+                f"\n- Durée totale : {time.time() - start_time:.2f}s"
+            )
+            if hasattr(cache, 'stats'):
+                summary += f"\n- Cache local : {cache.stats()['local_entries']} entrées, {cache.stats()['local_bytes']} octets"
+            self.stdout.write(self.style.SUCCESS(summary))
+            logging.info(summary)
+
+        except Exception as e:
+            error_msg = f"Erreur lors du réchauffement : {str(e)}"
+            self.stdout.write(self.style.ERROR(error_msg))
+            logging.error(error_msg)
+
+    @staticmethod
+    def _run(compute):
+        """Exécute un calcul dans un thread du pool et retourne sa durée"""
+        start_time = time.time()
+        try:
+            compute()
+        finally:
+            # Chaque thread a sa propre connexion à la base
+            connections.close_all()
+        return time.time() - start_time
+
+    def _tasks(self, plant_ids, activity_ids, remede_ids, pages):
+        """(libellé, calcul) de chaque résultat à mettre en cache, avec les paramètres par défaut des pages"""
+        tasks = []
+        for plant in Plant.objects.filter(id__in=plant_ids):
+            tasks.append((f"Plante {plant.id} ({plant.name}) - métabolites", plant.get_metabolites_with_parts))
+            for page in range(1, pages + 1):
+                tasks.append((
+                    f"Plante {plant.id} ({plant.name}) - plantes en commun, page {page}",
+                    lambda plant=plant, page=page: plant.get_common_plants_page(page=page, per_page=20)
+                ))
+
+        for activity in Activity.objects.filter(id__in=activity_ids):
+            tasks.append((
+                f"Activité {activity.id} ({activity.name}) - plantes par concentration",
+                lambda activity=activity: activity.get_plants_by_total_concentration(
+                    page=1, per_page=20, sort_params=[('total_concentration', 'desc')], search='', search_type='contains'
+                )
+            ))
+
+        for remede in Remede.objects.filter(id__in=remede_ids).select_related('target_plant').prefetch_related('activities'):
+            sort_params, exclude_ubiquitous = saved_sort_params(remede)
+            selected_metabolites = list(Metabolite.objects.filter(id__in=saved_metabolite_ids(remede)))
+            tasks.append((
+                f"Remède {remede.id} ({remede.name}) - sélection des plantes",
+                lambda remede=remede, sort_params=sort_params or list(DEFAULT_SORT_PARAMS),
+                       exclude_ubiquitous=exclude_ubiquitous, selected_metabolites=selected_metabolites:
+                    get_plants_by_activity(remede, sort_params, exclude_ubiquitous, selected_metabolites)
+            ))
+        return tasks
@@ -1,9 +1,15 @@
 from django.db import models
 from django.db import connection
 from django.utils.functional import cached_property
-from django.core.cache import cache
+from django.utils import timezone
+from django.conf import settings
 import logging
+import random
 from .utils import log_execution_time
+from .incidence import get_incidence_engine
+from .generation import cached_for_generation
+from .pairs import PAIR_SORT_FIELDS
+from .ranking import CommonPlantCandidates
 import math
 from accounts.models import CustomUser
 
@@ -21,20 +27,20 @@ class Metabolite(models.Model):
     @cached_property
     def get_unique_plants_count(self):
         """Version optimisée et mise en cache"""
-        return self.plants.values('plant_name').distinct().count()
+        return self.plants.values('plant_id').distinct().count()
     
     def get_plants_with_parts(self, sort_field=None, sort_direction=None, search_text=None, search_type=None):
         """Version optimisée avec SQL brut et tri dynamique"""
         # Définir l'ordre par défaut
-        order_by = "mp.plant_name, mp.plant_part"
+        order_by = "p.name, mp.plant_part"
         
         # Construire la clause ORDER BY en fonction des paramètres de tri
         if sort_field and sort_direction:
             direction = "ASC" if sort_direction == "asc" else "DESC"
             if sort_field == "plant_name":
-                order_by = f"mp.plant_name {direction}, mp.plant_part"
+                order_by = f"p.name {direction}, mp.plant_part"
             elif sort_field == "plant_part":
-                order_by = f"mp.plant_part {direction}, mp.plant_name"
+                order_by = f"mp.plant_part {direction}, p.name"
             elif sort_field in ["low", "high", "deviation"]:
                 # Pour les champs numériques, gérer les valeurs NULL
                 order_by = f"""
@@ -43,10 +49,10 @@ class Metabolite(models.Model):
                         ELSE 0 
                     END,
                     COALESCE(mp.{sort_field}, 0) {direction},
-                    mp.plant_name
+                    p.name
                 """
             elif sort_field == "reference":
-                order_by = f"mp.reference {direction}, mp.plant_name"
+                order_by = f"mp.reference {direction}, p.name"
 
         # Construire la clause WHERE pour la recherche
         where_clause = "WHERE mp.metabolite_id = %s"
@@ -54,16 +60,16 @@ class Metabolite(models.Model):
         
         if search_text:
             if search_type == 'contains':
-                where_clause += " AND mp.plant_name LIKE %s"
+                where_clause += " AND p.name LIKE %s"
                 params.append(f"%{search_text}%")
             elif search_type == 'starts_with':
-                where_clause += " AND mp.plant_name LIKE %s"
+                where_clause += " AND p.name LIKE %s"
                 params.append(f"{search_text}%")
 
         with connection.cursor() as cursor:
             cursor.execute(f"""
                 SELECT 
-                    mp.plant_name,
+                    p.name as plant_name,
                     mp.plant_part,
                     mp.low,
                     mp.high,
@@ -72,7 +78,7 @@ class Metabolite(models.Model):
                     p.id as plant_id,
                     p.french_name
                 FROM metabolites_metaboliteplant mp
-                JOIN metabolites_plant p ON p.name = mp.plant_name
+                JOIN metabolites_plant p ON p.id = mp.plant_id
                 {where_clause}
                 ORDER BY {order_by}
             """, params)
@@ -101,14 +107,15 @@ class Metabolite(models.Model):
         with connection.cursor() as cursor:
             cursor.execute("""
                 SELECT 
-                    mp.plant_name,
+                    p.name,
                     GROUP_CONCAT(DISTINCT a.name ORDER BY a.name) as activities
                 FROM metabolites_metaboliteplant mp
+                JOIN metabolites_plant p ON p.id = mp.plant_id
                 JOIN metabolites_metaboliteactivity ma ON ma.metabolite_id = %s
                 JOIN metabolites_activity a ON a.id = ma.activity_id
                 WHERE mp.metabolite_id = %s
-                GROUP BY mp.plant_name
-                ORDER BY mp.plant_name
+                GROUP BY p.id, p.name
+                ORDER BY p.name
             """, [self.id, self.id])
             
             return [
@@ -122,10 +129,11 @@ class Metabolite(models.Model):
             cursor.execute("""
                 SELECT 
                     a.name as activity_name,
-                    GROUP_CONCAT(DISTINCT mp.plant_name ORDER BY mp.plant_name) as plants
+                    GROUP_CONCAT(DISTINCT p.name ORDER BY p.name) as plants
                 FROM metabolites_activity a
                 JOIN metabolites_metaboliteactivity ma ON ma.activity_id = a.id
                 JOIN metabolites_metaboliteplant mp ON mp.metabolite_id = ma.metabolite_id
+                JOIN metabolites_plant p ON p.id = mp.plant_id
                 WHERE ma.metabolite_id = %s
                 GROUP BY a.name
                 ORDER BY a.name
@@ -144,7 +152,7 @@ class Metabolite(models.Model):
                 SELECT 
                     m.name,
                     m.is_ubiquitous,
-                    COUNT(DISTINCT mp.plant_name) as plant_count,
+                    COUNT(DISTINCT mp.plant_id) as plant_count,
                     COUNT(DISTINCT ma.activity_id) as activity_count
                 FROM metabolites_metabolite m
                 LEFT JOIN metabolites_metaboliteplant mp ON mp.metabolite_id = m.id
@@ -169,18 +177,53 @@ class Activity(models.Model):
         return self.name
     
     def get_plants_by_total_concentration(self, page=1, per_page=50, sort_params=None, search='', search_type='contains'):
+        """Classement des plantes par concentration totale, en cache pour la génération courante du jeu de données"""
+        return cached_for_generation(
+            'activity_plants',
+            lambda: self._get_plants_by_total_concentration_sql(page, per_page, sort_params, search, search_type),
+            activity_id=self.id, page=page, per_page=per_page, sort_params=[list(param) for param in sort_params or []],
+            search=search or '', search_type=search_type,
+        )
+
+    def _count_plants_sql(self, cursor, search_clause='', search_params=()):
+        """
+        Nombre de plantes ayant au moins un métabolite de l'activité (compteurs matérialisés par
+        activité) ; comptage direct en repli pour les plantes dont les compteurs ne sont pas calculés
+        (sans PlantStats : PlantActivityStats n'a de lignes que pour les comptes non nuls)
+        """
+        cursor.execute(f"""
+            SELECT COUNT(*)
+            FROM
+                metabolites_plant p
+                LEFT JOIN metabolites_plantstats ps ON ps.plant_id = p.id
+                LEFT JOIN metabolites_plantactivitystats pas ON pas.plant_id = p.id AND pas.activity_id = %s
+            WHERE (
+                pas.distinct_metabolites > 0
+                OR (ps.plant_id IS NULL AND EXISTS (
+                    SELECT 1
+                    FROM metabolites_metaboliteplant mp
+                    JOIN metabolites_metaboliteactivity ma ON ma.metabolite_id = mp.metabolite_id
+                    WHERE mp.plant_id = p.id AND ma.activity_id = %s
+                ))
+            ){search_clause}
+        """, [self.id, self.id, *search_params])
+        return cursor.fetchone()[0]
+
+    def _get_plants_by_total_concentration_sql(self, page=1, per_page=50, sort_params=None, search='', search_type='contains'):
         with connection.cursor() as cursor:
             # Construction de la clause WHERE pour la recherche
-            where_clause = "WHERE ma.activity_id = %s"
-            params = [self.id]
+            search_clause = ""
+            search_params = []
             
             if search:
                 if search_type == 'contains':
-                    where_clause += " AND p.name LIKE %s"
-                    params.append(f"%{search}%")
+                    search_clause = " AND p.name LIKE %s"
+                    search_params.append(f"%{search}%")
                 elif search_type == 'starts_with':
-                    where_clause += " AND p.name LIKE %s"
-                    params.append(f"{search}%")
+                    search_clause = " AND p.name LIKE %s"
+                    search_params.append(f"{search}%")
+            where_clause = "WHERE ma.activity_id = %s" + search_clause
+            params = [self.id] + search_params
 
             # Construction de la clause ORDER BY
             order_by = ""
@@ -198,18 +241,7 @@ class Activity(models.Model):
             else:
                 order_by = "ORDER BY name ASC"
 
-            # Requête pour obtenir le compte total
-            count_query = f"""
-                SELECT COUNT(DISTINCT p.id)
-                FROM 
-                    metabolites_plant p
-                    JOIN metabolites_metaboliteplant mp ON mp.plant_name = p.name
-                    JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
-                    JOIN metabolites_metaboliteactivity ma ON ma.metabolite_id = m.id
-                {where_clause}
-            """
-            cursor.execute(count_query, params[:2] if search else params[:1])
-            total_count = cursor.fetchone()[0]
+            total_count = self._count_plants_sql(cursor, search_clause, search_params)
 
             # Requête principale
             query = f"""
@@ -242,7 +274,7 @@ class Activity(models.Model):
                         ) as metabolites_details
                     FROM 
                         metabolites_plant p
-                        JOIN metabolites_metaboliteplant mp ON mp.plant_name = p.name
+                        JOIN metabolites_metaboliteplant mp ON mp.plant_id = p.id
                         JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
                         JOIN metabolites_metaboliteactivity ma ON ma.metabolite_id = m.id
                     {where_clause}
@@ -315,50 +347,255 @@ class Activity(models.Model):
             }
 
 class Plant(models.Model):
-    name = models.CharField(max_length=200, db_index=True)
+    name = models.CharField(max_length=200, unique=True, db_index=True)
     french_name = models.CharField(max_length=255, null=True, blank=True)
 
     def __str__(self):
         return self.name
     
+    def _stats(self):
+        """Compteurs matérialisés (PlantStats), None s'ils ne sont pas encore calculés"""
+        try:
+            return self.stats
+        except PlantStats.DoesNotExist:
+            return None
+
     @cached_property
     def all_metabolites_count(self):
-        """Optimisation avec SQL brut"""
+        """Lecture du compteur matérialisé, SQL brut en repli"""
+        stats = self._stats()
+        if stats is not None:
+            return stats.total_rows
         with connection.cursor() as cursor:
             cursor.execute("""
                 SELECT COUNT(*)
                 FROM metabolites_metaboliteplant
-                WHERE plant_name = %s
-            """, [self.name])
+                WHERE plant_id = %s
+            """, [self.id])
             return cursor.fetchone()[0]
     
     @cached_property
     def get_unique_metabolites_count(self):
-        """Optimisation avec une requête SQL directe"""
+        """Lecture du compteur matérialisé, requête SQL directe en repli"""
+        stats = self._stats()
+        if stats is not None:
+            return stats.distinct_metabolites
         with connection.cursor() as cursor:
             cursor.execute("""
                 SELECT COUNT(DISTINCT metabolite_id) 
                 FROM metabolites_metaboliteplant 
-                WHERE plant_name = %s
-            """, [self.name])
+                WHERE plant_id = %s
+            """, [self.id])
             return cursor.fetchone()[0]
     
     @log_execution_time
     def get_metabolites_with_parts(self):
         logger.info(f"Récupération des métabolites pour {self.name}")
-        cache_key = f'plant_metabolites_{self.id}'
-        result = cache.get(cache_key)
-        if result is None:
-            logger.debug("Cache miss - Exécution de la requête SQL")
-            result = self._get_metabolites_with_parts_sql()
-            cache.set(cache_key, result, 3600)
-        else:
-            logger.debug("Cache hit - Utilisation des données en cache")
-        return result
+        return cached_for_generation('plant_metabolites', self._get_metabolites_with_parts_sql, plant_id=self.id)
 
     def get_common_plants(self, activity_filter=None, page=1, per_page=50, sort_params=None, exclude_ubiquitous=False, search_text='', search_type='contains', metabolite_filters=None):
-        """Version optimisée avec matérialisation des CTE et index"""
+        """Page de plantes en commun, en cache pour la génération courante du jeu de données"""
         logger.info(f"Début get_common_plants pour la plante {self.name}")
+        return cached_for_generation(
+            'common_plants',
+            lambda: self._get_common_plants(activity_filter, page, per_page, sort_params, exclude_ubiquitous, search_text, search_type, metabolite_filters),
+            **self.common_plants_cache_params(activity_filter, exclude_ubiquitous, search_text, search_type, metabolite_filters, sort_params),
+            page=page, per_page=per_page,
+        )
+
+    def common_plants_cache_params(self, activity_filter=None, exclude_ubiquitous=False, search_text='', search_type='contains', metabolite_filters=None, sort_params=None):
+        """Paramètres normalisés d'une requête de plantes en commun (clés de cache)"""
+        return dict(
+            plant_id=self.id,
+            activity_filter=activity_filter or None,
+            exclude_ubiquitous=bool(exclude_ubiquitous),
+            search_text=search_text or '',
+            search_type=search_type if search_text else None,
+            metabolite_filters=sorted(int(metabolite_id) for metabolite_id in metabolite_filters or [] if metabolite_id),
+            sort_params=[list(param) for param in sort_params or []],
+        )
+
+    def _get_common_plants(self, activity_filter=None, page=1, per_page=50, sort_params=None, exclude_ubiquitous=False, search_text='', search_type='contains', metabolite_filters=None):
+        """Version en mémoire (matrice d'incidence creuse) avec repli sur la version SQL"""
+        query_args = dict(
+            activity_filter=activity_filter,
+            page=page,
+            per_page=per_page,
+            sort_params=sort_params,
+            exclude_ubiquitous=exclude_ubiquitous,
+            search_text=search_text,
+            search_type=search_type,
+            metabolite_filters=metabolite_filters,
+        )
+
+        results = None
+        if getattr(settings, 'USE_INCIDENCE_ENGINE', True):
+            try:
+                engine = get_incidence_engine()
+                if engine is not None:
+                    results, total_count, reference_count = engine.common_plants(self.id, **query_args)
+                    logger.info(f"Nombre de résultats obtenus (moteur d'incidence): {len(results)}")
+            except Exception as e:
+                logger.error(f"Moteur d'incidence indisponible, repli sur SQL: {e}")
+                results = None
+
+        if results is None:
+            results, total_count, reference_count = self._get_common_plants_sql(**query_args)
+
+        self._add_common_scores(results, reference_count)
+
+        return {
+            'results': results,
+            'total_count': total_count,
+            'page': page,
+            'per_page': per_page,
+            'total_pages': (total_count + per_page - 1) // per_page
+        }
+
+    def get_common_plant_candidates(self, activity_filter=None, exclude_ubiquitous=False, search_text='', search_type='contains', metabolite_filters=None):
+        """
+        Toutes les plantes en commun sous forme de colonnes (CommonPlantCandidates) : les tris et la
+        pagination sont appliqués sur les colonnes, seules les lignes affichées sont construites.
+        """
+        query_args = dict(
+            activity_filter=activity_filter,
+            exclude_ubiquitous=exclude_ubiquitous,
+            search_text=search_text,
+            search_type=search_type,
+            metabolite_filters=metabolite_filters,
+        )
+
+        if getattr(settings, 'USE_INCIDENCE_ENGINE', True):
+            try:
+                engine = get_incidence_engine()
+                if engine is not None:
+                    return engine.candidates(self.id, **query_args)
+            except Exception as e:
+                logger.error(f"Moteur d'incidence indisponible, repli sur SQL: {e}")
+
+        results, total_count, reference_count = self._get_common_plants_sql(page=1, per_page=max(Plant.objects.count(), 1), **query_args)
+        return CommonPlantCandidates.from_results(results, reference_count, activity_filter=activity_filter, reference_id=self.id)
+
+    def get_common_plants_page(self, page=1, per_page=20, activity_filter=None, exclude_ubiquitous=False, search_text='', search_type='contains', metabolite_filters=None, sort_params=None):
+        """
+        Page de plantes en commun affichée par plant_common_metabolites, en cache pour la génération
+        courante du jeu de données : voisins précalculés sans filtre, sinon tri multi-clés des candidats.
+        """
+        def compute():
+            if getattr(settings, 'USE_PLANT_PAIR_STATS', True) and not activity_filter and not metabolite_filters and not search_text:
+                precomputed_page = self.get_precomputed_common_plants(
+                    page=page, per_page=per_page, sort_params=sort_params, exclude_ubiquitous=exclude_ubiquitous
+                )
+                if precomputed_page is not None:
+                    return precomputed_page
+
+            # Toutes les plantes en commun sous forme de colonnes : seules les clés de tri sont calculées pour chacune
+            candidates = self.get_common_plant_candidates(
+                activity_filter=activity_filter,
+                exclude_ubiquitous=exclude_ubiquitous,
+                search_text=search_text,
+                search_type=search_type,
+                metabolite_filters=metabolite_filters
+            )
+            if sort_params:
+                logger.info(f"Application des tris: {sort_params}")
+            positions = candidates.page(sort_params, page, per_page)
+            logger.info(f"Page {page} : {len(positions)} plantes affichées sur {candidates.total_count}")
+            return Plant.common_plants_page(candidates, positions, page, per_page)
+
+        return cached_for_generation(
+            'common_plants_page',
+            compute,
+            **self.common_plants_cache_params(activity_filter, exclude_ubiquitous, search_text, search_type, metabolite_filters, sort_params),
+            page=page, per_page=per_page,
+        )
+
+    @classmethod
+    def common_plants_page(cls, candidates, positions, page, per_page):
+        """Page (même structure que get_common_plants) construite pour les seules positions affichées"""
+        results = candidates.rows(positions)
+        cls._add_common_scores(results, candidates.reference_count)
+        total_count = candidates.total_count
+        return {
+            'results': results,
+            'total_count': total_count,
+            'page': page,
+            'per_page': per_page,
+            'total_pages': (total_count + per_page - 1) // per_page
+        }
+
+    def get_precomputed_common_plants(self, page=1, per_page=20, sort_params=None, exclude_ubiquitous=False):
+        """
+        Page de plantes en commun lue dans les voisins précalculés (PlantPairStats).
+
+        Les voisins enregistrés sont classés comme les candidats calculés à la demande
+        (CommonPlantCandidates : valeurs arrondies, puis métabolites en commun, puis nom).
+        Retourne None si la page n'est pas servie exactement par le précalcul : tri non couvert,
+        page au-delà du top-K des listes enregistrées ou journal de modifications pas encore appliqué.
+        """
+        if sort_params:
+            if len(sort_params) > 1:
+                return None
+            field, direction = sort_params[0]
+            if field not in PAIR_SORT_FIELDS or direction.lower() != 'desc':
+                return None
+
+        stats = self._stats()
+        if stats is None or stats.neighbours_computed_at is None or not stats.neighbours_top_k:
+            return None
+        total_count = stats.neighbours_count_non_ubiquitous if exclude_ubiquitous else stats.neighbours_count
+
+        offset = (page - 1) * per_page
+        if min(offset + per_page, total_count) > stats.neighbours_top_k:
+            return None
+
+        # Modifications pas encore répercutées par apply_pair_changes : voisins obsolètes
+        if MetabolitePlantChange.objects.exists():
+            logger.info("Voisins précalculés obsolètes, calcul à la demande")
+            return None
+
+        pairs = (
+            PlantPairStats.objects
+            .filter(plant_id=self.id, exclude_ubiquitous=exclude_ubiquitous)
+            .values_list('neighbour_id', 'neighbour__name', 'neighbour__french_name', 'common_count', 'neighbour_total')
+        )
+        reference_count = stats.distinct_non_ubiquitous if exclude_ubiquitous else stats.distinct_metabolites
+        candidates = CommonPlantCandidates.from_results(
+            [
+                {'id': neighbour_id, 'name': name, 'french_name': french_name,
+                 'common_metabolites_count': common_count, 'metabolites_total': neighbour_total}
+                for neighbour_id, name, french_name, common_count, neighbour_total in pairs
+            ],
+            reference_count, reference_id=self.id, total_count=total_count,
+        )
+        positions = candidates.page(sort_params, page, per_page)
+        logger.info(f"Nombre de résultats obtenus (voisins précalculés): {len(positions)}")
+        return Plant.common_plants_page(candidates, positions, page, per_page)
+
+    @staticmethod
+    def _add_common_scores(results, reference_count):
+        """Calculer les pourcentages et scores"""
+        for result in results:
+            common_count = result['common_metabolites_count']
+            plant_total = result['metabolites_total']
+            
+            # Déterminer quel calcul utiliser
+            percentage = (common_count * 100.0) / plant_total if plant_total > 0 else 0
+            
+            # Conserver la distinction visuelle entre les cas
+            if reference_count >= plant_total:
+                result['percentage_type'] = 'blue'
+            else:
+                result['percentage_type'] = 'green'
+            
+            result['common_metabolites_percentage'] = round(percentage, 1)
+            
+            # Calcul des scores
+            result['meta_percentage_score'] = round(common_count * (percentage / 100), 2)
+            result['meta_root_score'] = round(math.sqrt(common_count) * (percentage / 100), 2) if common_count > 0 else 0
+
+    def _get_common_plants_sql(self, activity_filter=None, page=1, per_page=50, sort_params=None, exclude_ubiquitous=False, search_text='', search_type='contains', metabolite_filters=None):
+        """Version SQL avec matérialisation des CTE et index"""
         offset = (page - 1) * per_page
         
         # Construction de l'ordre SQL en fonction des paramètres de tri
@@ -392,21 +629,39 @@ class Plant(models.Model):
         
         order_by_clause = f"ORDER BY {', '.join(order_by)}"
         logger.info(f"Clause ORDER BY finale: {order_by_clause}")
+
+        # Nombre total de métabolites de chaque plante, lu dans les compteurs matérialisés,
+        # comptage direct en repli pour une plante dont les compteurs ne sont pas calculés
+        total_column = 'distinct_non_ubiquitous' if exclude_ubiquitous else 'distinct_metabolites'
+        live_total = f"""(
+            SELECT COUNT(DISTINCT lmp.metabolite_id)
+            FROM metabolites_metaboliteplant lmp
+            JOIN metabolites_metabolite lm ON lm.id = lmp.metabolite_id
+            WHERE lmp.plant_id = p.id{" AND lm.is_ubiquitous = FALSE" if exclude_ubiquitous else ""}
+        )"""
+        metabolites_total = f"COALESCE(ps.{total_column}, {live_total})"
         
         with connection.cursor() as cursor:
-            # Récupérer d'abord le nombre de métabolites de la plante de référence
-            query_ref = """
-                SELECT COUNT(DISTINCT mp.metabolite_id)
-                FROM metabolites_metaboliteplant mp
-                JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
-                WHERE mp.plant_name = %s
-            """
-            
-            if exclude_ubiquitous:
-                query_ref += " AND m.is_ubiquitous = FALSE"
-                
-            cursor.execute(query_ref, [self.name])
-            reference_count = cursor.fetchone()[0]
+            # Récupérer d'abord le nombre de métabolites de la plante de référence (compteurs matérialisés)
+            cursor.execute(f"""
+                SELECT {total_column}
+                FROM metabolites_plantstats
+                WHERE plant_id = %s
+            """, [self.id])
+            row = cursor.fetchone()
+            if row is not None:
+                reference_count = row[0]
+            else:
+                query_ref = """
+                    SELECT COUNT(DISTINCT mp.metabolite_id)
+                    FROM metabolites_metaboliteplant mp
+                    JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
+                    WHERE mp.plant_id = %s
+                """
+                if exclude_ubiquitous:
+                    query_ref += " AND m.is_ubiquitous = FALSE"
+                cursor.execute(query_ref, [self.id])
+                reference_count = cursor.fetchone()[0]
             logger.info(f"Nombre de métabolites de la plante de référence ({self.name}): {reference_count}")
 
             # Nettoyer les tables temporaires qui pourraient exister
@@ -426,13 +681,13 @@ class Plant(models.Model):
                     SELECT DISTINCT mp.metabolite_id
                     FROM metabolites_metaboliteplant mp
                     JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
-                    WHERE mp.plant_name = %s
+                    WHERE mp.plant_id = %s
                 """
                 
                 if exclude_ubiquitous:
                     query_temp_ref += " AND m.is_ubiquitous = FALSE"
                 
-                cursor.execute(query_temp_ref, [self.name])
+                cursor.execute(query_temp_ref, [self.id])
                 # Ajouter un index sur la table temporaire
                 cursor.execute("CREATE INDEX idx_temp_reference_metabolites ON temp_reference_metabolites(metabolite_id)")
 
@@ -458,30 +713,14 @@ class Plant(models.Model):
                         if metabolite_id:
                             cursor.execute(f"""
                                 CREATE TEMPORARY TABLE temp_filtered_plants_{i} AS
-                                SELECT DISTINCT plant_name
+                                SELECT DISTINCT plant_id
                                 FROM metabolites_metaboliteplant
                                 WHERE metabolite_id = %s
                             """, [metabolite_id])
-                            cursor.execute(f"CREATE INDEX idx_temp_filtered_plants_{i} ON temp_filtered_plants_{i}(plant_name)")
+                            cursor.execute(f"CREATE INDEX idx_temp_filtered_plants_{i} ON temp_filtered_plants_{i}(plant_id)")
 
                 # Requête principale pour les plantes avec des métabolites en commun et l'activité spécifiée
                 query = f"""
-                    WITH plant_counts AS (
-                        SELECT 
-                            p.name,
-                            COUNT(DISTINCT mp.metabolite_id) as metabolites_total
-                        FROM metabolites_plant p
-                        JOIN metabolites_metaboliteplant mp ON mp.plant_name = p.name
-                        JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
-                        WHERE 1=1
-                """
-                
-                if exclude_ubiquitous:
-                    query += " AND m.is_ubiquitous = FALSE"
-                
-                query += f"""
-                        GROUP BY p.name
-                    )
                     SELECT 
                         p.id,
                         p.name,
@@ -493,24 +732,24 @@ class Plant(models.Model):
                             WHEN tam.metabolite_id IS NOT NULL 
                             THEN COALESCE(mp.high, mp.low, 0) 
                         END), 0) as total_concentration,
-                        pc.metabolites_total,
+                        {metabolites_total} as metabolites_total,
                         COUNT(*) OVER() as pagination_total,
                         {reference_count} as reference_count
                     FROM metabolites_plant p
-                    JOIN metabolites_metaboliteplant mp ON mp.plant_name = p.name
+                    JOIN metabolites_metaboliteplant mp ON mp.plant_id = p.id
                     LEFT JOIN temp_reference_metabolites rm ON rm.metabolite_id = mp.metabolite_id
                     LEFT JOIN temp_activity_metabolites tam ON tam.metabolite_id = mp.metabolite_id
-                    JOIN plant_counts pc ON pc.name = p.name
-                    WHERE p.name != %s AND pc.metabolites_total > 1
+                    LEFT JOIN metabolites_plantstats ps ON ps.plant_id = p.id
+                    WHERE p.id != %s AND {metabolites_total} > 1
                 """
                 
-                params = [self.name]
+                params = [self.id]
 
                 # Ajouter les filtres de métabolites si présents
                 if metabolite_filters and any(metabolite_filters):
                     for i, metabolite_id in enumerate(metabolite_filters):
                         if metabolite_id:
-                            query += f" AND p.name IN (SELECT plant_name FROM temp_filtered_plants_{i})"
+                            query += f" AND p.id IN (SELECT plant_id FROM temp_filtered_plants_{i})"
 
                 # Ajouter la condition de recherche
                 if search_text:
@@ -521,7 +760,7 @@ class Plant(models.Model):
                         query += " AND LOWER(p.name) LIKE LOWER(%s)"
                         params.append(f"{search_text}%")
                 
-                query += " GROUP BY p.id, p.name, p.french_name, pc.metabolites_total"
+                query += f" GROUP BY p.id, p.name, p.french_name, ps.{total_column}"
                 query += " HAVING COUNT(DISTINCT CASE WHEN tam.metabolite_id IS NOT NULL THEN mp.metabolite_id END) > 0"  # Filtrer par activité
                 query += f" {order_by_clause}"
                 query += " LIMIT %s OFFSET %s"
@@ -546,13 +785,13 @@ class Plant(models.Model):
                     SELECT DISTINCT mp.metabolite_id
                     FROM metabolites_metaboliteplant mp
                     JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
-                    WHERE mp.plant_name = %s
+                    WHERE mp.plant_id = %s
                 """
                 
                 if exclude_ubiquitous:
                     query_temp_ref += " AND m.is_ubiquitous = FALSE"
                 
-                cursor.execute(query_temp_ref, [self.name])
+                cursor.execute(query_temp_ref, [self.id])
                 cursor.execute("CREATE INDEX idx_temp_reference_metabolites ON temp_reference_metabolites(metabolite_id)")
 
                 # Ajouter les filtres de métabolites si présents
@@ -561,48 +800,35 @@ class Plant(models.Model):
                         if metabolite_id:
                             cursor.execute(f"""
                                 CREATE TEMPORARY TABLE temp_filtered_plants_{i} AS
-                                SELECT DISTINCT plant_name
+                                SELECT DISTINCT plant_id
                                 FROM metabolites_metaboliteplant
                                 WHERE metabolite_id = %s
                             """, [metabolite_id])
-                            cursor.execute(f"CREATE INDEX idx_temp_filtered_plants_{i} ON temp_filtered_plants_{i}(plant_name)")
+                            cursor.execute(f"CREATE INDEX idx_temp_filtered_plants_{i} ON temp_filtered_plants_{i}(plant_id)")
 
                 query = f"""
-                    WITH plant_counts AS (
-                        SELECT plant_name, COUNT(DISTINCT mp.metabolite_id) as metabolites_total
-                        FROM metabolites_metaboliteplant mp
-                        JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
-                        WHERE 1=1
-                """
-                
-                if exclude_ubiquitous:
-                    query += " AND m.is_ubiquitous = FALSE"
-                
-                query += f"""
-                        GROUP BY plant_name
-                    )
                     SELECT 
                         p.id,
                         p.name,
                         p.french_name,
                         COUNT(DISTINCT mp2.metabolite_id) as common_metabolites_count,
-                        pc.metabolites_total,
+                        {metabolites_total} as metabolites_total,
                         COUNT(*) OVER() as pagination_total,
                         {reference_count} as reference_count
                     FROM metabolites_plant p
-                    JOIN metabolites_metaboliteplant mp2 ON mp2.plant_name = p.name
+                    JOIN metabolites_metaboliteplant mp2 ON mp2.plant_id = p.id
                     JOIN temp_reference_metabolites rm ON rm.metabolite_id = mp2.metabolite_id
-                    JOIN plant_counts pc ON pc.plant_name = p.name
-                    WHERE p.name != %s AND pc.metabolites_total > 1
+                    LEFT JOIN metabolites_plantstats ps ON ps.plant_id = p.id
+                    WHERE p.id != %s AND {metabolites_total} > 1
                 """
 
-                params = [self.name]
+                params = [self.id]
 
                 # Ajouter les filtres de métabolites si présents
                 if metabolite_filters and any(metabolite_filters):
                     for i, metabolite_id in enumerate(metabolite_filters):
                         if metabolite_id:
-                            query += f" AND p.name IN (SELECT plant_name FROM temp_filtered_plants_{i})"
+                            query += f" AND p.id IN (SELECT plant_id FROM temp_filtered_plants_{i})"
 
                 # Ajouter la condition de recherche
                 if search_text:
@@ -613,7 +839,7 @@ class Plant(models.Model):
                         query += " AND LOWER(p.name) LIKE LOWER(%s)"
                         params.append(f"{search_text}%")
                 
-                query += " GROUP BY p.id, p.name, p.french_name, pc.metabolites_total"
+                query += f" GROUP BY p.id, p.name, p.french_name, ps.{total_column}"
                 query += " HAVING COUNT(DISTINCT mp2.metabolite_id) > 0"
                 query += f" {order_by_clause}"
                 query += " LIMIT %s OFFSET %s"
@@ -634,36 +860,10 @@ class Plant(models.Model):
                     if i < 3:  # Maximum 3 filtres
                         cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS temp_filtered_plants_{i}")
             
-            # Calculer les pourcentages et scores
-            for result in results:
-                common_count = result['common_metabolites_count']
-                plant_total = result['metabolites_total']
-                
-                # Déterminer quel calcul utiliser
-                percentage = (common_count * 100.0) / plant_total if plant_total > 0 else 0
-                
-                # Conserver la distinction visuelle entre les cas
-                if reference_count >= plant_total:
-                    result['percentage_type'] = 'blue'
-                else:
-                    result['percentage_type'] = 'green'
-                
-                result['common_metabolites_percentage'] = round(percentage, 1)
-                
-                # Calcul des scores
-                result['meta_percentage_score'] = round(common_count * (percentage / 100), 2)
-                result['meta_root_score'] = round(math.sqrt(common_count) * (percentage / 100), 2) if common_count > 0 else 0
-            
             # Récupérer le total_count pour la pagination
             total_count = results[0]['pagination_total'] if results else 0
             
-            return {
-                'results': results,
-                'total_count': total_count,
-                'page': page,
-                'per_page': per_page,
-                'total_pages': (total_count + per_page - 1) // per_page
-            }
+            return results, total_count, reference_count
 
     def _sort_cached_results(self, results, order_criteria):
         """Trie les résultats en cache selon les critères spécifiés"""
@@ -735,9 +935,9 @@ class Plant(models.Model):
                     ON ma.metabolite_id = mp.metabolite_id
                 JOIN metabolites_activity a 
                     ON a.id = ma.activity_id
-                WHERE mp.plant_name = %s
+                WHERE mp.plant_id = %s
                     AND a.name = %s
-            """, [self.name, activity_name])
+            """, [self.id, activity_name])
             return cursor.fetchone()[0]
             
     def _get_metabolites_with_parts_sql(self):
@@ -755,9 +955,9 @@ class Plant(models.Model):
                     m.is_ubiquitous as metabolite__is_ubiquitous
                 FROM metabolites_metaboliteplant mp
                 JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
-                WHERE mp.plant_name = %s
+                WHERE mp.plant_id = %s
                 ORDER BY m.name, mp.plant_part
-            """, [self.name])
+            """, [self.id])
             columns = [col[0] for col in cursor.description]
             return [dict(zip(columns, row)) for row in cursor.fetchall()]
 
@@ -780,6 +980,10 @@ class MetaboliteActivity(models.Model):
 
 class MetabolitePlant(models.Model):
     metabolite = models.ForeignKey(Metabolite, related_name='plants', on_delete=models.CASCADE)
+    # Obligatoire en base : les écritures en masse (bulk_create, LOAD DATA, table de chargement) ne passent
+    # pas par save(). Les bases d'origine sont remplies par backfill_plant_fk avant la migration NOT NULL
+    plant = models.ForeignKey(Plant, related_name='metabolite_plants', on_delete=models.CASCADE)
+    # Nom dénormalisé conservé pour l'affichage et les imports, les jointures passent par plant_id
     plant_name = models.CharField(max_length=255, db_index=True)
     plant_part = models.CharField(max_length=255)
     low = models.DecimalField(max_digits=10, decimal_places=1, blank=True, null=True)
@@ -790,13 +994,246 @@ class MetabolitePlant(models.Model):
     def __str__(self):
         return f"{self.metabolite.name} - {self.plant_name} - {self.plant_part}"
 
+    def save(self, *args, **kwargs):
+        # Le nom dénormalisé est recopié depuis la plante (obligatoire, contrainte NOT NULL en base)
+        if self.plant_id is not None:
+            self.plant_name = self.plant.name
+        super().save(*args, **kwargs)
+
     class Meta:
         indexes = [
-            models.Index(fields=['plant_name', 'metabolite_id']),
-            models.Index(fields=['metabolite_id', 'plant_name']),
-            models.Index(fields=['plant_name']),
-            models.Index(fields=['metabolite_id']),
+            models.Index(fields=['plant', 'metabolite']),
+            models.Index(fields=['metabolite', 'plant']),
         ]
-        unique_together = ['metabolite', 'plant_name', 'plant_part', 'low', 'high', 'reference']
+        unique_together = ['metabolite', 'plant', 'plant_part', 'low', 'high', 'reference']
 
     
+
+
+class PlantStats(models.Model):
+    """Compteurs dénormalisés par plante, maintenus par signaux (voir stats.py)"""
+    plant = models.OneToOneField(Plant, related_name='stats', on_delete=models.CASCADE, primary_key=True)
+    total_rows = models.PositiveIntegerField(default=0)
+    distinct_metabolites = models.PositiveIntegerField(default=0, db_index=True)
+    distinct_non_ubiquitous = models.PositiveIntegerField(default=0, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # Renseignés par la commande build_plant_pairs (nombre réel de voisins, avant troncature top-K)
+    neighbours_count = models.PositiveIntegerField(null=True, blank=True)
+    neighbours_count_non_ubiquitous = models.PositiveIntegerField(null=True, blank=True)
+    neighbours_computed_at = models.DateTimeField(null=True, blank=True)
+    # Top-K des listes enregistrées (PlantPairStats) : seules les positions jusqu'à K sont exactes
+    neighbours_top_k = models.PositiveIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.plant.name} - {self.distinct_metabolites} métabolites"
+
+
+class PlantActivityStats(models.Model):
+    """Nombre de métabolites distincts d'une plante portant une activité donnée"""
+    plant = models.ForeignKey(Plant, related_name='activity_stats', on_delete=models.CASCADE)
+    activity = models.ForeignKey(Activity, related_name='plant_stats', on_delete=models.CASCADE)
+    distinct_metabolites = models.PositiveIntegerField(default=0)
+    distinct_non_ubiquitous = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['plant', 'activity']
+        indexes = [
+            models.Index(fields=['activity', 'distinct_metabolites']),
+        ]
+
+    def __str__(self):
+        return f"{self.plant.name} - {self.activity.name} - {self.distinct_metabolites}"
+
+
+class PlantMetaboliteConcentration(models.Model):
+    """
+    Concentrations d'un métabolite dans une plante, agrégées sur les parties de plantes
+    ayant une valeur (voir stats.py). Moyenne des (low + high) / 2, min des low, max des high.
+    """
+    plant = models.ForeignKey(Plant, related_name='concentrations', on_delete=models.CASCADE)
+    metabolite = models.ForeignKey(Metabolite, related_name='plant_concentrations', on_delete=models.CASCADE)
+    mean_concentration = models.FloatField()
+    min_concentration = models.FloatField()
+    max_concentration = models.FloatField()
+    parts_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['plant', 'metabolite']
+        indexes = [
+            models.Index(fields=['metabolite', 'mean_concentration']),
+        ]
+
+    def __str__(self):
+        return f"{self.plant.name} - {self.metabolite.name} - {self.mean_concentration}"
+
+    @staticmethod
+    def part_details(plant_ids, metabolite_ids):
+        """
+        Détail par partie de plante des valeurs retenues dans les moyennes (toutes les plantes si plant_ids
+        est None), retourne {(plant_id, metabolite_id): [{'plant_part', 'low', 'high', 'reference'}, ...]}
+        """
+        details = {}
+        rows = MetabolitePlant.objects.filter(metabolite_id__in=list(metabolite_ids))
+        if plant_ids is not None:
+            rows = rows.filter(plant_id__in=list(plant_ids))
+        rows = rows.values_list('plant_id', 'metabolite_id', 'plant_part', 'low', 'high', 'reference')
+        for plant_id, metabolite_id, plant_part, low, high, reference in rows:
+            low = float(low) if low is not None else 0.0
+            high = float(high) if high is not None else (low if low > 0.0 else 0.0)
+            # Ignorer les instances sans valeur
+            if low == 0.0 and high == 0.0:
+                continue
+            details.setdefault((plant_id, metabolite_id), []).append({
+                'plant_part': plant_part or 'Non spécifié',
+                'low': low,
+                'high': high,
+                'reference': reference
+            })
+        return details
+
+
+class PlantPairStats(models.Model):
+    """
+    Voisins précalculés d'une plante (commande build_plant_pairs).
+
+    Pour chaque critère de tri décroissant (métabolites en commun, pourcentage, Meta%, MetaRacine),
+    les PLANT_PAIR_TOP_K meilleurs voisins sont conservés : le tri de l'union sur n'importe lequel
+    de ces critères est donc exact pour les PLANT_PAIR_TOP_K premières positions.
+    """
+    plant = models.ForeignKey(Plant, related_name='pair_stats', on_delete=models.CASCADE)
+    neighbour = models.ForeignKey(Plant, related_name='+', on_delete=models.CASCADE)
+    exclude_ubiquitous = models.BooleanField(default=False)
+    common_count = models.PositiveIntegerField()
+    plant_total = models.PositiveIntegerField()
+    neighbour_total = models.PositiveIntegerField()
+    common_percentage = models.FloatField()
+    meta_percentage_score = models.FloatField()
+    meta_root_score = models.FloatField()
+
+    class Meta:
+        unique_together = ['plant', 'exclude_ubiquitous', 'neighbour']
+        indexes = [
+            models.Index(fields=['plant', 'exclude_ubiquitous', 'common_count']),
+            models.Index(fields=['plant', 'exclude_ubiquitous', 'common_percentage']),
+            models.Index(fields=['plant', 'exclude_ubiquitous', 'meta_percentage_score']),
+            models.Index(fields=['plant', 'exclude_ubiquitous', 'meta_root_score']),
+        ]
+
+    def __str__(self):
+        return f"{self.plant.name} - {self.neighbour.name} - {self.common_count}"
+
+
+class MetabolitePlantChange(models.Model):
+    """
+    Journal des apparitions (+1) et disparitions (-1) d'un métabolite dans une plante.
+
+    Alimenté par les signaux et les imports, consommé par la commande apply_pair_changes
+    qui répercute les deltas sur PlantPairStats. Pas de clés étrangères : la plante ou le
+    métabolite peuvent avoir été supprimés entre-temps.
+    """
+    plant_id = models.IntegerField()
+    metabolite_id = models.IntegerField()
+    delta = models.SmallIntegerField()
+    # Variantes concernées : tous les métabolites / hors ubiquitaires
+    all_metabolites = models.BooleanField(default=True)
+    non_ubiquitous = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['plant_id', 'metabolite_id']),
+            models.Index(fields=['metabolite_id']),
+        ]
+
+    def __str__(self):
+        return f"{self.plant_id} - {self.metabolite_id} ({self.delta:+d})"
+
+
+class ImportFingerprint(models.Model):
+    """
+    Empreinte d'une ligne source importée (import incrémental de transfert_plants).
+
+    key_hash identifie la ligne (métabolite, plante, partie), row_hash son contenu normalisé :
+    au run suivant, seules les lignes nouvelles, modifiées ou disparues sont appliquées.
+    """
+    source = models.CharField(max_length=50)
+    key_hash = models.BigIntegerField()
+    row_hash = models.BigIntegerField()
+    # Ligne MetabolitePlant correspondante (suppression si la ligne source disparaît)
+    metabolite_id = models.IntegerField()
+    plant_id = models.IntegerField()
+    plant_part = models.CharField(max_length=255)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['source', 'key_hash']
+
+    def __str__(self):
+        return f"{self.source} - {self.metabolite_id} - {self.plant_id} ({self.plant_part})"
+
+
+class DatasetGeneration(models.Model):
+    """
+    Compteur global de génération du jeu de données (une seule ligne), incrémenté à chaque
+    modification des plantes, métabolites, activités ou de l'ubiquité (signaux, imports, admin).
+
+    Les clés de cache des résultats calculés en dépendent (voir generation.py) : une mise à jour
+    invalide tous les résultats d'un coup, sans parcourir les clés.
+    """
+    value = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Génération {self.value}"
+
+
+class AccessCount(models.Model):
+    """
+    Nombre de consultations des pages coûteuses par plante, activité ou remède : la commande
+    warm_caches réchauffe en priorité les plus consultées.
+    """
+    KIND_PLANT = 'plant'
+    KIND_ACTIVITY = 'activity'
+    KIND_REMEDE = 'remede'
+    KIND_CHOICES = [(KIND_PLANT, 'Plante'), (KIND_ACTIVITY, 'Activité'), (KIND_REMEDE, 'Remède')]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    object_id = models.IntegerField()
+    count = models.PositiveIntegerField(default=0)
+    last_accessed = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['kind', 'object_id']
+        indexes = [
+            models.Index(fields=['kind', 'count']),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id} ({self.count})"
+
+    @classmethod
+    def record(cls, kind, object_id):
+        """
+        Compte une consultation par échantillonnage : une sur ACCESS_COUNT_SAMPLING seulement est
+        écrite en base (une requête UPDATE une fois la ligne créée), comptée ACCESS_COUNT_SAMPLING fois.
+        Le classement des plus consultées reste fiable sans écriture à chaque affichage.
+        """
+        sampling = max(int(getattr(settings, 'ACCESS_COUNT_SAMPLING', 1)), 1)
+        if random.random() * sampling >= 1:
+            return
+        try:
+            rows = cls.objects.filter(kind=kind, object_id=object_id)
+            increment = {'count': models.F('count') + sampling, 'last_accessed': timezone.now()}
+            if not rows.update(**increment):
+                _, created = cls.objects.get_or_create(kind=kind, object_id=object_id, defaults={'count': sampling})
+                if not created:
+                    # Ligne créée entre-temps par une requête concurrente
+                    rows.update(**increment)
+        except Exception as e:
+            # Les statistiques ne doivent jamais empêcher l'affichage de la page
+            logger.warning(f"Consultation non comptée ({kind} {object_id}): {e}")
+
+    @classmethod
+    def top(cls, kind, limit):
+        """IDs les plus consultés pour un type donné"""
+        return list(cls.objects.filter(kind=kind).order_by('-count', '-last_accessed').values_list('object_id', flat=True)[:limit])
@@ -0,0 +1,384 @@
+import logging
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q, Sum, Case, When, IntegerField
+from django.utils import timezone
+
+from .incidence import IncidenceEngine
+from .pairs import init_worker, compute_block, write_pair_rows, save_neighbour_counts
+
+logger = logging.getLogger('metabolites')
+
+# Taille des listes IN des requêtes de mise à jour
+CHUNK_SIZE = 500
+
+
+def log_presence_changes(changes, all_metabolites=True):
+    """
+    Journalise des changements de présence [(plant_id, metabolite_id, delta, non_ubiquitous), ...].
+
+    Utilisé par les signaux et par les imports en masse qui ne déclenchent pas de signaux.
+    """
+    from .models import MetabolitePlantChange
+
+    MetabolitePlantChange.objects.bulk_create([
+        MetabolitePlantChange(
+            plant_id=plant_id,
+            metabolite_id=metabolite_id,
+            delta=delta,
+            all_metabolites=all_metabolites,
+            non_ubiquitous=non_ubiquitous,
+        )
+        for plant_id, metabolite_id, delta, non_ubiquitous in changes
+        if plant_id is not None
+    ], batch_size=5000)
+
+
+def log_presence_change(plant_id, metabolite_id, delta):
+    """
+    Journalise un changement de présence constaté après écriture d'une ligne MetabolitePlant.
+
+    Le dernier delta en attente pour le couple sert de dédoublonnage : une suppression en masse
+    de plusieurs parties d'une même plante ne produit qu'une seule disparition.
+    """
+    from .models import Metabolite, MetabolitePlantChange
+
+    if plant_id is None:
+        return
+    last_delta = (
+        MetabolitePlantChange.objects
+        .filter(plant_id=plant_id, metabolite_id=metabolite_id, all_metabolites=True)
+        .order_by('-id').values_list('delta', flat=True).first()
+    )
+    if last_delta == delta:
+        return
+    is_ubiquitous = Metabolite.objects.filter(id=metabolite_id).values_list('is_ubiquitous', flat=True).first()
+    log_presence_changes([(plant_id, metabolite_id, delta, not is_ubiquitous)])
+
+
+def log_ubiquity_change(metabolite_id, is_ubiquitous):
+    """Un métabolite devenu ubiquitaire disparaît de la variante hors ubiquitaires (et inversement)"""
+    from .models import MetabolitePlant
+
+    plant_ids = (
+        MetabolitePlant.objects.filter(metabolite_id=metabolite_id, plant__isnull=False)
+        .values_list('plant_id', flat=True).distinct()
+    )
+    delta = -1 if is_ubiquitous else 1
+    log_presence_changes(
+        [(plant_id, metabolite_id, delta, True) for plant_id in plant_ids],
+        all_metabolites=False,
+    )
+
+
+def last_build_top_k():
+    """Top-K du dernier build_plant_pairs (enregistré dans PlantStats), PLANT_PAIR_TOP_K à défaut"""
+    from .models import PlantStats
+
+    top_k = (
+        PlantStats.objects.filter(neighbours_computed_at__isnull=False, neighbours_top_k__isnull=False)
+        .order_by('-neighbours_computed_at').values_list('neighbours_top_k', flat=True).first()
+    )
+    return top_k or settings.PLANT_PAIR_TOP_K
+
+
+def _chunks(values):
+    values = list(values)
+    for start in range(0, len(values), CHUNK_SIZE):
+        yield values[start:start + CHUNK_SIZE]
+
+
+def _base_memberships(changes):
+    """
+    Reconstitue, pour chaque métabolite du journal et chaque variante, l'ensemble des plantes
+    qui le contenaient avant le premier changement en attente (état actuel moins les deltas en attente).
+    """
+    from .models import Metabolite, MetabolitePlant, MetabolitePlantChange
+
+    metabolite_ids = {change.metabolite_id for change in changes}
+    current = defaultdict(set)
+    ubiquitous = {}
+    for chunk in _chunks(metabolite_ids):
+        for metabolite_id, plant_id in (
+            MetabolitePlant.objects.filter(metabolite_id__in=chunk, plant__isnull=False)
+            .values_list('metabolite_id', 'plant_id').distinct()
+        ):
+            current[metabolite_id].add(plant_id)
+        ubiquitous.update(Metabolite.objects.filter(id__in=chunk).values_list('id', 'is_ubiquitous'))
+
+    pending = (
+        MetabolitePlantChange.objects.values('metabolite_id', 'plant_id')
+        .annotate(
+            net_all=Sum(Case(When(all_metabolites=True, then='delta'), default=0, output_field=IntegerField())),
+            net_non_ubiquitous=Sum(Case(When(non_ubiquitous=True, then='delta'), default=0, output_field=IntegerField())),
+        )
+    )
+
+    memberships = {}
+    for metabolite_id in metabolite_ids:
+        memberships[(False, metabolite_id)] = set(current[metabolite_id])
+        memberships[(True, metabolite_id)] = set(current[metabolite_id]) if ubiquitous.get(metabolite_id) is False else set()
+    for row in pending:
+        for exclude_ubiquitous, net in ((False, row['net_all']), (True, row['net_non_ubiquitous'])):
+            members = memberships[(exclude_ubiquitous, row['metabolite_id'])]
+            if net > 0:
+                members.discard(row['plant_id'])
+            elif net < 0:
+                members.add(row['plant_id'])
+    return memberships
+
+
+def _replay(changes, memberships):
+    """Rejoue le journal dans l'ordre et cumule les deltas par couple de plantes et par plante"""
+    pair_deltas = defaultdict(int)
+    total_deltas = defaultdict(int)
+    for change in changes:
+        for exclude_ubiquitous, concerned in ((False, change.all_metabolites), (True, change.non_ubiquitous)):
+            if not concerned:
+                continue
+            members = memberships[(exclude_ubiquitous, change.metabolite_id)]
+            plant_id = change.plant_id
+            if change.delta > 0:
+                if plant_id in members:
+                    continue
+            elif plant_id not in members:
+                continue
+            members.discard(plant_id)
+            for other_id in members:
+                pair_deltas[(exclude_ubiquitous, plant_id, other_id)] += change.delta
+                pair_deltas[(exclude_ubiquitous, other_id, plant_id)] += change.delta
+            if change.delta > 0:
+                members.add(plant_id)
+            total_deltas[(exclude_ubiquitous, plant_id)] += change.delta
+    return pair_deltas, total_deltas
+
+
+def _apply_deltas(exclude_ubiquitous, pair_deltas, total_deltas, top_k):
+    """
+    Applique les deltas aux voisins enregistrés d'une variante.
+
+    Retourne les plantes dont la liste tronquée (top-K enregistré de la plante, top_k à défaut)
+    ne peut plus être garantie exacte et doit être recalculée.
+    """
+    from .models import Plant, PlantStats, PlantPairStats
+
+    count_field = 'neighbours_count_non_ubiquitous' if exclude_ubiquitous else 'neighbours_count'
+    total_field = 'distinct_non_ubiquitous' if exclude_ubiquitous else 'distinct_metabolites'
+    pairs = PlantPairStats.objects.filter(exclude_ubiquitous=exclude_ubiquitous)
+
+    by_plant = defaultdict(dict)
+    for (_, plant_id, other_id), delta in pair_deltas.items():
+        if delta:
+            by_plant[plant_id][other_id] = delta
+    involved = set(by_plant) | {plant_id for _, plant_id in total_deltas}
+
+    existing_plants = set()
+    neighbour_counts = {}
+    stored_top_k = {}
+    totals = {}
+    for chunk in _chunks(involved):
+        existing_plants.update(Plant.objects.filter(id__in=chunk).values_list('id', flat=True))
+        for plant_id, count, total, computed_at, plant_top_k in PlantStats.objects.filter(plant_id__in=chunk).values_list(
+            'plant_id', count_field, total_field, 'neighbours_computed_at', 'neighbours_top_k'
+        ):
+            totals[plant_id] = total
+            if computed_at is not None:
+                neighbour_counts[plant_id] = count
+                stored_top_k[plant_id] = plant_top_k or top_k
+
+    dirty = set()
+    increments = defaultdict(list)
+    for plant_id, deltas in by_plant.items():
+        # Plante jamais calculée par build_plant_pairs : rien à maintenir
+        if plant_id not in neighbour_counts:
+            continue
+        truncated = neighbour_counts[plant_id] > stored_top_k[plant_id]
+        stored = dict(
+            pairs.filter(plant_id=plant_id, neighbour_id__in=list(deltas)).values_list('neighbour_id', 'common_count')
+        )
+        for other_id, delta in deltas.items():
+            if other_id not in existing_plants or other_id not in stored:
+                # Nouveau voisin, voisin supprimé ou voisin hors liste : appartenance à revoir
+                dirty.add(plant_id)
+            elif stored[other_id] + delta <= 0 or (delta < 0 and truncated):
+                dirty.add(plant_id)
+            else:
+                increments[(plant_id, delta)].append(other_id)
+
+    for (plant_id, delta), other_ids in increments.items():
+        pairs.filter(plant_id=plant_id, neighbour_id__in=other_ids).update(common_count=F('common_count') + delta)
+
+    for (_, plant_id), delta in total_deltas.items():
+        if not delta:
+            continue
+        pairs.filter(plant_id=plant_id).update(plant_total=F('plant_total') + delta)
+        pairs.filter(neighbour_id=plant_id).update(neighbour_total=F('neighbour_total') + delta)
+
+        owners = pairs.filter(neighbour_id=plant_id).values_list('plant_id', flat=True)
+        new_total = totals.get(plant_id, 0)
+        old_total = new_total - delta
+        if (old_total > 1) != (new_total > 1):
+            # La plante franchit le seuil d'éligibilité (plus d'un métabolite)
+            dirty.update(owners)
+            dirty.update(_plants_sharing_metabolites(plant_id, exclude_ubiquitous))
+        elif delta > 0:
+            # Total en hausse : scores en baisse dans les listes tronquées où elle figure
+            owner_ids = set(owners)
+            dirty.update(_truncated(owner_ids, count_field, top_k))
+        else:
+            # Total en baisse : scores en hausse, elle peut entrer dans les listes tronquées où elle ne figure pas
+            owner_ids = set(owners)
+            sharing = set(_plants_sharing_metabolites(plant_id, exclude_ubiquitous)) - owner_ids
+            dirty.update(_truncated(sharing, count_field, top_k))
+
+    _refresh_scores(exclude_ubiquitous, by_plant.keys(), [plant_id for _, plant_id in total_deltas])
+    return dirty
+
+
+def _uncomputed_plants(plant_ids):
+    """
+    Plantes ayant des métabolites mais pas de voisins calculés (aucun métabolite lors du dernier
+    build_plant_pairs) : un calcul complet les inclurait, elles sont calculées pour les deux variantes
+    """
+    from .models import PlantStats
+
+    if not PlantStats.objects.filter(neighbours_computed_at__isnull=False).exists():
+        return set()
+    uncomputed = set()
+    for chunk in _chunks(plant_ids):
+        uncomputed.update(PlantStats.objects.filter(
+            plant_id__in=chunk, neighbours_computed_at__isnull=True, distinct_metabolites__gt=0
+        ).values_list('plant_id', flat=True))
+    return uncomputed
+
+
+def _truncated(plant_ids, count_field, top_k):
+    """Plantes dont la liste de voisins enregistrée est tronquée à son top-K (top_k à défaut)"""
+    from .models import PlantStats
+
+    beyond_top_k = (
+        Q(neighbours_top_k__isnull=False, **{f'{count_field}__gt': F('neighbours_top_k')})
+        | Q(neighbours_top_k__isnull=True, **{f'{count_field}__gt': top_k})
+    )
+    truncated = []
+    for chunk in _chunks(plant_ids):
+        truncated += PlantStats.objects.filter(
+            beyond_top_k, plant_id__in=chunk, neighbours_computed_at__isnull=False
+        ).values_list('plant_id', flat=True)
+    return truncated
+
+
+def _plants_sharing_metabolites(plant_id, exclude_ubiquitous):
+    with connection.cursor() as cursor:
+        query = """
+            SELECT DISTINCT mp2.plant_id
+            FROM metabolites_metaboliteplant mp1
+            JOIN metabolites_metaboliteplant mp2 ON mp2.metabolite_id = mp1.metabolite_id
+            JOIN metabolites_metabolite m ON m.id = mp1.metabolite_id
+            WHERE mp1.plant_id = %s AND mp2.plant_id IS NOT NULL AND mp2.plant_id != %s
+        """
+        if exclude_ubiquitous:
+            query += " AND m.is_ubiquitous = FALSE"
+        cursor.execute(query, [plant_id, plant_id])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _refresh_scores(exclude_ubiquitous, plant_ids, neighbour_ids):
+    """Recalcule pourcentage, Meta% et MetaRacine des lignes dont les comptes ont changé"""
+    with connection.cursor() as cursor:
+        for column, ids in (('plant_id', plant_ids), ('neighbour_id', neighbour_ids)):
+            for chunk in _chunks(ids):
+                placeholders = ', '.join(['%s'] * len(chunk))
+                cursor.execute(f"""
+                    UPDATE metabolites_plantpairstats
+                    SET common_percentage = common_count * 100.0 / neighbour_total,
+                        meta_percentage_score = common_count * common_count * 1.0 / neighbour_total,
+                        meta_root_score = SQRT(common_count) * common_count / neighbour_total
+                    WHERE exclude_ubiquitous = %s
+                    AND neighbour_total > 0
+                    AND {column} IN ({placeholders})
+                """, [exclude_ubiquitous] + chunk)
+
+
+def _recompute_plants(dirty, top_k):
+    """
+    Recalcule entièrement la liste de voisins des plantes données (une ligne de P·Pᵀ chacune),
+    au top-K enregistré de chaque plante (top_k à défaut)
+    """
+    from .models import PlantPairStats, PlantStats
+
+    engine = IncidenceEngine()
+    n_rows = engine.presence.shape[0]
+    row_plant_ids = np.empty(n_rows, dtype=np.int64)
+    for plant_id, row in engine.plant_rows.items():
+        row_plant_ids[row] = plant_id
+    name_rank = np.zeros(n_rows, dtype=np.int64)
+    name_rank[engine.candidate_rows] = engine.candidate_name_rank
+    eligible = np.zeros(n_rows, dtype=bool)
+    eligible[engine.candidate_rows] = True
+    init_worker({
+        False: (engine.presence, engine.totals_all),
+        True: (engine.presence[:, ~engine.ubiquitous].tocsr(), engine.totals_non_ubiquitous),
+    }, name_rank, eligible)
+
+    for exclude_ubiquitous, plant_ids in dirty.items():
+        by_top_k = defaultdict(list)
+        for chunk in _chunks(plant_ids):
+            stored_top_k = dict(PlantStats.objects.filter(plant_id__in=chunk).values_list('plant_id', 'neighbours_top_k'))
+            for plant_id in chunk:
+                by_top_k[stored_top_k.get(plant_id) or top_k].append(plant_id)
+
+        for plant_top_k, plant_ids in by_top_k.items():
+            rows = [engine.plant_rows[plant_id] for plant_id in plant_ids if plant_id in engine.plant_rows]
+            _, block = compute_block(exclude_ubiquitous, rows, plant_top_k)
+            neighbour_counts, _ = write_pair_rows(row_plant_ids, exclude_ubiquitous, block)
+
+            # Plantes sans aucun métabolite : plus aucun voisin
+            empty = [plant_id for plant_id in plant_ids if plant_id not in engine.plant_rows]
+            PlantPairStats.objects.filter(plant_id__in=empty, exclude_ubiquitous=exclude_ubiquitous).delete()
+            neighbour_counts.update({plant_id: 0 for plant_id in empty})
+            save_neighbour_counts(exclude_ubiquitous, neighbour_counts, timezone.now(), top_k=plant_top_k)
+
+
+def apply_pending_changes(top_k=None):
+    """
+    Consomme le journal MetabolitePlantChange et tient PlantPairStats à jour par deltas ±1.
+
+    Tout le journal est traité dans une seule transaction : l'état lu en base correspond
+    exactement à l'état obtenu après application de tous les changements lus.
+    Retourne (changements appliqués, plantes recalculées).
+    """
+    from .models import MetabolitePlantChange
+
+    top_k = top_k or last_build_top_k()
+    with transaction.atomic():
+        changes = list(MetabolitePlantChange.objects.order_by('id'))
+        if not changes:
+            return 0, 0
+
+        memberships = _base_memberships(changes)
+        pair_deltas, total_deltas = _replay(changes, memberships)
+
+        dirty = {}
+        for exclude_ubiquitous in (False, True):
+            dirty[exclude_ubiquitous] = _apply_deltas(
+                exclude_ubiquitous,
+                {key: delta for key, delta in pair_deltas.items() if key[0] == exclude_ubiquitous},
+                {key: delta for key, delta in total_deltas.items() if key[0] == exclude_ubiquitous},
+                top_k,
+            )
+        uncomputed = _uncomputed_plants({plant_id for _, plant_id in total_deltas})
+        for exclude_ubiquitous in dirty:
+            dirty[exclude_ubiquitous] |= uncomputed
+
+        recomputed = sum(len(plant_ids) for plant_ids in dirty.values())
+        if recomputed:
+            _recompute_plants(dirty, top_k)
+
+        MetabolitePlantChange.objects.filter(id__lte=changes[-1].id).delete()
+
+    logger.info(f"Journal appliqué : {len(changes)} changement(s), {recomputed} plante(s) recalculée(s)")
+    return len(changes), recomputed
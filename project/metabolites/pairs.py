@@ -0,0 +1,141 @@
+import numpy as np
+
+from .ranking import score_column
+
+# Critères de tri décroissants servis par les voisins précalculés
+PAIR_SORT_FIELDS = ('common_metabolites', 'common_percentage', 'meta_percentage_score', 'meta_root_score')
+
+# Matrices partagées par les processus de calcul (renseignées par init_worker)
+_worker_state = {}
+
+
+def init_worker(variants, name_rank, eligible):
+    """
+    Initialisation d'un processus de calcul.
+
+    variants : {exclude_ubiquitous: (matrice de présence CSR, totaux par ligne)}
+    """
+    _worker_state['variants'] = {
+        exclude_ubiquitous: (presence, presence.T.tocsr(), totals)
+        for exclude_ubiquitous, (presence, totals) in variants.items()
+    }
+    _worker_state['name_rank'] = name_rank
+    _worker_state['eligible'] = eligible
+
+
+def top_indices(key, common, name_rank, top_k):
+    """
+    Indices des top_k plus grandes valeurs de key, départagées comme l'affichage
+    (métabolites en commun décroissants puis nom).
+    """
+    if len(key) <= top_k:
+        return np.arange(len(key))
+    threshold = np.partition(key, len(key) - top_k)[len(key) - top_k]
+    candidates = np.flatnonzero(key >= threshold)
+    if len(candidates) > top_k:
+        order = np.lexsort((name_rank[candidates], -common[candidates], -key[candidates]))
+        candidates = candidates[order[:top_k]]
+    return candidates
+
+
+def compute_block(exclude_ubiquitous, block_rows, top_k):
+    """
+    Calcule les lignes block_rows du produit P·Pᵀ et conserve, pour chaque plante,
+    l'union des top_k voisins selon chaque critère de tri.
+
+    Retourne (exclude_ubiquitous, [(ligne, total de la plante, nombre de voisins, colonnes, communs,
+    totaux voisins, pourcentages, scores Meta%, scores MetaRacine), ...]).
+    """
+    presence, presence_t, totals = _worker_state['variants'][exclude_ubiquitous]
+    name_rank = _worker_state['name_rank']
+    eligible = _worker_state['eligible']
+
+    block_rows = np.asarray(block_rows, dtype=np.int64)
+    block = (presence[block_rows] @ presence_t).tocsr()
+    rows = []
+    for local, row in enumerate(block_rows):
+        row = int(row)
+        first, last = block.indptr[local], block.indptr[local + 1]
+        columns = block.indices[first:last]
+        commons = block.data[first:last]
+
+        # Mêmes conditions que Plant.get_common_plants sans filtre d'activité
+        keep = (columns != row) & (commons > 0) & (totals[columns] > 1) & eligible[columns]
+        columns, commons = columns[keep], commons[keep]
+        if not len(columns):
+            rows.append((row, int(totals[row]), 0) + (np.empty(0),) * 6)
+            continue
+
+        common = commons.astype(np.float64)
+        neighbour_totals = totals[columns].astype(np.float64)
+        percentages = common * 100.0 / neighbour_totals
+        meta_scores = common * common / neighbour_totals
+        root_scores = np.sqrt(common) * common / neighbour_totals
+
+        # Sélection sur les valeurs arrondies comme à l'affichage, départagées comme le classement à la demande
+        selected = np.zeros(len(columns), dtype=bool)
+        for field in PAIR_SORT_FIELDS:
+            key = score_column(field, common, neighbour_totals)
+            selected[top_indices(key, common, name_rank[columns], top_k)] = True
+        selected = np.flatnonzero(selected)
+
+        rows.append((
+            row,
+            int(totals[row]),
+            len(columns),
+            columns[selected],
+            commons[selected],
+            totals[columns[selected]],
+            percentages[selected],
+            meta_scores[selected],
+            root_scores[selected],
+        ))
+    return exclude_ubiquitous, rows
+
+
+def write_pair_rows(row_plant_ids, exclude_ubiquitous, rows):
+    """Remplace les voisins enregistrés des plantes calculées, retourne {plant_id: nombre de voisins}"""
+    from django.db import transaction
+    from .models import PlantPairStats
+
+    neighbour_counts = {}
+    pairs = []
+    for row, plant_total, count, columns, commons, neighbour_totals, percentages, meta_scores, root_scores in rows:
+        plant_id = int(row_plant_ids[row])
+        neighbour_counts[plant_id] = count
+        for index in range(len(columns)):
+            pairs.append(PlantPairStats(
+                plant_id=plant_id,
+                neighbour_id=int(row_plant_ids[columns[index]]),
+                exclude_ubiquitous=exclude_ubiquitous,
+                common_count=int(commons[index]),
+                plant_total=plant_total,
+                neighbour_total=int(neighbour_totals[index]),
+                common_percentage=float(percentages[index]),
+                meta_percentage_score=float(meta_scores[index]),
+                meta_root_score=float(root_scores[index]),
+            ))
+
+    with transaction.atomic():
+        PlantPairStats.objects.filter(
+            plant_id__in=list(neighbour_counts), exclude_ubiquitous=exclude_ubiquitous
+        ).delete()
+        PlantPairStats.objects.bulk_create(pairs, batch_size=5000)
+    return neighbour_counts, len(pairs)
+
+
+def save_neighbour_counts(exclude_ubiquitous, neighbour_counts, computed_at=None, top_k=None):
+    """
+    Enregistre le nombre réel de voisins de chaque plante (base de la pagination)
+    et le top-K des listes enregistrées (pages servies par le précalcul)
+    """
+    from .models import PlantStats
+
+    field = 'neighbours_count_non_ubiquitous' if exclude_ubiquitous else 'neighbours_count'
+    fields = [field] + (['neighbours_computed_at'] if computed_at else []) + (['neighbours_top_k'] if top_k else [])
+    stats = []
+    for plant_id, count in neighbour_counts.items():
+        plant_stats = PlantStats(plant_id=plant_id, neighbours_computed_at=computed_at, neighbours_top_k=top_k)
+        setattr(plant_stats, field, count)
+        stats.append(plant_stats)
+    PlantStats.objects.bulk_update(stats, fields, batch_size=1000)
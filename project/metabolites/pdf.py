@@ -0,0 +1,185 @@
+from io import BytesIO
+from xml.sax.saxutils import escape
+
+from django.template.defaultfilters import floatformat
+from django.utils.formats import localize
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4, landscape
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.lib.units import cm
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.platypus import Flowable, LongTable, Paragraph, SimpleDocTemplate, Spacer, TableStyle
+
+# Couleurs du tableau HTML (classes Tailwind et pills de plant_common_metabolites.html)
+GREEN_DARK = colors.HexColor('#166534')
+GRAY = colors.HexColor('#6b7280')
+GRAY_LIGHT = colors.HexColor('#9ca3af')
+BORDER = colors.HexColor('#e5e7eb')
+STRIPE = colors.HexColor('#f9fafb')
+PERCENTAGE_COLORS = {'blue': colors.HexColor('#2563eb'), 'green': colors.HexColor('#16a34a')}
+SIMILARITY_HIGH = colors.HexColor('#16a34a')
+SIMILARITY_MEDIUM = colors.HexColor('#ca8a04')
+PURPLE = colors.HexColor('#8b5cf6')
+PINK = colors.HexColor('#ec4899')
+ORANGE = colors.HexColor('#f59e0b')
+BLUE = colors.HexColor('#2563eb')
+
+TITLE_STYLE = ParagraphStyle('title', fontName='Helvetica-Bold', fontSize=16, leading=19, textColor=GREEN_DARK, alignment=1)
+SUBTITLE_STYLE = ParagraphStyle('subtitle', fontName='Helvetica', fontSize=9, leading=11, textColor=GRAY, alignment=1)
+INFO_STYLE = ParagraphStyle('info', fontName='Helvetica', fontSize=8, leading=10)
+HEADER_STYLE = ParagraphStyle('header', fontName='Helvetica-Bold', fontSize=7, leading=8.5, textColor=GRAY)
+FOOTER_STYLE = ParagraphStyle('footer', fontName='Helvetica', fontSize=7, leading=9, textColor=GRAY)
+
+
+def fit_text(text, font_name, font_size, width):
+    """Texte tronqué (…) pour tenir dans width points"""
+    if stringWidth(text, font_name, font_size) <= width:
+        return text
+    while text and stringWidth(text + '…', font_name, font_size) > width:
+        text = text[:-1]
+    return text + '…'
+
+
+class PlantCell(Flowable):
+    """
+    Cellule Plante : nom latin (gras, vert) et nom français (gris) sur deux lignes de hauteur
+    fixe, dessinées directement (pas d'analyse de balisage ni de césure comme un Paragraph).
+    """
+
+    def __init__(self, name, french_name=None):
+        super().__init__()
+        self.name = name
+        self.french_name = french_name or ''
+
+    def wrap(self, available_width, available_height):
+        self.width = available_width
+        self.height = 19 if self.french_name else 9
+        return self.width, self.height
+
+    def draw(self):
+        canvas = self.canv
+        canvas.setFillColor(GREEN_DARK)
+        canvas.setFont('Helvetica-Bold', 8)
+        canvas.drawString(0, self.height - 7, fit_text(self.name, 'Helvetica-Bold', 8, self.width))
+        if self.french_name:
+            canvas.setFillColor(GRAY)
+            canvas.setFont('Helvetica', 7)
+            canvas.drawString(0, 1.5, fit_text(self.french_name, 'Helvetica', 7, self.width))
+
+
+def common_plants_columns(filtered_metabolites=(), activity_filter=None, numbered=False):
+    """En-têtes du tableau, dans l'ordre de la page HTML"""
+    columns = ["N°"] if numbered else []
+    columns += ["Plante", "Nb métabolites commun", "% en commun", "Similarité AA", "Meta%", "MetaRacine"]
+    columns += [f"Concentration {metabolite['name']}" for metabolite in filtered_metabolites]
+    if activity_filter:
+        columns += [
+            f"Métabolites communs avec l'activité \"{activity_filter}\"",
+            f"Total métabolites avec l'activité \"{activity_filter}\"",
+            f"Concentration total \"{activity_filter}\"",
+        ]
+    return columns
+
+
+def common_plants_table_rows(results, filtered_metabolites=(), activity_filter=None, numbered=False):
+    """
+    Cellules du tableau et couleurs de texte par cellule [(colonne, ligne, couleur)],
+    calculées depuis les résultats classés (mêmes valeurs que la page HTML).
+    """
+    rows, text_colors = [], []
+
+    def cell(value, color=None):
+        if color is not None:
+            text_colors.append((len(row), len(rows) + 1, color))
+        row.append(value)
+
+    for plant_data in results:
+        row = []
+        if numbered:
+            cell(str(plant_data.get('numbering') or '-'))
+
+        cell(PlantCell(plant_data['name'], plant_data.get('french_name')))
+
+        cell(localize(plant_data['common_metabolites_count']), GRAY)
+        cell(f"{localize(plant_data['common_metabolites_percentage'])}%",
+             PERCENTAGE_COLORS.get(plant_data.get('percentage_type'), GRAY))
+
+        similarity = plant_data.get('amino_acid_similarity') or 0
+        cell(floatformat(similarity, 3) if similarity > 0 else '-',
+             SIMILARITY_HIGH if similarity > 0.7 else SIMILARITY_MEDIUM if similarity > 0.4 else GRAY_LIGHT)
+        cell(localize(plant_data.get('meta_percentage_score')), PURPLE)
+        cell(localize(plant_data.get('meta_root_score')), PINK)
+
+        concentrations = plant_data.get('metabolite_concentrations') or {}
+        for metabolite in filtered_metabolites:
+            concentration = concentrations.get(int(metabolite['id']))
+            if concentration and concentration['count'] > 0:
+                cell(floatformat(concentration['average'], 2), ORANGE)
+            else:
+                cell('-', GRAY_LIGHT)
+
+        if activity_filter:
+            cell(localize(plant_data.get('common_activity_metabolites_count')), GRAY)
+            cell(localize(plant_data.get('total_activity_metabolites_count')), GRAY)
+            cell(floatformat(plant_data.get('total_concentration'), 2), BLUE)
+        rows.append(row)
+    return rows, text_colors
+
+
+def common_plants_pdf(plant, results, filtered_metabolites=(), activity_filter=None, numbered=False,
+                      filters_description=(), sorting_description=(), generated_at=''):
+    """
+    PDF (A4 paysage) des plantes en commun, construit directement depuis les résultats
+    classés avec reportlab : pas de rendu HTML intermédiaire. Retourne les octets du PDF.
+    """
+    buffer = BytesIO()
+    document = SimpleDocTemplate(
+        buffer, pagesize=landscape(A4),
+        leftMargin=0.5 * cm, rightMargin=0.5 * cm, topMargin=0.5 * cm, bottomMargin=0.5 * cm,
+        title=f"{plant.name} - Métabolites en commun",
+    )
+
+    story = [Paragraph(escape(plant.name), TITLE_STYLE)]
+    if plant.french_name:
+        story.append(Paragraph(escape(plant.french_name), SUBTITLE_STYLE))
+    story += [
+        Spacer(1, 6),
+        Paragraph(f"<b>Filtres:</b> {escape(', '.join(filters_description)) or 'Aucun'}", INFO_STYLE),
+        Paragraph(f"<b>Tri:</b> {escape(', '.join(sorting_description)) or 'Aucun'}", INFO_STYLE),
+        Spacer(1, 6),
+    ]
+
+    columns = common_plants_columns(filtered_metabolites, activity_filter, numbered)
+    # En-têtes sans majuscules forcées : les mots tiennent dans les colonnes étroites
+    header = [Paragraph(escape(column), HEADER_STYLE) for column in columns]
+    rows, text_colors = common_plants_table_rows(results, filtered_metabolites, activity_filter, numbered)
+    style = [
+        ('GRID', (0, 0), (-1, -1), 0.5, BORDER),
+        ('BACKGROUND', (0, 0), (-1, 0), STRIPE),
+        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, STRIPE]),
+        ('FONT', (0, 1), (-1, -1), 'Helvetica', 8),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('LEFTPADDING', (0, 0), (-1, -1), 4),
+        ('RIGHTPADDING', (0, 0), (-1, -1), 4),
+        ('TOPPADDING', (0, 0), (-1, -1), 3),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 3),
+    ]
+    style += [('TEXTCOLOR', (column, row), (column, row), color) for column, row, color in text_colors]
+    if not rows:
+        rows = [["Aucune plante avec des métabolites en commun"] + [''] * (len(columns) - 1)]
+        style += [('SPAN', (0, 1), (-1, 1)), ('ALIGN', (0, 1), (-1, 1), 'CENTER'), ('TEXTCOLOR', (0, 1), (-1, 1), GRAY)]
+
+    # Colonne Plante plus large, les autres se partagent la largeur restante
+    plant_column = 1 if numbered else 0
+    other_width = (document.width - 5 * cm - (1 * cm if numbered else 0)) / (len(columns) - 1 - (1 if numbered else 0))
+    widths = [other_width] * len(columns)
+    widths[plant_column] = 5 * cm
+    if numbered:
+        widths[0] = 1 * cm
+
+    # LongTable : découpage en pages sans recalcul de la mise en page de tout le tableau
+    story.append(LongTable([header] + rows, colWidths=widths, repeatRows=1, style=TableStyle(style)))
+    story += [Spacer(1, 8), Paragraph(f"Document généré le {escape(generated_at)} - PhytoChemInteractif", FOOTER_STYLE)]
+
+    document.build(story)
+    return buffer.getvalue()
@@ -0,0 +1,201 @@
+import numpy as np
+
+# Préfixe des tris par concentration moyenne d'un métabolite (metabolite_concentration_<id>)
+CONCENTRATION_SORT_PREFIX = 'metabolite_concentration_'
+
+
+def score_column(field, common, totals):
+    """
+    Valeurs d'un critère calculé à partir des comptes (métabolites en commun, total de la plante),
+    arrondies comme à l'affichage, None pour un autre champ. Les égalités entre valeurs arrondies
+    sont départagées par les métabolites en commun décroissants puis par le nom, aussi bien pour
+    le classement à la demande que pour la sélection des voisins précalculés (pairs.compute_block).
+    """
+    common = np.asarray(common, dtype=np.float64)
+    if field == 'common_metabolites':
+        return common
+    totals = np.asarray(totals, dtype=np.float64)
+    percentages = np.divide(common * 100.0, totals, out=np.zeros_like(common), where=totals > 0)
+    if field == 'common_percentage':
+        return np.round(percentages, 1)
+    if field == 'meta_percentage_score':
+        return np.round(common * percentages / 100, 2)
+    if field == 'meta_root_score':
+        return np.round(np.sqrt(common) * percentages / 100, 2)
+    return None
+
+
+def lexsort_keys(column, sort_params, tie_breakers=()):
+    """
+    Clés np.lexsort pour sort_params [(champ, 'asc' | 'desc'), ...] donnés par ordre de priorité :
+    le premier paramètre est la clé principale. column(champ) retourne les valeurs du champ,
+    ou None pour un champ inconnu (ignoré). tie_breakers départagent les égalités (format np.lexsort).
+    """
+    keys = list(tie_breakers)
+    for field, direction in reversed(list(sort_params or [])):
+        values = column(field)
+        if values is not None:
+            keys.append(-values if direction.lower() == 'desc' else values)
+    return keys
+
+
+def page_order(keys, page, per_page):
+    """
+    Positions de la page demandée dans l'ordre de np.lexsort(keys) (dernière clé principale,
+    égalités dans l'ordre d'origine), sans trier l'ensemble des candidats.
+
+    Seuls les candidats dont la clé principale ne dépasse pas la valeur de rang page × per_page
+    (trouvée par np.partition) sont triés.
+    """
+    n = len(keys[-1])
+    offset = (page - 1) * per_page
+    end = min(offset + per_page, n)
+    if offset >= n:
+        return np.empty(0, dtype=np.int64)
+
+    candidates = np.arange(n)
+    if end < n:
+        primary = keys[-1]
+        threshold = np.partition(primary, end - 1)[end - 1]
+        candidates = np.flatnonzero(primary <= threshold)
+
+    order = candidates[np.lexsort([key[candidates] for key in keys])]
+    return order[offset:end]
+
+
+class CommonPlantCandidates:
+    """
+    Plantes ayant des métabolites en commun avec une plante de référence, sous forme de colonnes :
+    les clés de tri sont calculées sur tous les candidats, les lignes (dictionnaires)
+    uniquement pour la page affichée.
+
+    Les égalités sont départagées par les métabolites en commun décroissants puis par le nom.
+    """
+
+    def __init__(self, ids, names, french_names, name_rank, common, totals, reference_count, activity=None,
+                 reference_id=None, total_count=None):
+        self.reference_id = reference_id
+        # Nombre total de candidats quand seuls les premiers sont fournis (voisins précalculés)
+        self._total_count = total_count
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.names = names
+        self.french_names = french_names
+        self.name_rank = np.asarray(name_rank, dtype=np.int64)
+        self.common = np.asarray(common, dtype=np.int64)
+        self.totals = np.asarray(totals, dtype=np.int64)
+        self.reference_count = reference_count
+        # (total_activity, common_activity, total_concentration) si un filtre d'activité est actif
+        self.activity = activity
+        self._columns = {}
+
+    @classmethod
+    def from_results(cls, results, reference_count, activity_filter=None, reference_id=None, total_count=None):
+        """Candidats construits à partir des lignes de la version SQL ou des voisins précalculés"""
+        lower_names = np.array([result['name'].lower() for result in results], dtype=str)
+        name_rank = np.unique(lower_names, return_inverse=True)[1] if len(results) else []
+        activity = None
+        if activity_filter:
+            activity = (
+                np.array([result['total_activity_metabolites_count'] for result in results], dtype=np.int64),
+                np.array([result['common_activity_metabolites_count'] for result in results], dtype=np.int64),
+                np.array([float(result['total_concentration']) for result in results], dtype=np.float64),
+            )
+        return cls(
+            ids=[result['id'] for result in results],
+            names=[result['name'] for result in results],
+            french_names=[result['french_name'] for result in results],
+            name_rank=name_rank,
+            common=[result['common_metabolites_count'] for result in results],
+            totals=[result['metabolites_total'] for result in results],
+            reference_count=reference_count,
+            activity=activity,
+            reference_id=reference_id,
+            total_count=total_count,
+        )
+
+    @property
+    def total_count(self):
+        return len(self.ids) if self._total_count is None else self._total_count
+
+    def default_keys(self):
+        """
+        Ordre par défaut : métabolites en commun décroissants (précédés des métabolites actifs en commun),
+        puis nom ; sert aussi à départager les égalités des autres tris
+        """
+        keys = [self.name_rank, -self.common]
+        if self.activity is not None:
+            keys.append(-self.activity[1])
+        return keys
+
+    def column(self, field):
+        """
+        Valeurs d'un champ de tri pour tous les candidats (arrondies comme à l'affichage),
+        None si le champ est inconnu. Les colonnes calculées sont conservées.
+        """
+        if field not in self._columns:
+            self._columns[field] = self._compute_column(field)
+        return self._columns[field]
+
+    def _compute_column(self, field):
+        if field == 'name':
+            return self.name_rank
+        if field == 'common_metabolites':
+            return self.common
+        values = score_column(field, self.common, self.totals)
+        if values is not None:
+            return values
+        if self.activity is not None:
+            total_activity, common_activity, total_concentration = self.activity
+            if field == 'common_activity_metabolites':
+                return common_activity
+            if field == 'total_activity_metabolites':
+                return total_activity
+            if field == 'total_concentration':
+                return total_concentration
+        if field == 'amino_acid_similarity' and self.reference_id is not None:
+            from acides_amines.utils import calculate_amino_acid_similarity
+            return calculate_amino_acid_similarity(self.reference_id, self.ids, normalization='sum')
+        if field.startswith(CONCENTRATION_SORT_PREFIX):
+            from .models import PlantMetaboliteConcentration
+            try:
+                metabolite_id = int(field[len(CONCENTRATION_SORT_PREFIX):])
+            except ValueError:
+                return None
+            averages = dict(PlantMetaboliteConcentration.objects.filter(
+                metabolite_id=metabolite_id, plant_id__in=self.ids.tolist()
+            ).values_list('plant_id', 'mean_concentration'))
+            return np.array([averages.get(plant_id, 0.0) for plant_id in self.ids.tolist()], dtype=np.float64)
+        return None
+
+    def sort_keys(self, sort_params):
+        """Clés np.lexsort de sort_params (le premier est prioritaire), égalités dans l'ordre par défaut"""
+        return lexsort_keys(self.column, sort_params, tie_breakers=self.default_keys())
+
+    def order(self, sort_params):
+        """Positions de tous les candidats triés selon sort_params"""
+        return np.lexsort(self.sort_keys(sort_params))
+
+    def page(self, sort_params, page, per_page):
+        """Positions de la page demandée triée selon sort_params"""
+        return page_order(self.sort_keys(sort_params), page, per_page)
+
+    def rows(self, positions):
+        """Lignes (mêmes clés que Plant.get_common_plants, sans les scores) des positions données"""
+        rows = []
+        for index in positions:
+            row = {
+                'id': int(self.ids[index]),
+                'name': self.names[index],
+                'french_name': self.french_names[index],
+                'common_metabolites_count': int(self.common[index]),
+                'metabolites_total': int(self.totals[index]),
+                'pagination_total': self.total_count,
+                'reference_count': self.reference_count,
+            }
+            if self.activity is not None:
+                total_activity, common_activity, total_concentration = self.activity
+                row['total_activity_metabolites_count'] = int(total_activity[index])
+                row['common_activity_metabolites_count'] = int(common_activity[index])
+                row['total_concentration'] = float(total_concentration[index])
+            rows.append(row)
+        return rows
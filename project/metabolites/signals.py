@@ -0,0 +1,114 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from .models import Metabolite, MetaboliteActivity, MetabolitePlant, Activity, Plant
+from .incidence import invalidate_incidence_engine
+from .stats import schedule_plant_stats, schedule_plant_concentrations
+from .pair_changes import log_presence_change, log_ubiquity_change
+from .generation import bump_generation
+from acides_amines.utils import invalidate_amino_acid_matrix
+
+
+@receiver([post_save, post_delete], sender=MetabolitePlant)
+@receiver([post_save, post_delete], sender=MetaboliteActivity)
+@receiver([post_save, post_delete], sender=Metabolite)
+@receiver([post_save, post_delete], sender=Activity)
+@receiver([post_save, post_delete], sender=Plant)
+def reset_incidence_engine(sender, **kwargs):
+    """Toute modification des données invalide la matrice d'incidence du processus"""
+    invalidate_incidence_engine()
+
+
+@receiver([post_save, post_delete], sender=Metabolite)
+@receiver([post_save, post_delete], sender=Plant)
+def reset_amino_acid_matrix(sender, **kwargs):
+    """
+    Un nom modifié ou une suppression invalide la matrice des acides aminés du processus
+    (les concentrations la réinitialisent elles-mêmes une fois recalculées)
+    """
+    invalidate_amino_acid_matrix()
+
+
+def _cascade_from(origin, *models):
+    """Vrai si la suppression en cascade part d'une instance (ou d'un queryset) des modèles donnés"""
+    return isinstance(origin, models) or getattr(origin, 'model', None) in models
+
+
+def _plants_with_metabolite(metabolite_id):
+    return MetabolitePlant.objects.filter(metabolite_id=metabolite_id).values_list('plant_id', flat=True).distinct()
+
+
+def _has_metabolite(plant_id, metabolite_id):
+    return MetabolitePlant.objects.filter(plant_id=plant_id, metabolite_id=metabolite_id).exists()
+
+
+@receiver(pre_save, sender=MetabolitePlant)
+def remember_previous_plant(sender, instance, **kwargs):
+    """Mémorise le couple plante-métabolite d'origine pour recalculer aussi ses compteurs s'il change"""
+    instance._previous_plant_id = instance._previous_metabolite_id = None
+    if instance.pk:
+        previous = sender.objects.filter(pk=instance.pk).values_list('plant_id', 'metabolite_id').first()
+        if previous:
+            instance._previous_plant_id, instance._previous_metabolite_id = previous
+
+
+@receiver(post_save, sender=MetabolitePlant)
+def update_stats_on_metabolite_plant_save(sender, instance, **kwargs):
+    previous_plant_id = getattr(instance, '_previous_plant_id', None)
+    previous_metabolite_id = getattr(instance, '_previous_metabolite_id', None)
+    schedule_plant_stats({instance.plant_id, previous_plant_id})
+    schedule_plant_concentrations({instance.plant_id, previous_plant_id})
+
+    # Journal des présences pour la maintenance incrémentale des voisins (PlantPairStats)
+    if (previous_plant_id, previous_metabolite_id) != (instance.plant_id, instance.metabolite_id):
+        if previous_plant_id and not _has_metabolite(previous_plant_id, previous_metabolite_id):
+            log_presence_change(previous_plant_id, previous_metabolite_id, -1)
+        # Première partie de plante pour ce métabolite : apparition
+        if instance.plant_id and MetabolitePlant.objects.filter(
+            plant_id=instance.plant_id, metabolite_id=instance.metabolite_id
+        ).count() == 1:
+            log_presence_change(instance.plant_id, instance.metabolite_id, 1)
+
+
+@receiver(post_delete, sender=MetabolitePlant)
+def update_stats_on_metabolite_plant_delete(sender, instance, origin=None, **kwargs):
+    # Les compteurs d'une plante supprimée disparaissent avec elle
+    if not _cascade_from(origin, Plant):
+        schedule_plant_stats({instance.plant_id})
+    # Les concentrations d'une plante ou d'un métabolite supprimé disparaissent en cascade
+    if not _cascade_from(origin, Plant, Metabolite):
+        schedule_plant_concentrations({instance.plant_id})
+    if instance.plant_id and not _has_metabolite(instance.plant_id, instance.metabolite_id):
+        log_presence_change(instance.plant_id, instance.metabolite_id, -1)
+
+
+@receiver(pre_save, sender=Metabolite)
+def remember_previous_ubiquity(sender, instance, **kwargs):
+    instance._previous_is_ubiquitous = None
+    if instance.pk:
+        instance._previous_is_ubiquitous = sender.objects.filter(pk=instance.pk).values_list('is_ubiquitous', flat=True).first()
+
+
+@receiver(post_save, sender=Metabolite)
+def update_stats_on_ubiquity_change(sender, instance, created, **kwargs):
+    """Le passage en ubiquitaire modifie les compteurs non ubiquitaires de toutes les plantes concernées"""
+    previous = getattr(instance, '_previous_is_ubiquitous', None)
+    if not created and previous is not None and previous != instance.is_ubiquitous:
+        schedule_plant_stats(_plants_with_metabolite(instance.id))
+        log_ubiquity_change(instance.id, instance.is_ubiquitous)
+
+
+@receiver([post_save, post_delete], sender=MetaboliteActivity)
+def update_stats_on_metabolite_activity_change(sender, instance, origin=None, **kwargs):
+    if not _cascade_from(origin, Metabolite, Activity):
+        schedule_plant_stats(_plants_with_metabolite(instance.metabolite_id))
+
+
+# Enregistré en dernier : la génération n'avance qu'une fois les données dérivées recalculées
+@receiver([post_save, post_delete], sender=MetabolitePlant)
+@receiver([post_save, post_delete], sender=MetaboliteActivity)
+@receiver([post_save, post_delete], sender=Metabolite)
+@receiver([post_save, post_delete], sender=Activity)
+@receiver([post_save, post_delete], sender=Plant)
+def advance_dataset_generation(sender, **kwargs):
+    """Toute modification des données rend obsolètes les résultats en cache (clés versionnées)"""
+    bump_generation()
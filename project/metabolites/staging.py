@@ -0,0 +1,235 @@
+import logging
+import time
+from collections import OrderedDict
+
+from django.db import IntegrityError, connection, models, transaction
+
+logger = logging.getLogger('metabolites')
+
+_staging_models = {}
+
+
+class LiveTableChanged(Exception):
+    """Levée par swap() si les données live ont été modifiées depuis la copie : l'échange perdrait ces écritures"""
+
+
+class StagingTable:
+    """
+    Table de chargement de même schéma qu'un modèle, échangée atomiquement avec la table live :
+    les lectures restent rapides pendant l'import et aucun jeu de données partiel n'est visible.
+
+    - create() : crée la table (sans ses index secondaires) et y copie les lignes live ;
+    - model : modèle non géré sur la table de chargement, pour les écritures de l'import ;
+    - build_indexes() : construit les index secondaires sur la table chargée ;
+    - swap() : échange les tables (RENAME TABLE sous MySQL) puis supprime l'ancienne ;
+    - drop() : abandonne le chargement.
+
+    Les écritures faites sur la table live entre la copie et l'échange seraient perdues : un
+    repère des écritures (génération du jeu de données et dernier id du journal des présences,
+    voir _live_marker) est lu avant la copie et relu pendant l'échange ; s'il a changé, swap()
+    lève LiveTableChanged et l'import est à relancer. Les écritures qui ne passent pas par les
+    signaux doivent donc appeler bump_generation(), comme les commandes d'import. Les clés
+    étrangères de la table chargée sont vérifiées avant l'échange, sans verrou (IntegrityError
+    si une ligne référence une plante ou un métabolite absent) ; une suppression faite ensuite
+    avance la génération et annule l'échange. Seuls la relecture du repère et le renommage ont
+    lieu sous LOCK TABLES.
+
+    Sous SQLite (développement), l'échange se fait dans une transaction (DROP TABLE puis
+    ALTER TABLE ... RENAME) ; les noms d'index étant globaux à la base, les index y sont
+    construits pendant l'échange (un doublon sur un index unique annule alors l'échange).
+    """
+
+    def __init__(self, model):
+        self.live_model = model
+        self.live = model._meta.db_table
+        self.table = f'{self.live}_staging'
+        self.vendor = connection.vendor
+        self._indexes = []
+        self._foreign_keys = []
+        self._marker = None
+
+    @property
+    def model(self):
+        """Modèle non géré, de mêmes champs que le modèle live, sur la table de chargement"""
+        if self.table not in _staging_models:
+            attrs = {'__module__': self.live_model.__module__}
+            for field in self.live_model._meta.local_fields:
+                name, path, args, kwargs = field.deconstruct()
+                if field.is_relation:
+                    # Pas d'accesseur inverse ni de cascade : les suppressions sur les tables live
+                    # ne lisent pas la table de chargement (vérifiée par swap())
+                    kwargs['related_name'] = '+'
+                    kwargs['on_delete'] = models.DO_NOTHING
+                attrs[name] = field.__class__(*args, **kwargs)
+            attrs['Meta'] = type('Meta', (), {
+                'db_table': self.table,
+                'managed': False,
+                'app_label': self.live_model._meta.app_label,
+            })
+            _staging_models[self.table] = type(f'{self.live_model.__name__}Staging', (models.Model,), attrs)
+        return _staging_models[self.table]
+
+    def create(self):
+        """Crée la table de chargement sans index secondaires et y copie les lignes live"""
+        start_time = time.time()
+        self.drop()
+        with connection.cursor() as cursor:
+            if self.vendor == 'mysql':
+                cursor.execute(f"CREATE TABLE `{self.table}` LIKE `{self.live}`")
+                # Index secondaires supprimés pendant le chargement, reconstruits par build_indexes()
+                self._indexes = self._mysql_secondary_indexes(cursor)
+                if self._indexes:
+                    cursor.execute(
+                        f"ALTER TABLE `{self.table}` " + ', '.join(f"DROP INDEX `{name}`" for name in self._indexes)
+                    )
+                self._foreign_keys = self._mysql_foreign_keys(cursor)
+            else:
+                cursor.execute(
+                    "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = %s", [self.live]
+                )
+                create_sql = cursor.fetchone()[0]
+                cursor.execute(create_sql.replace(f'"{self.live}"', f'"{self.table}"', 1))
+                cursor.execute(
+                    "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND sql IS NOT NULL",
+                    [self.live]
+                )
+                self._indexes = [row[0] for row in cursor.fetchall()]
+
+            # Repère lu avant la copie : une écriture validée pendant la copie annule l'échange
+            self._marker = self._live_marker(cursor)
+            cursor.execute(f"INSERT INTO {self._quoted(self.table)} SELECT * FROM {self._quoted(self.live)}")
+        logger.info(f"Table de chargement {self.table} créée en {time.time() - start_time:.1f}s")
+
+    def build_indexes(self):
+        """Construit les index secondaires sur la table chargée (MySQL : une seule instruction ALTER)"""
+        if self.vendor != 'mysql' or not self._indexes:
+            return
+        start_time = time.time()
+        clauses = ', '.join(
+            f"ADD INDEX `{name}` ({', '.join(columns)})" for name, columns in self._indexes.items()
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(f"ALTER TABLE `{self.table}` {clauses}")
+        logger.info(f"Index de {self.table} construits en {time.time() - start_time:.1f}s")
+
+    def swap(self):
+        """
+        Remplace atomiquement la table live par la table de chargement et supprime l'ancienne.
+
+        IntegrityError si une clé étrangère de la table chargée ne référence aucune ligne,
+        LiveTableChanged si les données live ont changé depuis create() : la table live est alors conservée.
+        """
+        start_time = time.time()
+        with connection.cursor() as cursor:
+            # Parcours de la table chargée, hors verrou : les lectures de la table live continuent
+            self._check_foreign_keys(cursor)
+            if self.vendor == 'mysql':
+                old = f'{self.live}_old'
+                cursor.execute(f"DROP TABLE IF EXISTS `{old}`")
+                # Sous verrou : relecture du repère (deux lectures par clé primaire) et renommage
+                cursor.execute(
+                    f"LOCK TABLES `{self.live}` WRITE, `{self.table}` WRITE, "
+                    f"`{self._generation_table}` READ, `{self._journal_table}` READ"
+                )
+                try:
+                    self._check_unchanged(cursor)
+                    cursor.execute(f"RENAME TABLE `{self.live}` TO `{old}`, `{self.table}` TO `{self.live}`")
+                finally:
+                    cursor.execute("UNLOCK TABLES")
+                cursor.execute(f"DROP TABLE `{old}`")
+                # Les clés étrangères (noms globaux au schéma) sont recréées une fois l'ancienne table supprimée ;
+                # vérifiées avant l'échange, elles sont ajoutées sans nouvelle vérification, en place, sans copie de la table
+                if self._foreign_keys:
+                    cursor.execute("SET foreign_key_checks = 0")
+                    try:
+                        cursor.execute(f"ALTER TABLE `{self.live}` " + ', '.join(
+                            f"ADD CONSTRAINT `{name}` FOREIGN KEY (`{column}`) "
+                            f"REFERENCES `{referenced_table}` (`{referenced_column}`)"
+                            for name, column, referenced_table, referenced_column in self._foreign_keys
+                        ))
+                    finally:
+                        cursor.execute("SET foreign_key_checks = 1")
+            else:
+                with transaction.atomic():
+                    self._check_unchanged(cursor)
+                    cursor.execute(f'DROP TABLE "{self.live}"')
+                    cursor.execute(f'ALTER TABLE "{self.table}" RENAME TO "{self.live}"')
+                    for index_sql in self._indexes:
+                        cursor.execute(index_sql)
+        logger.info(f"Table {self.live} remplacée en {time.time() - start_time:.2f}s")
+
+    def drop(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {self._quoted(self.table)}")
+
+    @property
+    def _generation_table(self):
+        from .models import DatasetGeneration
+        return DatasetGeneration._meta.db_table
+
+    @property
+    def _journal_table(self):
+        from .models import MetabolitePlantChange
+        return MetabolitePlantChange._meta.db_table
+
+    def _live_marker(self, cursor):
+        """
+        Repère des écritures sur les données live : génération du jeu de données (avancée par les
+        signaux et les imports) et dernier id du journal des présences, lus par clé primaire
+        """
+        cursor.execute(f"SELECT value FROM {self._quoted(self._generation_table)} WHERE id = 1")
+        row = cursor.fetchone()
+        cursor.execute(f"SELECT MAX(id) FROM {self._quoted(self._journal_table)}")
+        return row[0] if row else 0, cursor.fetchone()[0]
+
+    def _check_unchanged(self, cursor):
+        if self._live_marker(cursor) != self._marker:
+            raise LiveTableChanged(
+                f"Les données de {self.live} ont été modifiées pendant l'import : échange annulé, import à relancer"
+            )
+
+    def _check_foreign_keys(self, cursor):
+        """Lignes de la table chargée dont une clé étrangère ne référence aucune ligne"""
+        if self.vendor != 'mysql':
+            connection.check_constraints(table_names=[self.table])
+            return
+        for name, column, referenced_table, referenced_column in self._foreign_keys:
+            cursor.execute(f"""
+                SELECT COUNT(*)
+                FROM `{self.table}` s
+                LEFT JOIN `{referenced_table}` r ON r.`{referenced_column}` = s.`{column}`
+                WHERE s.`{column}` IS NOT NULL AND r.`{referenced_column}` IS NULL
+            """)
+            orphans = cursor.fetchone()[0]
+            if orphans:
+                raise IntegrityError(
+                    f"{orphans} ligne(s) de {self.table} sans correspondance dans {referenced_table} ({name})"
+                )
+
+    def _quoted(self, table):
+        return f'`{table}`' if self.vendor == 'mysql' else f'"{table}"'
+
+    def _mysql_secondary_indexes(self, cursor):
+        """{nom: [colonnes]} des index non uniques de la table de chargement"""
+        cursor.execute(f"SHOW INDEX FROM `{self.table}`")
+        names = [column[0] for column in cursor.description]
+        indexes = OrderedDict()
+        for row in cursor.fetchall():
+            index = dict(zip(names, row))
+            if not index['Non_unique']:
+                continue
+            column = f"`{index['Column_name']}`"
+            if index['Sub_part']:
+                column += f"({index['Sub_part']})"
+            indexes.setdefault(index['Key_name'], []).append(column)
+        return indexes
+
+    def _mysql_foreign_keys(self, cursor):
+        """Clés étrangères de la table live : (nom, colonne, table référencée, colonne référencée)"""
+        cursor.execute("""
+            SELECT constraint_name, column_name, referenced_table_name, referenced_column_name
+            FROM information_schema.key_column_usage
+            WHERE table_schema = DATABASE() AND table_name = %s AND referenced_table_name IS NOT NULL
+            ORDER BY constraint_name, ordinal_position
+        """, [self.live])
+        return cursor.fetchall()
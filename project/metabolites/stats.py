@@ -0,0 +1,198 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from acides_amines.utils import invalidate_amino_acid_matrix
+from .generation import deferred_generation
+
+logger = logging.getLogger('metabolites')
+
+# Nombre de plantes recalculées par requête
+CHUNK_SIZE = 500
+
+_state = threading.local()
+
+# Valeurs d'une instance (partie de plante) : high absent = low, instances sans valeur ignorées
+_CONCENTRATION_SQL = """
+    INSERT INTO metabolites_plantmetaboliteconcentration
+        (plant_id, metabolite_id, mean_concentration, min_concentration, max_concentration, parts_count)
+    SELECT
+        v.plant_id,
+        v.metabolite_id,
+        AVG(CASE WHEN v.high_value > 0 THEN (v.low_value + v.high_value) / 2.0 ELSE v.low_value END),
+        MIN(v.low_value),
+        MAX(CASE WHEN v.high_value > v.low_value THEN v.high_value ELSE v.low_value END),
+        COUNT(*)
+    FROM (
+        SELECT
+            mp.plant_id,
+            mp.metabolite_id,
+            COALESCE(mp.low, 0) AS low_value,
+            COALESCE(mp.high, CASE WHEN mp.low > 0 THEN mp.low ELSE 0 END) AS high_value
+        FROM metabolites_metaboliteplant mp
+        WHERE mp.plant_id IN ({placeholders})
+    ) v
+    WHERE v.low_value <> 0 OR v.high_value <> 0
+    GROUP BY v.plant_id, v.metabolite_id
+"""
+
+
+def refresh_plant_stats(plant_ids):
+    """
+    Recalcule les compteurs (PlantStats et PlantActivityStats) des plantes données.
+
+    Les plantes supprimées entre-temps sont ignorées.
+    """
+    from .models import Plant, PlantStats, PlantActivityStats
+
+    plant_ids = sorted({int(plant_id) for plant_id in plant_ids if plant_id is not None})
+    for start in range(0, len(plant_ids), CHUNK_SIZE):
+        chunk = plant_ids[start:start + CHUNK_SIZE]
+        placeholders = ', '.join(['%s'] * len(chunk))
+
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT
+                    mp.plant_id,
+                    COUNT(*),
+                    COUNT(DISTINCT mp.metabolite_id),
+                    COUNT(DISTINCT CASE WHEN m.is_ubiquitous = FALSE THEN mp.metabolite_id END)
+                FROM metabolites_metaboliteplant mp
+                JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
+                WHERE mp.plant_id IN ({placeholders})
+                GROUP BY mp.plant_id
+            """, chunk)
+            totals = {row[0]: row[1:] for row in cursor.fetchall()}
+
+            cursor.execute(f"""
+                SELECT
+                    mp.plant_id,
+                    ma.activity_id,
+                    COUNT(DISTINCT mp.metabolite_id),
+                    COUNT(DISTINCT CASE WHEN m.is_ubiquitous = FALSE THEN mp.metabolite_id END)
+                FROM metabolites_metaboliteplant mp
+                JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
+                JOIN metabolites_metaboliteactivity ma ON ma.metabolite_id = mp.metabolite_id
+                WHERE mp.plant_id IN ({placeholders})
+                GROUP BY mp.plant_id, ma.activity_id
+            """, chunk)
+            activity_rows = cursor.fetchall()
+
+        existing = set(Plant.objects.filter(id__in=chunk).values_list('id', flat=True))
+        with_stats = set(PlantStats.objects.filter(plant_id__in=chunk).values_list('plant_id', flat=True))
+
+        # Mise à jour en place : les compteurs de voisins (build_plant_pairs) sont conservés
+        now = timezone.now()
+        to_update, to_create = [], []
+        for plant_id in chunk:
+            if plant_id not in existing:
+                continue
+            total_rows, distinct_metabolites, distinct_non_ubiquitous = totals.get(plant_id, (0, 0, 0))
+            plant_stats = PlantStats(
+                plant_id=plant_id,
+                total_rows=total_rows,
+                distinct_metabolites=distinct_metabolites,
+                distinct_non_ubiquitous=distinct_non_ubiquitous,
+                updated_at=now,
+            )
+            (to_update if plant_id in with_stats else to_create).append(plant_stats)
+
+        with transaction.atomic():
+            PlantStats.objects.bulk_update(
+                to_update, ['total_rows', 'distinct_metabolites', 'distinct_non_ubiquitous', 'updated_at'], batch_size=1000
+            )
+            PlantStats.objects.bulk_create(to_create)
+
+            PlantActivityStats.objects.filter(plant_id__in=chunk).delete()
+            PlantActivityStats.objects.bulk_create([
+                PlantActivityStats(
+                    plant_id=plant_id,
+                    activity_id=activity_id,
+                    distinct_metabolites=distinct_metabolites,
+                    distinct_non_ubiquitous=distinct_non_ubiquitous,
+                )
+                for plant_id, activity_id, distinct_metabolites, distinct_non_ubiquitous in activity_rows
+                if plant_id in existing
+            ], batch_size=1000)
+
+        logger.debug(f"Compteurs recalculés pour {len(chunk)} plante(s)")
+
+
+def refresh_plant_concentrations(plant_ids):
+    """Recalcule les concentrations agrégées (PlantMetaboliteConcentration) des plantes données"""
+    plant_ids = sorted({int(plant_id) for plant_id in plant_ids if plant_id is not None})
+    for start in range(0, len(plant_ids), CHUNK_SIZE):
+        chunk = plant_ids[start:start + CHUNK_SIZE]
+        placeholders = ', '.join(['%s'] * len(chunk))
+
+        # Les plantes supprimées n'ont plus de lignes MetabolitePlant : rien n'est réinséré
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM metabolites_plantmetaboliteconcentration WHERE plant_id IN ({placeholders})", chunk
+            )
+            cursor.execute(_CONCENTRATION_SQL.format(placeholders=placeholders), chunk)
+
+        logger.debug(f"Concentrations recalculées pour {len(chunk)} plante(s)")
+    invalidate_amino_acid_matrix()
+
+
+def plants_with_metabolites(metabolite_ids):
+    """Plantes contenant au moins un des métabolites donnés (compteurs à recalculer après un import en masse)"""
+    from .models import MetabolitePlant
+
+    metabolite_ids = sorted(set(metabolite_ids))
+    plant_ids = set()
+    for start in range(0, len(metabolite_ids), CHUNK_SIZE):
+        plant_ids.update(
+            MetabolitePlant.objects.filter(metabolite_id__in=metabolite_ids[start:start + CHUNK_SIZE], plant__isnull=False)
+            .values_list('plant_id', flat=True).distinct()
+        )
+    return plant_ids
+
+
+def schedule_plant_stats(plant_ids):
+    """Recalcule immédiatement, ou en fin de bloc deferred_plant_stats() s'il est actif"""
+    pending = getattr(_state, 'pending', None)
+    if pending is not None:
+        pending.update(plant_id for plant_id in plant_ids if plant_id is not None)
+    else:
+        refresh_plant_stats(plant_ids)
+
+
+def schedule_plant_concentrations(plant_ids):
+    """Recalcule immédiatement, ou en fin de bloc deferred_plant_stats() s'il est actif"""
+    pending = getattr(_state, 'pending_concentrations', None)
+    if pending is not None:
+        pending.update(plant_id for plant_id in plant_ids if plant_id is not None)
+    else:
+        refresh_plant_concentrations(plant_ids)
+
+
+@contextmanager
+def deferred_plant_stats():
+    """
+    Regroupe les recalculs déclenchés par les signaux (imports ligne à ligne) :
+    chaque plante touchée n'est recalculée qu'une fois, en sortie de bloc, puis
+    la génération du jeu de données n'est incrémentée qu'une fois.
+    """
+    if getattr(_state, 'pending', None) is not None:
+        yield
+        return
+
+    with deferred_generation():
+        _state.pending = set()
+        _state.pending_concentrations = set()
+        try:
+            yield
+        finally:
+            pending, _state.pending = _state.pending, None
+            pending_concentrations, _state.pending_concentrations = _state.pending_concentrations, None
+            if pending:
+                logger.info(f"Recalcul différé des compteurs de {len(pending)} plante(s)")
+                refresh_plant_stats(pending)
+            if pending_concentrations:
+                logger.info(f"Recalcul différé des concentrations de {len(pending_concentrations)} plante(s)")
+                refresh_plant_concentrations(pending_concentrations)
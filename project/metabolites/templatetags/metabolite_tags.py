@@ -10,5 +10,5 @@ def get_metabolites_count(plant_name):
     Retourne le nombre de métabolites uniques pour une plante donnée
     """
     return MetabolitePlant.objects.filter(
-        plant_name=plant_name
+        plant__name=plant_name
     ).values('metabolite__name').distinct().count() 
\ No newline at end of file
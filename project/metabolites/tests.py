@@ -1,3 +1,883 @@
-from django.test import TestCase
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from io import StringIO
+from itertools import product
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.apps.registry import Apps
+from django.core.cache import caches
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.management import call_command
+from django.db import IntegrityError, connection, models, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from . import incidence
+from .generation import bump_generation, cached_for_generation, current_generation
+from .incidence import IncidenceEngine
+from .pairs import PAIR_SORT_FIELDS
+from .models import (
+    AccessCount, Activity, Metabolite, MetaboliteActivity, MetabolitePlant, MetabolitePlantChange, Plant,
+    PlantActivityStats, PlantMetaboliteConcentration, PlantPairStats, PlantStats,
+)
+from .staging import LiveTableChanged, StagingTable
+from .stats import deferred_plant_stats, refresh_plant_concentrations, refresh_plant_stats
+from accounts.models import CustomUser
+from project.cache import _fill_across_workers, _file_lock_path, acquire_lock, release_lock, single_flight
+from remedes.models import Remede
+from tabs_numbering.models import PlantNumbering
+
+# Cache des tests en mémoire : les résultats ne sont pas écrits dans le cache partagé (CACHE_DIR)
+TEST_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def sqlite_temporary_tables(execute, sql, params, many, context):
+    """SQLite n'a pas DROP TEMPORARY TABLE (MySQL) : réécrit en DROP TABLE pour la version SQL"""
+    return execute(sql.replace('DROP TEMPORARY TABLE', 'DROP TABLE'), params, many, context)
+
+
+def create_dataset(plants=30, metabolites=40, activities=3, seed=0):
+    """
+    Jeu de données aléatoire reproductible : plusieurs parties de plante par métabolite,
+    métabolites ubiquitaires, activités et concentrations, compteurs PlantStats à jour.
+    Noms en minuscules : même ordre alphabétique en SQL (collation) et en mémoire.
+    """
+    rng = random.Random(seed)
+    plant_objects = Plant.objects.bulk_create([Plant(name=f"plante {index:03d}") for index in range(plants)])
+    metabolite_objects = Metabolite.objects.bulk_create([
+        Metabolite(name=f"metabolite {index:03d}", is_ubiquitous=index % 7 == 0) for index in range(metabolites)
+    ])
+    activity_objects = Activity.objects.bulk_create([Activity(name=f"activite {index}") for index in range(activities)])
+    MetaboliteActivity.objects.bulk_create([
+        MetaboliteActivity(metabolite=metabolite, activity=activity)
+        for metabolite in metabolite_objects for activity in activity_objects if rng.random() < 0.3
+    ])
+    rows = []
+    for plant in plant_objects:
+        for metabolite in rng.sample(metabolite_objects, rng.randint(0, metabolites // 2)):
+            for part in rng.sample(['feuille', 'racine', 'fleur'], rng.randint(1, 2)):
+                low = Decimal(rng.randint(0, 500)) if rng.random() < 0.8 else None
+                high = low + rng.randint(0, 100) if low is not None and rng.random() < 0.5 else None
+                rows.append(MetabolitePlant(
+                    metabolite=metabolite, plant=plant, plant_name=plant.name, plant_part=part, low=low, high=high,
+                ))
+    MetabolitePlant.objects.bulk_create(rows)
+    plant_ids = [plant.id for plant in plant_objects]
+    refresh_plant_stats(plant_ids)
+    refresh_plant_concentrations(plant_ids)
+    return plant_objects, metabolite_objects, activity_objects
+
+
+def sort_value(row, field):
+    """Valeur d'un champ de tri calculée depuis une ligne, comme les clauses ORDER BY de la version SQL"""
+    common = row['common_metabolites_count']
+    total = row['metabolites_total']
+    reference = row['reference_count']
+    if field == 'name':
+        return row['name']
+    if field == 'common_metabolites':
+        return common
+    if field == 'common_percentage':
+        if reference >= total:
+            return round(common * 100.0 / total, 6)
+        return round(common * 100.0 / reference, 6) if reference else None
+    if field == 'meta_percentage_score':
+        return round(common * common / total, 6)
+    if field == 'meta_root_score':
+        return round(common ** 0.5 * common / total, 6)
+    if field == 'common_activity_metabolites':
+        return row['common_activity_metabolites_count']
+    if field == 'total_activity_metabolites':
+        return row['total_activity_metabolites_count']
+    if field == 'total_concentration':
+        return round(float(row['total_concentration']), 6)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class IncidenceEngineTests(TestCase):
+    """Le moteur d'incidence retourne les mêmes lignes que la version SQL de Plant.get_common_plants"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.plants, cls.metabolites, cls.activities = create_dataset()
+
+    def compare(self, plant, sort_params=None, **query_args):
+        engine = IncidenceEngine()
+        with connection.execute_wrapper(sqlite_temporary_tables):
+            expected, expected_total, expected_reference = plant._get_common_plants_sql(
+                page=1, per_page=1000, sort_params=sort_params, **query_args
+            )
+        results, total_count, reference_count = engine.common_plants(
+            plant.id, page=1, per_page=1000, sort_params=sort_params, **query_args
+        )
+
+        message = f"{plant.name} {sort_params} {query_args}"
+        self.assertEqual((total_count, reference_count), (expected_total, expected_reference), message)
+
+        # Mêmes lignes et mêmes comptages
+        def by_id(rows):
+            return {
+                row['id']: {
+                    key: round(float(value), 6) if key == 'total_concentration' else value
+                    for key, value in row.items()
+                }
+                for row in rows
+            }
+        self.assertEqual(by_id(results), by_id(expected), message)
+
+        # Même ordre, aux égalités près (l'ordre des ex aequo n'est pas fixé en SQL)
+        fields = [field for field, _ in sort_params or []]
+        if not fields:
+            fields = ['common_activity_metabolites', 'common_metabolites'] if query_args.get('activity_filter') else ['common_metabolites']
+
+        def keys(rows):
+            return [tuple(sort_value(row, field) for field in fields) for row in rows]
+        self.assertEqual(keys(results), keys(expected), message)
+        return len(results)
+
+    def test_same_rows_as_sql(self):
+        activity = self.activities[0].name
+        sorts = [
+            None,
+            [('name', 'asc')],
+            [('common_percentage', 'desc'), ('name', 'asc')],
+            [('meta_percentage_score', 'desc'), ('name', 'desc')],
+            [('meta_root_score', 'asc'), ('name', 'asc')],
+            [('common_metabolites', 'asc'), ('name', 'asc')],
+        ]
+        activity_sorts = [
+            [('common_activity_metabolites', 'desc'), ('name', 'asc')],
+            [('total_activity_metabolites', 'asc'), ('name', 'asc')],
+            [('total_concentration', 'desc'), ('name', 'asc')],
+        ]
+        searches = [('', 'contains'), ('1', 'contains'), ('plante 00', 'starts_with')]
+        metabolite_filters = [None, [self.metabolites[1].id], [self.metabolites[1].id, self.metabolites[2].id]]
+
+        compared = 0
+        for plant in self.plants[:4]:
+            for activity_filter, exclude_ubiquitous, (search_text, search_type), filters in product(
+                [None, activity], [False, True], searches, metabolite_filters
+            ):
+                for sort_params in sorts + (activity_sorts if activity_filter else []):
+                    compared += self.compare(
+                        plant, sort_params=sort_params, activity_filter=activity_filter,
+                        exclude_ubiquitous=exclude_ubiquitous, search_text=search_text, search_type=search_type,
+                        metabolite_filters=filters,
+                    )
+        self.assertGreater(compared, 0)
+
+    def test_same_rows_without_stats(self):
+        """Compteurs matérialisés absents (non calculés) : comptage direct, mêmes lignes"""
+        activity = self.activities[0]
+        query_args = [
+            dict(activity_filter=activity_filter, exclude_ubiquitous=exclude_ubiquitous, sort_params=sort_params)
+            for activity_filter, exclude_ubiquitous, sort_params in product(
+                [None, activity.name], [False, True], [None, [('common_percentage', 'desc'), ('name', 'asc')]]
+            )
+        ]
+
+        def snapshot():
+            results = []
+            with connection.execute_wrapper(sqlite_temporary_tables), connection.cursor() as cursor:
+                for plant in self.plants[:3]:
+                    for args in query_args:
+                        results.append(plant._get_common_plants_sql(page=1, per_page=1000, **args))
+                for search in ['', '1']:
+                    results.append(activity._count_plants_sql(
+                        cursor, " AND p.name LIKE %s" if search else '', [f"%{search}%"] if search else []
+                    ))
+            return results
+
+        expected = snapshot()
+        self.assertGreater(len(expected[0][0]), 0)
+        # Compteurs calculés pour la seule première plante, puis pour aucune
+        PlantStats.objects.filter(plant__in=self.plants[1:]).delete()
+        PlantActivityStats.objects.filter(plant__in=self.plants[1:]).delete()
+        self.assertEqual(snapshot(), expected)
+        PlantStats.objects.all().delete()
+        PlantActivityStats.objects.all().delete()
+        self.assertEqual(snapshot(), expected)
+
+    def test_metabolite_added_during_load(self):
+        """Métabolite créé (dans un trou d'IDs) entre la lecture des métabolites et celle des associations"""
+        plant = self.plants[0]
+        gap = Metabolite.objects.create(name="metabolite supprime")
+        gap_id = gap.id
+        gap.delete()
+        Metabolite.objects.create(name="metabolite suivant")
+        expected = IncidenceEngine()
+
+        def add_metabolite(execute, sql, params, many, context):
+            if "FROM metabolites_metaboliteplant" in sql and not Metabolite.objects.filter(id=gap_id).exists():
+                metabolite = Metabolite.objects.create(id=gap_id, name="metabolite concurrent")
+                MetabolitePlant.objects.create(metabolite=metabolite, plant=plant, plant_part="feuille")
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(add_metabolite):
+            engine = IncidenceEngine()
+
+        # Association ignorée, et non comptée pour le métabolite de la colonne suivante
+        row, expected_row = engine.plant_rows[plant.id], expected.plant_rows[plant.id]
+        self.assertEqual(list(engine.metabolite_ids), list(expected.metabolite_ids))
+        self.assertEqual(engine.presence[row].indices.tolist(), expected.presence[expected_row].indices.tolist())
+        self.assertEqual(engine.totals_all.tolist(), expected.totals_all.tolist())
+
+    def test_no_common_plants(self):
+        self.compare(Plant(id=0, name="absente"))
+        self.compare(self.plants[0], activity_filter=self.activities[0].name, search_text="aucune plante")
+
+    def test_engine_reloaded_in_background(self):
+        """Une nouvelle génération ne recharge pas la matrice dans l'appel : None et chargement en arrière-plan"""
+        incidence.invalidate_incidence_engine()
+        engine = incidence.get_incidence_engine(wait=True)
+        self.assertEqual(engine.generation, current_generation())
+        with mock.patch.object(incidence, '_load_in_background') as load_in_background:
+            self.assertIs(incidence.get_incidence_engine(), engine)
+            load_in_background.assert_not_called()
+
+            bump_generation()
+            self.assertIsNone(incidence.get_incidence_engine())
+            load_in_background.assert_called_once_with(current_generation())
+        incidence.invalidate_incidence_engine()
+
+    def test_generation_read_once_per_cached_computation(self):
+        """Pendant le calcul d'une valeur en cache, la génération est celle de la clé, sans requête"""
+        def compute():
+            with self.assertNumQueries(0):
+                return current_generation()
+        self.assertEqual(cached_for_generation('test_generation', compute), current_generation())
+
+
+@override_settings(CACHES=TEST_CACHES)
+class BackfillPlantForeignKeyTests(TransactionTestCase):
+    """
+    Mise à jour d'une base d'origine (noms de plantes en double, ni clé plant ni tables ajoutées) :
+    backfill_plant_fk avant migrate fusionne les doublons, puis après l'ajout de la clé plant
+    nullable la renseigne ; la migration suivante rend la colonne NOT NULL.
+    """
+
+    # Modèles du schéma d'origine : les autres tables sont créées par les migrations
+    BASELINE_MODELS = (Metabolite, Activity, Plant, MetaboliteActivity, MetabolitePlant)
+
+    def setUp(self):
+        self.added_models = [
+            model for model in apps.get_app_config('metabolites').get_models()
+            if model._meta.managed and model not in self.BASELINE_MODELS
+        ]
+        self.baseline_name = models.CharField(max_length=200, db_index=True)
+        self.baseline_name.set_attributes_from_name('name')
+        self.baseline_name.model = Plant
+        # Clé plant telle qu'ajoutée par la première migration, avant le remplissage
+        name, path, args, kwargs = MetabolitePlant._meta.get_field('plant').deconstruct()
+        self.nullable_plant = models.ForeignKey(*args, **{**kwargs, 'to': Plant, 'null': True})
+        self.nullable_plant.set_attributes_from_name('plant')
+        self.nullable_plant.model = MetabolitePlant
+
+        # Associations d'origine (sans clé plant), dans un registre de modèles isolé
+        class BaselineMetabolitePlant(models.Model):
+            metabolite_id = models.IntegerField()
+            plant_name = models.CharField(max_length=255, db_index=True)
+            plant_part = models.CharField(max_length=255)
+            low = models.DecimalField(max_digits=10, decimal_places=1, blank=True, null=True)
+            high = models.DecimalField(max_digits=10, decimal_places=1, blank=True, null=True)
+            deviation = models.DecimalField(max_digits=10, decimal_places=1, blank=True, null=True)
+            reference = models.CharField(max_length=255, blank=True, null=True)
+
+            class Meta:
+                apps = Apps()
+                app_label = 'metabolites'
+                db_table = MetabolitePlant._meta.db_table
+
+        with connection.schema_editor() as editor:
+            for model in self.added_models:
+                editor.delete_model(model)
+            editor.delete_model(MetabolitePlant)
+            editor.create_model(BaselineMetabolitePlant)
+            editor.alter_field(Plant, Plant._meta.get_field('name'), self.baseline_name)
+        self.migrated = False
+        self.addCleanup(self.restore_schema)
+
+    def restore_schema(self):
+        """Schéma complet pour les tests suivants, même si le test a échoué avant la fusion"""
+        if not self.migrated:
+            with connection.cursor() as cursor:
+                for model in (Remede.plants.through, Remede, PlantNumbering, MetabolitePlant, Plant):
+                    cursor.execute(f"DELETE FROM {model._meta.db_table}")
+        self.migrate()
+        self.migrate_not_null()
+
+    def migrate(self):
+        """Schéma après migrate (contrainte unique sur Plant.name, clé plant nullable, nouvelles tables)"""
+        if self.migrated:
+            return
+        with connection.schema_editor() as editor:
+            editor.alter_field(Plant, self.baseline_name, Plant._meta.get_field('name'))
+            editor.add_field(MetabolitePlant, self.nullable_plant)
+            for model in self.added_models:
+                editor.create_model(model)
+        self.migrated = True
+        self.not_null = False
+
+    def migrate_not_null(self):
+        """Migration suivant le remplissage : clé plant NOT NULL"""
+        if self.not_null:
+            return
+        with connection.schema_editor() as editor:
+            editor.alter_field(MetabolitePlant, self.nullable_plant, MetabolitePlant._meta.get_field('plant'))
+        self.not_null = True
+
+    def test_merge_before_migrate_then_backfill(self):
+        first, translated, third, other = Plant.objects.bulk_create([
+            Plant(name="aloe vera"), Plant(name="aloe vera", french_name="Aloès"), Plant(name="aloe vera"),
+            Plant(name="malus domestica"),
+        ])
+        metabolite, = Metabolite.objects.bulk_create([Metabolite(name="aloine")])
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO metabolites_metaboliteplant (metabolite_id, plant_name, plant_part) VALUES (%s, %s, %s)",
+                [(metabolite.id, "aloe vera", "feuille"), (metabolite.id, "malus domestica", "fruit"),
+                 (metabolite.id, "ficus carica", "fruit")]
+            )
+        user = CustomUser.objects.create_user(email="test@example.com", username="test")
+        remede = Remede.objects.create(name="remède", target_plant=translated, created_by=user)
+        remede.plants.set([translated, third])
+        other_remede = Remede.objects.create(name="autre remède", target_plant=other, created_by=user)
+        other_remede.plants.set([first, third, other])
+        numbering = PlantNumbering.objects.create(
+            user=user, name="numérotation", plant_id=third.id, query_params="{}", numbering_data={}
+        )
+
+        # Avant migrate : seule la fusion, sans toucher aux tables qui n'existent pas encore
+        output = StringIO()
+        call_command('backfill_plant_fk', stdout=output)
+        self.assertNotIn("Erreur", output.getvalue())
+        self.assertIn("Plantes en double fusionnées : 2", output.getvalue())
+
+        self.assertEqual(list(Plant.objects.order_by('id').values_list('id', 'name', 'french_name')), [
+            (first.id, "aloe vera", "Aloès"), (other.id, "malus domestica", None),
+        ])
+        remede.refresh_from_db()
+        self.assertEqual(remede.target_plant_id, first.id)
+        self.assertEqual(set(remede.plants.values_list('id', flat=True)), {first.id})
+        self.assertEqual(set(other_remede.plants.values_list('id', flat=True)), {first.id, other.id})
+        numbering.refresh_from_db()
+        self.assertEqual(numbering.plant_id, first.id)
+
+        # Après migrate : la contrainte unique passe et la clé plant est renseignée
+        self.migrate()
+        output = StringIO()
+        call_command('backfill_plant_fk', stdout=output)
+        self.assertNotIn("Erreur", output.getvalue())
+
+        ficus = Plant.objects.get(name="ficus carica")
+        self.assertEqual(
+            dict(MetabolitePlant.objects.values_list('plant_name', 'plant_id')),
+            {"aloe vera": first.id, "malus domestica": other.id, "ficus carica": ficus.id},
+        )
+        self.assertEqual(PlantStats.objects.get(plant=first).distinct_metabolites, 1)
+
+        # Colonne remplie : la migration NOT NULL s'applique, une association sans plante est refusée
+        self.migrate_not_null()
+        with self.assertRaises(IntegrityError), connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO metabolites_metaboliteplant (metabolite_id, plant_name, plant_part) VALUES (%s, %s, %s)",
+                [metabolite.id, "sans plante", "feuille"]
+            )
+
+
+@override_settings(CACHES=TEST_CACHES)
+class MetabolitePlantSaveTests(TestCase):
+    def test_plant_required(self):
+        metabolite = Metabolite.objects.create(name="aloine")
+        # Refusée par la contrainte NOT NULL, aussi pour les écritures en masse
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            MetabolitePlant.objects.bulk_create([MetabolitePlant(metabolite=metabolite, plant_name="aloe vera")])
+        self.assertFalse(Plant.objects.filter(name="aloe vera").exists())
+
+    def test_plant_name_copied_from_plant(self):
+        metabolite = Metabolite.objects.create(name="aloine")
+        plant = Plant.objects.create(name="aloe vera")
+        row = MetabolitePlant.objects.create(metabolite=metabolite, plant=plant, plant_name="ancien nom", plant_part="feuille")
+        self.assertEqual(row.plant_name, "aloe vera")
+
+
+@override_settings(CACHES=TEST_CACHES)
+class PrecomputedNeighboursTests(TestCase):
+    """Voisins précalculés (build_plant_pairs) : mêmes pages que le classement à la demande, jusqu'au top-K"""
+
+    @classmethod
+    def setUpTestData(cls):
+        create_dataset(plants=40, metabolites=12)
+        call_command('build_plant_pairs', top_k=5, workers=1, stdout=StringIO())
+        cls.plants = list(Plant.objects.select_related('stats').order_by('id'))
+
+    def test_pages_match_candidates(self):
+        engine = IncidenceEngine()
+        compared = 0
+        for plant in self.plants:
+            if plant.id not in engine.plant_rows:
+                # Plante sans métabolite : pas de voisins précalculés
+                self.assertIsNone(plant.get_precomputed_common_plants())
+                continue
+            for exclude_ubiquitous, field in product([False, True], [None] + list(PAIR_SORT_FIELDS)):
+                sort_params = [(field, 'desc')] if field else None
+                precomputed = plant.get_precomputed_common_plants(
+                    page=1, per_page=5, sort_params=sort_params, exclude_ubiquitous=exclude_ubiquitous
+                )
+                candidates = engine.candidates(plant.id, exclude_ubiquitous=exclude_ubiquitous)
+                expected = Plant.common_plants_page(candidates, candidates.page(sort_params, 1, 5), 1, 5)
+                self.assertEqual(precomputed, expected, f"{plant.name} {sort_params} {exclude_ubiquitous}")
+                compared += len(expected['results'])
+        self.assertGreater(compared, 0)
+
+    def test_pages_beyond_stored_top_k(self):
+        plant = max(self.plants, key=lambda plant: plant.stats.neighbours_count or 0)
+        self.assertEqual(plant.stats.neighbours_top_k, 5)
+        self.assertGreater(plant.stats.neighbours_count, 5)
+        self.assertIsNotNone(plant.get_precomputed_common_plants(page=1, per_page=5))
+        self.assertIsNone(plant.get_precomputed_common_plants(page=2, per_page=5))
+        self.assertIsNone(plant.get_precomputed_common_plants(page=1, per_page=6))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class PairChangesTests(TestCase):
+    """Le journal rejoué par apply_pair_changes donne les mêmes voisins qu'un build_plant_pairs complet"""
+
+    def snapshot(self):
+        pairs = sorted(
+            (plant_id, neighbour_id, exclude_ubiquitous, common_count, plant_total, neighbour_total,
+             round(percentage, 6), round(meta_score, 6), round(root_score, 6))
+            for plant_id, neighbour_id, exclude_ubiquitous, common_count, plant_total, neighbour_total,
+            percentage, meta_score, root_score in PlantPairStats.objects.values_list(
+                'plant_id', 'neighbour_id', 'exclude_ubiquitous', 'common_count', 'plant_total', 'neighbour_total',
+                'common_percentage', 'meta_percentage_score', 'meta_root_score',
+            )
+        )
+        counts = sorted(
+            PlantStats.objects.filter(neighbours_computed_at__isnull=False)
+            .values_list('plant_id', 'neighbours_count', 'neighbours_count_non_ubiquitous', 'neighbours_top_k')
+        )
+        return pairs, counts
+
+    def test_replay_matches_full_build(self):
+        rng = random.Random(1)
+        plants, metabolites, _ = create_dataset(plants=30, metabolites=16)
+        call_command('build_plant_pairs', top_k=4, workers=1, stdout=StringIO())
+
+        # Modifications ligne à ligne (signaux) : ajouts, suppressions, ubiquité, plante ajoutée
+        for _ in range(25):
+            plant, metabolite = rng.choice(plants), rng.choice(metabolites)
+            MetabolitePlant.objects.create(metabolite=metabolite, plant=plant, plant_part='tige')
+        rows = list(MetabolitePlant.objects.order_by('id'))
+        for row in rng.sample(rows, 40):
+            row.delete()
+        for metabolite in metabolites[:3]:
+            metabolite.is_ubiquitous = not metabolite.is_ubiquitous
+            metabolite.save()
+        new_plant = Plant.objects.create(name="plante nouvelle")
+        for metabolite in rng.sample(metabolites, 6):
+            MetabolitePlant.objects.create(metabolite=metabolite, plant=new_plant, plant_part='feuille')
+        self.assertTrue(MetabolitePlantChange.objects.exists())
+
+        call_command('apply_pair_changes', stdout=StringIO())
+        self.assertFalse(MetabolitePlantChange.objects.exists())
+        replayed = self.snapshot()
+
+        call_command('build_plant_pairs', top_k=4, workers=1, stdout=StringIO())
+        rebuilt = self.snapshot()
+        self.assertGreater(len(rebuilt[0]), 0)
+        self.assertEqual(replayed, rebuilt)
+        # Plante ajoutée après le calcul complet : voisins calculés au top-K de ce calcul
+        self.assertEqual(PlantStats.objects.get(plant=new_plant).neighbours_top_k, 4)
+
+
+class SharedCacheTests(TestCase):
+    """Cache à deux niveaux devant un cache fichiers, verrous entre workers et single_flight"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        override = override_settings(CACHES={
+            'default': {
+                'BACKEND': 'project.cache.TwoTierCache',
+                'LOCATION': 'tests',
+                'OPTIONS': {'SHARED_ALIAS': 'shared'},
+            },
+            'shared': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': directory,
+            },
+        })
+        override.enable()
+        self.addCleanup(override.disable)
+        self.cache = caches['default']
+        self.cache.clear_local()
+
+    def local_keys(self):
+        return list(self.cache._store.entries)
+
+    def test_shared_values_served_locally(self):
+        self.cache.set('tiers:1', [1, 2])
+        self.cache.clear_local()
+        self.assertEqual(caches['shared'].get('tiers:1'), [1, 2])
+        self.assertEqual(self.cache.get('tiers:1'), [1, 2])
+        self.assertEqual(self.cache.get('tiers:1'), [1, 2])
+        self.assertEqual(self.cache.stats()['namespaces']['tiers'], {
+            'local_hits': 1, 'shared_hits': 1, 'misses': 0, 'sets': 1,
+        })
+
+        # Suppression retirée des deux niveaux
+        self.cache.delete('tiers:1')
+        self.assertIsNone(self.cache.get('tiers:1'))
+
+    def test_file_lock_is_exclusive(self):
+        token = acquire_lock(self.cache, 'plants:1:lock', 60)
+        self.assertTrue(token)
+        self.assertIsNone(acquire_lock(self.cache, 'plants:1:lock', 60))
+        self.assertEqual(self.local_keys(), [])
+
+        # Un autre jeton (verrou expiré puis repris) ne retire pas le verrou
+        release_lock(self.cache, 'plants:1:lock', 'other')
+        self.assertIsNone(acquire_lock(self.cache, 'plants:1:lock', 60))
+        release_lock(self.cache, 'plants:1:lock', token)
+        token = acquire_lock(self.cache, 'plants:1:lock', 60)
+        self.assertTrue(token)
+
+        # Verrou expiré (worker arrêté pendant le calcul) : repris
+        path = _file_lock_path(caches['shared'], 'plants:1:lock')
+        os.utime(path, (time.time() - 120, time.time() - 120))
+        self.assertTrue(acquire_lock(self.cache, 'plants:1:lock', 60))
+
+    def test_concurrent_workers_compute_once(self):
+        calls = []
+        barrier = threading.Barrier(8)
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'value': 42}
+
+        def worker():
+            barrier.wait()
+            # Sans le single-flight du processus : chaque thread se comporte comme un worker distinct
+            return _fill_across_workers(self.cache, 'plants:2', compute, 60, lock_timeout=10, wait_interval=0.01)
+
+        # FileBasedCache.add lit puis écrit le fichier : fenêtre élargie pour que la course se produise
+        has_key = FileBasedCache.has_key
+
+        def slow_has_key(cache, *args, **kwargs):
+            result = has_key(cache, *args, **kwargs)
+            time.sleep(0.05)
+            return result
+
+        with mock.patch.object(FileBasedCache, 'has_key', slow_has_key), ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda _: worker(), range(8)))
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'value': 42}] * 8)
+        self.assertNotIn('plants:2:lock', [key.split(':', 2)[-1] for key in self.local_keys()])
+        self.assertEqual([name for name in os.listdir(caches['shared']._dir) if name.endswith('.lock')], [])
+
+    def test_single_flight_computes_once(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return len(calls)
+
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            results = list(executor.map(lambda _: single_flight('plants:3', compute, 60), range(6)))
+        self.assertEqual(results, [1] * 6)
+        self.assertEqual(single_flight('plants:3', compute, 60), 1)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([key for key in self.local_keys() if key.endswith(':lock')], [])
+
+
+@override_settings(CACHES=TEST_CACHES, ACCESS_COUNT_SAMPLING=10)
+class AccessCountTests(TestCase):
+    """Consultations comptées par échantillonnage, sans perte lors de la création concurrente de la ligne"""
+
+    def test_unsampled_access_not_written(self):
+        with mock.patch('metabolites.models.random.random', return_value=0.5), self.assertNumQueries(0):
+            AccessCount.record(AccessCount.KIND_PLANT, 1)
+        self.assertFalse(AccessCount.objects.exists())
+
+    def test_sampled_access_weighted(self):
+        with mock.patch('metabolites.models.random.random', return_value=0.05):
+            AccessCount.record(AccessCount.KIND_PLANT, 1)
+            with self.assertNumQueries(1):
+                AccessCount.record(AccessCount.KIND_PLANT, 1)
+        self.assertEqual(AccessCount.objects.get(kind=AccessCount.KIND_PLANT, object_id=1).count, 20)
+
+    def test_row_created_concurrently(self):
+        get_or_create = AccessCount.objects.get_or_create
+
+        def concurrent_get_or_create(**kwargs):
+            # Une autre requête crée la ligne entre l'UPDATE (0 ligne) et get_or_create
+            AccessCount.objects.create(kind=AccessCount.KIND_REMEDE, object_id=3, count=10)
+            return get_or_create(**kwargs)
+
+        with mock.patch('metabolites.models.random.random', return_value=0.0), \
+                mock.patch.object(AccessCount.objects, 'get_or_create', concurrent_get_or_create):
+            AccessCount.record(AccessCount.KIND_REMEDE, 3)
+        self.assertEqual(AccessCount.objects.get(kind=AccessCount.KIND_REMEDE, object_id=3).count, 20)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class TransfertPlantsTests(TestCase):
+    """Import plantes-métabolites : noms de plantes et de métabolites rapprochés sans tenir compte de la casse"""
+
+    ROWS = [
+        "chemical,plant,part,low,high,deviation,reference",
+        "Metabolite 1,Plante A,feuille,1,2,0,r1",
+        "metabolite 2,PLANTE A,racine,not available,not available,not available,r2",
+        "metabolite 1,Plante B,feuille,3,,,r3",
+        "METABOLITE 2,plante b,fleur,4,5,,r4",
+        "inconnu,Plante B,feuille,1,1,1,r5",
+    ]
+
+    def setUp(self):
+        self.plant = Plant.objects.create(name="plante a")
+        Metabolite.objects.bulk_create([Metabolite(name="metabolite 1"), Metabolite(name="metabolite 2")])
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = os.path.join(directory, 'plants.csv')
+        with open(self.path, 'w', encoding='latin-1') as f:
+            f.write('\n'.join(self.ROWS) + '\n')
+
+    def import_file(self, *args):
+        output = StringIO()
+        call_command('transfert_plants', '--file', self.path, '--workers', '1', *args, stdout=output)
+        return output.getvalue()
+
+    def check_import(self, output):
+        self.assertIn("Nouvelles plantes créées : 1\n", output)
+        self.assertIn("Métabolites non trouvés : 1\n", output)
+        self.assertEqual(sorted(Plant.objects.values_list('name', flat=True)), ["Plante B", "plante a"])
+        self.assertEqual(sorted(MetabolitePlant.objects.values_list('plant_name', 'plant_part', 'metabolite__name')), [
+            ("Plante B", "feuille", "metabolite 1"),
+            ("Plante B", "fleur", "metabolite 2"),
+            ("plante a", "feuille", "metabolite 1"),
+            ("plante a", "racine", "metabolite 2"),
+        ])
+        self.assertEqual(PlantStats.objects.get(plant=self.plant).distinct_metabolites, 2)
+
+    def test_full_import(self):
+        self.check_import(self.import_file())
+
+    def test_staging_import(self):
+        # L'import n'avance pas lui-même le repère des écritures avant l'échange
+        self.check_import(self.import_file('--staging'))
+
+    def test_incremental_import(self):
+        self.check_import(self.import_file('--incremental'))
+        output = self.import_file('--incremental')
+        self.assertIn("Lignes inchangées depuis le dernier import : 4\n", output)
+        self.assertIn("Nouvelles plantes créées : 0\n", output)
+
+    def test_incremental_case_change(self):
+        self.import_file('--incremental')
+        row_ids = sorted(MetabolitePlant.objects.values_list('id', flat=True))
+
+        # Même fichier à la casse près : ni suppression ni insertion
+        with open(self.path, 'w', encoding='latin-1') as f:
+            f.write('\n'.join(self.ROWS).replace("Metabolite 1,Plante A", "METABOLITE 1,plante a") + '\n')
+        output = self.import_file('--incremental')
+        self.assertIn("Associations plantes-métabolites créées : 0\n", output)
+        self.assertIn("Associations supprimées (absentes du fichier) : 0\n", output)
+        self.assertIn("Lignes inchangées depuis le dernier import : 3\n", output)
+        self.assertEqual(sorted(MetabolitePlant.objects.values_list('id', flat=True)), row_ids)
+
+        # L'empreinte du contenu suit la nouvelle orthographe
+        output = self.import_file('--incremental')
+        self.assertIn("Lignes inchangées depuis le dernier import : 4\n", output)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class TransfertActivitiesUbiTests(TestCase):
+    """Imports des activités et de l'ubiquité : noms rapprochés sans tenir compte de la casse"""
+
+    def setUp(self):
+        self.metabolite = Metabolite.objects.create(name="metabolite 1")
+        Activity.objects.create(name="Antioxydant")
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def import_file(self, command, lines):
+        path = os.path.join(self.directory, f'{command}.csv')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        output = StringIO()
+        call_command(command, '--file', path, '--workers', '1', stdout=output)
+        return output.getvalue()
+
+    def test_activity_types_case_insensitive(self):
+        output = self.import_file('transfert_activities', [
+            "name,activity,dosage,reference",
+            "metabolite 1,antioxydant,1 mg,r1",
+            "Metabolite 1,Anti-inflammatoire,,r2",
+            "metabolite 1,ANTI-INFLAMMATOIRE,,r3",
+        ])
+        self.assertIn("Activités créées : 3\n", output)
+        self.assertIn("Types d'activités créés : 1\n", output)
+        self.assertIn("Métabolites non trouvés : 0\n", output)
+        self.assertEqual(sorted(Activity.objects.values_list('name', flat=True)), ["Anti-inflammatoire", "Antioxydant"])
+        self.assertEqual(sorted(self.metabolite.activities.values_list('activity__name', 'reference')), [
+            ("Anti-inflammatoire", "r2"), ("Anti-inflammatoire", "r3"), ("Antioxydant", "r1"),
+        ])
+
+    def test_ubiquity_case_insensitive(self):
+        output = self.import_file('transfert_ubi', [
+            "Metabolite 1,Yes",
+            "metabolite 3,No",
+            "METABOLITE 3,Yes",
+        ])
+        self.assertIn("Métabolites créés : 1\n", output)
+        self.assertIn("Métabolites mis à jour : 1\n", output)
+        self.assertEqual(
+            sorted(Metabolite.objects.values_list('name', 'is_ubiquitous')),
+            [("METABOLITE 3", True), ("metabolite 1", True)],
+        )
+
+        output = self.import_file('transfert_ubi', ["metabolite 3,Yes"])
+        self.assertIn("Métabolites créés : 0\n", output)
+        self.assertIn("Métabolites inchangés : 1\n", output)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class IncrementalImportTests(TestCase):
+    """Import incrémental v1 puis v2 : même état qu'un import direct de v2"""
+
+    def setUp(self):
+        self.metabolites = Metabolite.objects.bulk_create([
+            Metabolite(name=f"metabolite {index}", is_ubiquitous=index == 0) for index in range(10)
+        ])
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def write_file(self, name, rows):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='latin-1') as f:
+            f.write("chemical,plant,part,low,high,deviation,reference\n")
+            f.write(''.join(','.join(str(value) for value in row) + '\n' for row in rows))
+        return path
+
+    def import_file(self, path, *args):
+        output = StringIO()
+        call_command('transfert_plants', '--file', path, '--workers', '1', *args, stdout=output)
+        self.assertNotIn("Erreur", output.getvalue())
+        return output.getvalue()
+
+    def snapshot(self):
+        return (
+            sorted(MetabolitePlant.objects.values_list(
+                'metabolite__name', 'plant__name', 'plant_name', 'plant_part', 'low', 'high', 'deviation', 'reference'
+            )),
+            sorted(PlantStats.objects.filter(total_rows__gt=0).values_list(
+                'plant__name', 'total_rows', 'distinct_metabolites', 'distinct_non_ubiquitous'
+            )),
+            sorted(
+                (plant, metabolite, round(mean, 6), round(low, 6), round(high, 6), parts)
+                for plant, metabolite, mean, low, high, parts in PlantMetaboliteConcentration.objects.values_list(
+                    'plant__name', 'metabolite__name', 'mean_concentration', 'min_concentration',
+                    'max_concentration', 'parts_count',
+                )
+            ),
+        )
+
+    def test_incremental_equals_direct_import(self):
+        rng = random.Random(3)
+
+        def random_row(plants):
+            low = rng.randint(0, 500)
+            return [
+                f"metabolite {rng.randrange(10)}", rng.choice(plants), rng.choice(['feuille', 'racine', 'fleur']),
+                low, low + rng.randint(0, 50) if rng.random() < 0.5 else 'not available', '', f"ref {rng.randrange(5)}",
+            ]
+
+        plants = [f"plante {index}" for index in range(8)]
+        v1 = [random_row(plants) for _ in range(60)]
+        v2 = [list(row) for row in v1]
+        for index in rng.sample(range(len(v2)), 10):
+            v2[index][3] = rng.randint(0, 500)
+            v2[index][5] = 'not available'
+        for index in sorted(rng.sample(range(len(v2)), 12), reverse=True):
+            del v2[index]
+        v2 += [random_row(plants + ["plante nouvelle"]) for _ in range(15)]
+        v1_path, v2_path = self.write_file('v1.csv', v1), self.write_file('v2.csv', v2)
+
+        self.import_file(v2_path)
+        direct = self.snapshot()
+
+        with deferred_plant_stats():
+            MetabolitePlant.objects.all().delete()
+            Plant.objects.all().delete()
+        self.assertFalse(PlantMetaboliteConcentration.objects.exists())
+
+        self.import_file(v1_path, '--incremental')
+        output = self.import_file(v2_path, '--incremental')
+        self.assertNotIn("Associations supprimées (absentes du fichier) : 0\n", output)
+        self.assertNotIn("Associations modifiées : 0\n", output)
+        self.assertEqual(self.snapshot(), direct)
+        self.assertGreater(len(direct[0]), 0)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class StagingTableTests(TestCase):
+    """Échange de la table de chargement : écritures concurrentes et clés étrangères vérifiées"""
+
+    def setUp(self):
+        self.metabolite = Metabolite.objects.create(name="metabolite 1")
+        self.plant = Plant.objects.create(name="plante a")
+        MetabolitePlant.objects.create(metabolite=self.metabolite, plant=self.plant, plant_part='feuille')
+        self.staging = StagingTable(MetabolitePlant)
+        self.staging.create()
+        self.addCleanup(self.staging.drop)
+
+    def load(self, plant_id, plant_part):
+        self.staging.model.objects.create(
+            metabolite_id=self.metabolite.id, plant_id=plant_id, plant_name="plante a", plant_part=plant_part
+        )
+
+    def test_swap(self):
+        self.load(self.plant.id, 'racine')
+        self.staging.swap()
+        self.assertEqual(sorted(MetabolitePlant.objects.values_list('plant_part', flat=True)), ['feuille', 'racine'])
+
+    def test_live_changed_after_copy(self):
+        self.load(self.plant.id, 'racine')
+        MetabolitePlant.objects.create(metabolite=self.metabolite, plant=self.plant, plant_part='fleur')
+        with self.assertRaises(LiveTableChanged):
+            self.staging.swap()
+        self.assertEqual(sorted(MetabolitePlant.objects.values_list('plant_part', flat=True)), ['feuille', 'fleur'])
+
+    def test_bulk_write_after_copy(self):
+        # Les écritures en masse ne déclenchent pas les signaux : l'import avance la génération
+        self.load(self.plant.id, 'racine')
+        MetabolitePlant.objects.bulk_create([
+            MetabolitePlant(metabolite=self.metabolite, plant=self.plant, plant_part='fleur')
+        ])
+        bump_generation()
+        with self.assertRaises(LiveTableChanged):
+            self.staging.swap()
+        self.assertEqual(sorted(MetabolitePlant.objects.values_list('plant_part', flat=True)), ['feuille', 'fleur'])
+
+    def test_orphan_foreign_key(self):
+        self.load(self.plant.id + 1000, 'racine')
+        with self.assertRaises(IntegrityError):
+            self.staging.swap()
+        self.assertEqual(list(MetabolitePlant.objects.values_list('plant_part', flat=True)), ['feuille'])
+
+    def test_live_delete_ignores_staging_table(self):
+        # Le modèle de chargement reste enregistré après la suppression de sa table
+        self.staging.model
+        self.staging.drop()
+        Plant.objects.filter(pk=self.plant.pk).delete()
+        self.assertFalse(Plant.objects.filter(pk=self.plant.pk).exists())
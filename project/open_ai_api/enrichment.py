@@ -0,0 +1,523 @@
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import sys
+import time
+import unicodedata
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from openai import APIConnectionError, APITimeoutError, AsyncOpenAI, InternalServerError, RateLimitError
+from tqdm import tqdm
+
+from open_ai_api.models import EnrichmentCache, RunCheckpoint
+from open_ai_api.rate_limit import AIMDLimiter, TokenBudget, backoff_delay, retry_after
+
+logger = logging.getLogger(__name__)
+
+MODEL = "gpt-4o-mini"
+ITEMS_PER_REQUEST = 50  # Textes envoyés dans une même requête
+MAX_CONCURRENT_REQUESTS = 20  # Plafond du nombre de requêtes parallèles (ajusté en AIMD en dessous)
+INITIAL_CONCURRENT_REQUESTS = 2
+TPM_LIMIT = 30000  # Limite de tokens par minute
+RPM_LIMIT = 500  # Limite de requêtes par minute
+TPM_BUFFER = 1000  # Buffer de sécurité
+PROMPT_TOKENS = 500  # Estimation du prompt système, payé une fois par requête (avant le premier usage réel)
+TOKENS_PER_ANSWER = 30  # Estimation de la réponse pour un texte (avant le premier usage réel)
+ESTIMATE_MARGIN = 1.2  # Marge sur l'estimation issue de l'usage réel
+MAX_RETRIES = 6
+REQUEST_TIMEOUT = 30.0  # Secondes, plus une par texte du lot
+PAGE_SIZE = 1000  # Objets lus par requête (par id croissant)
+WRITE_BATCH_SIZE = 500  # Objets écrits par transaction
+FLUSH_INTERVAL = 5.0  # Secondes d'inactivité avant l'écriture d'un lot incomplet
+
+FORMAT_INSTRUCTIONS = """
+Tu reçois un objet JSON {"elements": {"1": "texte", ...}}.
+Réponds UNIQUEMENT par un objet JSON avec une entrée par numéro reçu, par exemple :
+{"resultats": {"1": "valeur", "2": ""}} (chaîne vide si tu ne sais pas)."""
+
+
+def normalize_text(text):
+    """Texte normalisé (clé de mémorisation) : Unicode NFKC, minuscules, espaces réduits"""
+    return ' '.join(unicodedata.normalize('NFKC', text).lower().split())
+
+
+class RequestFailed(Exception):
+    """Requête abandonnée après MAX_RETRIES essais (429, timeouts, erreurs serveur ou de connexion)"""
+
+
+class ChatClient:
+    """
+    Requêtes chat completions à réponse JSON, partagées par les lots concurrents.
+
+    Budgets de tokens et de requêtes par minute réservés avant l'envoi puis corrigés par
+    l'usage réel ; 429, timeouts, erreurs serveur et de connexion réessayés après une
+    attente exponentielle avec gigue (ou le délai retry-after du serveur) ; concurrence
+    ajustée en AIMD.
+    """
+
+    def __init__(self, model=MODEL, base_url=None, tpm=TPM_LIMIT - TPM_BUFFER, rpm=RPM_LIMIT,
+                 max_concurrency=MAX_CONCURRENT_REQUESTS, logger=logger):
+        # Les reprises sont gérées ici (AIMD, backoff) : pas de reprise implicite du client
+        self.client = AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY, base_url=base_url or settings.OPENAI_BASE_URL, max_retries=0
+        )
+        self.model = model
+        self.logger = logger
+        self.budget = TokenBudget(tpm)
+        self.request_budget = TokenBudget(rpm, kind='requests')
+        self.limiter = AIMDLimiter(initial=INITIAL_CONCURRENT_REQUESTS, maximum=max(max_concurrency, 1))
+        self.requests_count = 0
+        self.retries_count = 0
+        self.rate_limited_count = 0
+        self.timeout_count = 0
+        self.tokens_used = 0
+        self.items_charged = 0
+
+    def estimate_tokens(self, texts):
+        """Tokens réservés pour un lot : usage réel moyen par texte dès qu'il est connu, estimation fixe avant"""
+        if self.items_charged:
+            return math.ceil(self.tokens_used / self.items_charged * len(texts) * ESTIMATE_MARGIN)
+        return PROMPT_TOKENS + sum(len(text) * 2 + TOKENS_PER_ANSWER for text in texts)
+
+    async def complete_json(self, system_prompt, payload, texts):
+        """Envoie payload (JSON) pour le lot de textes texts ; retourne la réponse JSON décodée"""
+        for attempt in range(MAX_RETRIES):
+            estimated_tokens = self.estimate_tokens(texts)
+            # Attendre si nécessaire pour respecter les quotas
+            await self.budget.reserve(estimated_tokens)
+            await self.request_budget.reserve(1)
+            epoch = await self.limiter.acquire()
+            congested, headers = False, None
+            try:
+                self.logger.debug(f"Requête de {len(texts)} textes (tentative {attempt + 1}/{MAX_RETRIES})")
+                self.requests_count += 1
+                raw = await self.client.chat.completions.with_raw_response.create(
+                    model=self.model,
+                    temperature=0,
+                    response_format={"type": "json_object"},
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": json.dumps(payload, ensure_ascii=False)}
+                    ],
+                    timeout=REQUEST_TIMEOUT + len(texts),
+                )
+                headers = raw.headers
+                response = raw.parse()
+
+                # Usage réel : correction du budget et de l'estimation des lots suivants
+                used = response.usage.total_tokens if response.usage else estimated_tokens
+                self.budget.settle(estimated_tokens, used)
+                self.budget.sync(headers)
+                self.request_budget.sync(headers)
+                self.tokens_used += used
+                self.items_charged += len(texts)
+                return json.loads(response.choices[0].message.content)
+
+            except (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError) as e:
+                congested = isinstance(e, (RateLimitError, APITimeoutError))
+                headers = getattr(getattr(e, 'response', None), 'headers', None)
+                if isinstance(e, RateLimitError):
+                    self.rate_limited_count += 1
+                    # Requête refusée : rien n'a été consommé
+                    self.budget.settle(estimated_tokens, 0)
+                    self.budget.sync(headers)
+                    self.request_budget.sync(headers)
+                elif isinstance(e, APITimeoutError):
+                    self.timeout_count += 1
+                if attempt == MAX_RETRIES - 1:
+                    raise RequestFailed(f"{MAX_RETRIES} essais : {e}") from e
+                wait_time = retry_after(headers) or backoff_delay(attempt)
+                self.logger.warning(
+                    f"{type(e).__name__} sur un lot de {len(texts)} textes, nouvel essai dans {wait_time:.1f}s "
+                    f"({attempt + 1}/{MAX_RETRIES}, concurrence {int(self.limiter.limit)})"
+                )
+                self.retries_count += 1
+            finally:
+                await self.limiter.release(epoch, congested, headers)
+            await asyncio.sleep(wait_time)
+
+
+class EnrichmentRunner:
+    """
+    Remplit le champ field des objets d'un queryset à partir de leur champ source, par un
+    modèle de langage : queryset + prompt + champ cible.
+
+    - lecture par id croissant (pages de PAGE_SIZE), nombre de lots en attente borné ;
+    - textes regroupés par lots de items_per_request en une requête JSON (ChatClient :
+      budgets par minute, concurrence AIMD, reprises) ;
+    - réponses mémorisées (EnrichmentCache) : un texte déjà vu, dans ce run ou un précédent,
+      n'est pas redemandé ;
+    - écritures par lots de write_batch_size (bulk_update) par une tâche dédiée, dans la
+      même transaction que la mémoire et le point de reprise (RunCheckpoint) ;
+    - resume=True reprend le dernier run interrompu de la tâche job.
+
+    Le queryset doit ne retenir que les objets à traiter (ex. champ cible vide). Les
+    sous-classes adaptent la clé de mémorisation, le décodage des réponses, la mémoire et
+    l'affectation (source_text, cache_key, parse, load_cache, save_cache, apply).
+    """
+
+    request_key = 'elements'
+    response_key = 'resultats'
+
+    def __init__(self, job, queryset, field, prompt, source='name', chat=None,
+                 items_per_request=ITEMS_PER_REQUEST, write_batch_size=WRITE_BATCH_SIZE,
+                 limit=0, resume=False, logger=logger, desc="🔄 Enrichissement"):
+        self.job = job
+        self.queryset = queryset.order_by('pk')
+        self.model = queryset.model
+        self.field = field
+        self.prompt = prompt
+        self.source = source
+        self.chat = chat or ChatClient(logger=logger)
+        self.items_per_request = max(items_per_request, 1)
+        self.write_batch_size = max(write_batch_size, 1)
+        self.limit = limit
+        self.resume = resume
+        self.logger = logger
+        self.desc = desc
+        self.prompt_digest = hashlib.sha1(prompt.encode('utf-8')).hexdigest()
+        self.max_length = self.model._meta.get_field(field).max_length
+
+        self.processed = 0
+        self.updated = 0
+        self.empty_count = 0
+        self.cache_hits = 0
+        self.error_count = 0
+        self.writes_count = 0
+        self.total = None
+        self.pbar = None
+
+    # Points d'extension
+
+    def system_prompt(self):
+        return self.prompt + "\n" + FORMAT_INSTRUCTIONS
+
+    def source_text(self, obj):
+        return getattr(obj, self.source)
+
+    def cache_key(self, text):
+        """Clé de mémorisation : empreinte du prompt et du texte normalisé"""
+        return hashlib.sha1(f"{self.prompt_digest}\0{normalize_text(text)}".encode('utf-8')).hexdigest()
+
+    def parse(self, text, value):
+        """Réponse retenue pour text ('' : pas de valeur), None si elle est invalide (non mémorisée)"""
+        if not isinstance(value, str):
+            return None
+        value = value.strip()
+        if self.max_length and len(value) > self.max_length:
+            return None
+        return value
+
+    def load_cache(self, keys):
+        """Réponses mémorisées {clé: réponse} pour les clés données"""
+        cached = {}
+        for start in range(0, len(keys), 500):
+            for entry in EnrichmentCache.objects.filter(job=self.job, key__in=keys[start:start + 500]):
+                cached[entry.key] = entry.value
+        return cached
+
+    def save_cache(self, results):
+        """Mémorise [(clé, texte, réponse)] (appelé dans la transaction d'écriture)"""
+        EnrichmentCache.objects.bulk_create(
+            [
+                EnrichmentCache(job=self.job, key=key, source=text, value=answer, model=self.chat.model)
+                for key, text, answer in results
+            ],
+            batch_size=self.write_batch_size,
+            update_conflicts=True, unique_fields=['job', 'key'],
+            update_fields=['source', 'value', 'model', 'updated_at'],
+        )
+
+    def apply(self, objs, text, answer, cached):
+        """Affecte la réponse aux objets de même clé ; retourne les objets à écrire"""
+        if not answer:
+            self.empty_count += len(objs)
+            return []
+        for obj in objs:
+            setattr(obj, self.field, answer)
+        return objs
+
+    # Affichage
+
+    def echo(self, message):
+        """Affiche un message au-dessus de la barre de progression"""
+        if self.pbar is None:
+            print(message)
+            return
+        # Efface la ligne de la barre de progression
+        sys.stdout.write('\033[1A\033[K')
+        print(message)
+        # Réaffiche la barre de progression
+        self.pbar.refresh()
+
+    # Pipeline
+
+    async def request_batch(self, batch):
+        """Envoie un lot [(clé, texte)] ; retourne {clé: (texte, réponse)} pour les réponses valides"""
+        payload = {self.request_key: {str(index): text for index, (_, text) in enumerate(batch, start=1)}}
+        try:
+            content = await self.chat.complete_json(self.system_prompt(), payload, [text for _, text in batch])
+            answers = content.get(self.response_key) or {}
+        except Exception as e:
+            error_message = f"❌ Erreur sur le lot {batch[0][1]}... ({len(batch)} textes) : {str(e)}"
+            self.echo(error_message)
+            self.logger.error(error_message)
+            self.error_count += len(batch)
+            return {}
+
+        results = {}
+        for index, (key, text) in enumerate(batch, start=1):
+            value = answers.get(str(index))
+            answer = self.parse(text, value)
+            if answer is None:
+                # Absente ou invalide : non mémorisée, redemandée au prochain run
+                self.echo(f"⚠️ {text:<40} → Réponse absente ou invalide, ignorée")
+                self.logger.warning(f"Réponse invalide pour {text}: {value}")
+                self.error_count += 1
+                continue
+            results[key] = (text, answer)
+        return results
+
+    def flush(self, objs, cache_results, in_flight, last_id, completed=False):
+        """Écrit un lot (mémoire, objets) et le point de reprise dans une même transaction"""
+        with transaction.atomic():
+            if cache_results:
+                self.save_cache(cache_results)
+            self.model.objects.bulk_update(objs, [self.field], batch_size=self.write_batch_size)
+            RunCheckpoint.objects.filter(job=self.job).update(last_id=last_id, in_flight=in_flight, completed=completed)
+
+    async def writer(self, queue):
+        """
+        Tâche d'écriture : regroupe les résultats reçus (objets, mémoire, ids terminés) et les
+        écrit par lots de write_batch_size objets, ou après FLUSH_INTERVAL secondes d'inactivité.
+        """
+        objs, cache_results, done_ids = [], [], set()
+        finished = False
+        while not finished:
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                item = False
+            if item is None:
+                finished = True
+            elif item:
+                item_objs, item_cache, item_done = item
+                objs.extend(item_objs)
+                cache_results.extend(item_cache)
+                done_ids.update(item_done)
+            if not (finished or done_ids and (item is False or len(done_ids) >= self.write_batch_size)):
+                continue
+
+            # Point de reprise cohérent avec ce lot : position de lecture et ids encore en cours
+            in_flight = sorted(self.in_flight - done_ids)
+            completed = finished and self.scan_complete
+            await sync_to_async(self.flush)(objs, cache_results, in_flight, self.scan_position, completed)
+            self.in_flight -= done_ids
+            self.processed += len(done_ids)
+            self.updated += len(objs)
+            self.writes_count += 1
+            objs, cache_results, done_ids = [], [], set()
+
+    def start_checkpoint(self):
+        """Point de reprise du run : celui du run interrompu si resume, sinon un nouveau (id 0)"""
+        if self.resume:
+            checkpoint = RunCheckpoint.objects.filter(job=self.job, completed=False).first()
+            if checkpoint:
+                return checkpoint, True
+        checkpoint, _ = RunCheckpoint.objects.update_or_create(job=self.job, defaults={
+            'last_id': 0, 'in_flight': [], 'completed': False, 'started_at': timezone.now(),
+        })
+        return checkpoint, False
+
+    def count(self):
+        """Nombre d'objets à traiter (limite comprise)"""
+        total = self.queryset.filter(pk__gt=self.scan_position).count() + len(self.in_flight)
+        return min(total, self.limit) if self.limit else total
+
+    def read(self, after_id=None, ids=None, size=None):
+        """Objets à traiter, par id croissant : après after_id, ou parmi ids"""
+        if ids is not None:
+            return list(self.queryset.filter(pk__in=ids))
+        return list(self.queryset.filter(pk__gt=after_id)[:size])
+
+    async def prepare(self):
+        """Charge ou crée le point de reprise ; retourne (reprise ?, nombre d'objets à traiter)"""
+        checkpoint, self.resumed = await sync_to_async(self.start_checkpoint)()
+        self.scan_position = checkpoint.last_id
+        self.in_flight = set(checkpoint.in_flight)
+        self.scan_complete = False
+        self.total = await sync_to_async(self.count)()
+        return self.resumed, self.total
+
+    async def run(self):
+        """Traite le queryset ; retourne les métriques du run (voir metrics())"""
+        if self.total is None:
+            await self.prepare()
+        max_pending_batches = self.chat.limiter.maximum * 2
+
+        # Configuration de la barre de progression
+        self.pbar = tqdm(total=self.total,
+                         desc=self.desc,
+                         bar_format='{desc} |{bar:30}| {percentage:3.0f}% [{n_fmt}/{total_fmt}]',
+                         colour='green',
+                         position=0,
+                         leave=True,
+                         file=sys.stdout,
+                         dynamic_ncols=True)
+
+        queue = asyncio.Queue()
+        writer_task = asyncio.create_task(self.writer(queue))
+        pending = {}  # Clé -> objets en attente de la réponse d'un lot
+        answers = {}  # Réponses reçues pendant ce run (pas encore forcément écrites)
+        buffer = []  # Textes à envoyer dans le prochain lot
+        tasks = {}  # Requêtes en cours -> lot
+        self.started_at = time.monotonic()
+
+        async def harvest(done):
+            """Traite les lots terminés : objets, mémoire et ids terminés envoyés à la tâche d'écriture"""
+            for task in done:
+                batch = tasks.pop(task)
+                results = task.result()
+                answers.update(results)
+                objs, done_ids = [], []
+                for key, _ in batch:
+                    key_objs = pending.pop(key)
+                    if key in results:
+                        # Sans réponse valide, les objets sont terminés sans mise à jour
+                        text, answer = results[key]
+                        objs.extend(self.apply(key_objs, text, answer, cached=False))
+                    done_ids.extend(obj.pk for obj in key_objs)
+                cache_results = [(key, text, answer) for key, (text, answer) in results.items()]
+                await queue.put((objs, cache_results, done_ids))
+                self.pbar.update(len(done_ids))
+
+        async def collect():
+            """Attend qu'au moins un lot se termine et traite tous les lots terminés"""
+            done, _ = await asyncio.wait(list(tasks), return_when=asyncio.FIRST_COMPLETED)
+            await harvest(done)
+
+        async def dispatch(batch):
+            tasks[asyncio.create_task(self.request_batch(batch))] = batch
+            # Réponses déjà reçues traitées sans attendre : écrites au fil de l'eau
+            await harvest([task for task in tasks if task.done()])
+            # Nombre de lots en attente borné : la lecture avance au rythme des réponses
+            if len(tasks) >= max_pending_batches:
+                await collect()
+
+        async def process(page):
+            """Réponses connues appliquées directement, autres textes regroupés en lots de requêtes"""
+            groups = {}
+            for obj in page:
+                text = self.source_text(obj)
+                groups.setdefault(self.cache_key(text), []).append(obj)
+
+            unknown = [key for key in groups if key not in answers and key not in pending]
+            cached = await sync_to_async(self.load_cache)(unknown)
+            objs, done_ids = [], []
+            for key, key_objs in groups.items():
+                if key in pending:
+                    # Déjà demandé dans un lot en cours
+                    pending[key].extend(key_objs)
+                elif key in answers or key in cached:
+                    text = self.source_text(key_objs[0])
+                    answer = answers[key][1] if key in answers else cached[key]
+                    objs.extend(self.apply(key_objs, text, answer, cached=True))
+                    done_ids.extend(obj.pk for obj in key_objs)
+                    self.cache_hits += len(key_objs)
+                else:
+                    pending[key] = key_objs
+                    buffer.append((key, self.source_text(key_objs[0])))
+            if done_ids:
+                await queue.put((objs, [], done_ids))
+                self.pbar.update(len(done_ids))
+
+            while len(buffer) >= self.items_per_request:
+                batch = buffer[:self.items_per_request]
+                del buffer[:self.items_per_request]
+                await dispatch(batch)
+
+        try:
+            # Objets en cours lors de l'interruption, puis lecture par id croissant
+            if self.in_flight:
+                page = await sync_to_async(self.read)(ids=sorted(self.in_flight))
+                # Ceux traités entre-temps ne sont plus en cours
+                self.in_flight = {obj.pk for obj in page}
+                await process(page)
+            remaining = self.total - len(self.in_flight) if self.limit else None
+            while remaining is None or remaining > 0:
+                size = PAGE_SIZE if remaining is None else min(PAGE_SIZE, remaining)
+                page = await sync_to_async(self.read)(after_id=self.scan_position, size=size)
+                if not page:
+                    break
+                self.in_flight.update(obj.pk for obj in page)
+                self.scan_position = page[-1].pk
+                if remaining is not None:
+                    remaining -= len(page)
+                await process(page)
+
+            if buffer:
+                await dispatch(list(buffer))
+                buffer.clear()
+            while tasks:
+                await collect()
+            self.scan_complete = not self.limit
+        finally:
+            # Interruption : les réponses déjà reçues (payées) sont écrites, les autres lots abandonnés
+            await harvest([task for task in tasks if task.done() and not task.cancelled()])
+            for task in tasks:
+                task.cancel()
+            # Dernières écritures et point de reprise, y compris en cas d'interruption
+            await queue.put(None)
+            await writer_task
+            self.pbar.close()
+
+        return self.metrics()
+
+    def metrics(self):
+        """Métriques du run : débit, tokens par objet, taux de réponses mémorisées, requêtes"""
+        chat = self.chat
+        elapsed = time.monotonic() - self.started_at
+        return {
+            'job': self.job,
+            'elapsed_seconds': round(elapsed, 2),
+            'items': self.processed,
+            'updated': self.updated,
+            'empty': self.empty_count,
+            'errors': self.error_count,
+            'cache_hits': self.cache_hits,
+            'cache_hit_rate': round(self.cache_hits / self.processed, 3) if self.processed else 0,
+            'items_per_second': round(self.processed / elapsed, 1) if elapsed else 0,
+            'requests': chat.requests_count,
+            'retries': chat.retries_count,
+            'rate_limited': chat.rate_limited_count,
+            'timeouts': chat.timeout_count,
+            'tokens': chat.tokens_used,
+            'items_charged': chat.items_charged,
+            'tokens_per_item': round(chat.tokens_used / chat.items_charged, 1) if chat.items_charged else 0,
+            'tokens_per_minute': round(chat.tokens_used / elapsed * 60) if elapsed else 0,
+            'token_budget': chat.budget.capacity,
+            'concurrency': {
+                'final': int(chat.limiter.limit), 'peak': chat.limiter.peak, 'decreases': chat.limiter.decreases,
+            },
+            'writes': self.writes_count,
+            'last_id': self.scan_position,
+            'completed': self.scan_complete,
+        }
+
+    @staticmethod
+    def summary(metrics):
+        """Lignes de récapitulatif communes aux commandes d'enrichissement"""
+        concurrency = metrics['concurrency']
+        return f"""   • Réponses mémorisées : {metrics['cache_hits']} ({metrics['cache_hit_rate']:.0%} des objets traités)
+   • Requêtes envoyées : {metrics['requests']} ({metrics['items_charged']} textes, {metrics['retries']} reprises)
+   • Refus 429 : {metrics['rate_limited']} • Timeouts : {metrics['timeouts']}
+   • Tokens consommés : {metrics['tokens']} ({metrics['tokens_per_item']:.0f} par texte)
+   • Débit : {metrics['items_per_second']:.1f} objets/s, {metrics['tokens_per_minute']} tokens/min (budget {metrics['token_budget']})
+   • Concurrence : finale {concurrency['final']}, pic {concurrency['peak']}, {concurrency['decreases']} réductions
+   • Écritures : {metrics['writes']} lots (point de reprise : id {metrics['last_id']})
+"""
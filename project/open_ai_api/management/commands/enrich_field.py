@@ -0,0 +1,119 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from open_ai_api.enrichment import (
+    ITEMS_PER_REQUEST, MAX_CONCURRENT_REQUESTS, RPM_LIMIT, TPM_BUFFER, TPM_LIMIT, WRITE_BATCH_SIZE,
+    ChatClient, EnrichmentRunner,
+)
+
+
+class Command(BaseCommand):
+    help = ("Remplit un champ d'un modèle à partir d'un champ source via OpenAI (EnrichmentRunner), "
+            "ex. : enrich_field metabolites.Plant name french_name --prompt \"Traduis en français ...\"")
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help="Modèle au format app_label.Model")
+        parser.add_argument('source', help="Champ lu (texte envoyé au modèle de langage)")
+        parser.add_argument('field', help="Champ rempli avec la réponse")
+        prompt = parser.add_mutually_exclusive_group(required=True)
+        prompt.add_argument('--prompt', help="Consigne (prompt système) appliquée à chaque texte")
+        prompt.add_argument('--prompt-file', help="Fichier contenant la consigne")
+        parser.add_argument('--job', help="Nom de la tâche : mémoire et point de reprise (défaut : model.field)")
+        parser.add_argument('--all', action='store_true',
+                            help="Traite aussi les objets dont le champ cible est déjà rempli")
+        parser.add_argument('--limit', type=int, default=0, help="Nombre d'objets à traiter (0 pour tous)")
+        parser.add_argument('--resume', action='store_true',
+                            help="Reprend le dernier run interrompu de la tâche (point de reprise RunCheckpoint)")
+        parser.add_argument('--items-per-request', type=int, default=ITEMS_PER_REQUEST,
+                            help="Nombre de textes envoyés dans une même requête")
+        parser.add_argument('--write-batch-size', type=int, default=WRITE_BATCH_SIZE,
+                            help="Nombre d'objets écrits par transaction")
+        parser.add_argument('--base-url', default=None,
+                            help="Point d'accès compatible OpenAI (défaut : OPENAI_BASE_URL, ex. openai_stub_server)")
+        parser.add_argument('--tpm', type=int, default=TPM_LIMIT - TPM_BUFFER,
+                            help="Budget de tokens par minute (usage réel des réponses)")
+        parser.add_argument('--rpm', type=int, default=RPM_LIMIT, help="Budget de requêtes par minute")
+        parser.add_argument('--max-concurrency', type=int, default=MAX_CONCURRENT_REQUESTS,
+                            help="Plafond des requêtes simultanées, ajustées en AIMD sur les 429 et timeouts")
+        parser.add_argument('--metrics-output', help="Fichier JSON des métriques du run (défaut : à côté du fichier de log)")
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(f"Modèle inconnu : {options['model']} ({e})")
+        for name in (options['source'], options['field']):
+            try:
+                model._meta.get_field(name)
+            except FieldDoesNotExist:
+                raise CommandError(f"Champ inconnu : {model.__name__}.{name}")
+
+        if options['prompt_file']:
+            with open(options['prompt_file'], encoding='utf-8') as f:
+                prompt = f.read().strip()
+        else:
+            prompt = options['prompt']
+        job = options['job'] or f"{model._meta.label_lower}.{options['field']}"
+
+        # Création du dossier logs s'il n'existe pas
+        logs_dir = "logs"
+        if not os.path.exists(logs_dir):
+            os.makedirs(logs_dir)
+
+        # Configuration des logs
+        log_basename = f"{logs_dir}/enrich_{job}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        logging.basicConfig(
+            filename=f"{log_basename}.log",
+            level=logging.INFO,
+            format='%(asctime)s - %(levelname)s - %(message)s'
+        )
+        logger = logging.getLogger(__name__)
+
+        queryset = model.objects.all()
+        if not options['all']:
+            empty = Q(**{f"{options['field']}__isnull": True}) | Q(**{options['field']: ''})
+            queryset = queryset.filter(empty)
+
+        try:
+            chat = ChatClient(
+                base_url=options['base_url'], tpm=options['tpm'], rpm=options['rpm'],
+                max_concurrency=options['max_concurrency'], logger=logger,
+            )
+            runner = EnrichmentRunner(
+                job, queryset, options['field'], prompt, source=options['source'], chat=chat,
+                items_per_request=options['items_per_request'], write_batch_size=options['write_batch_size'],
+                limit=options['limit'], resume=options['resume'], logger=logger,
+            )
+            metrics = asyncio.run(self.run(runner, options['resume']))
+        except Exception as e:
+            logger.error(f"Erreur lors de l'enrichissement {job} : {str(e)}")
+            self.stdout.write(self.style.ERROR(f"Erreur : {str(e)}"))
+            return
+
+        metrics_output = options['metrics_output'] or f"{log_basename}_metrics.json"
+        with open(metrics_output, 'w', encoding='utf-8') as f:
+            json.dump(metrics, f, ensure_ascii=False, indent=2)
+
+        summary = f"""
+✨ Récapitulatif de l'enrichissement {job} :
+   • Objets traités : {metrics['items']} ({metrics['updated']} mis à jour, {metrics['empty']} sans réponse)
+   • Échecs : {metrics['errors']}
+""" + EnrichmentRunner.summary(metrics) + f"   • Métriques : {metrics_output}\n"
+        self.stdout.write(self.style.SUCCESS(summary))
+        logger.info(summary)
+
+    async def run(self, runner, resume):
+        resumed, total = await runner.prepare()
+        if resume and not resumed:
+            self.stdout.write(self.style.WARNING("Aucun run interrompu à reprendre : nouveau run"))
+        self.stdout.write(self.style.SUCCESS(
+            f"\n🧪 {runner.job} : {total} objets à traiter"
+            + (f" (reprise après l'id {runner.scan_position}, {len(runner.in_flight)} en cours)" if resumed else "")
+        ))
+        return await runner.run()
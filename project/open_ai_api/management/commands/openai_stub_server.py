@@ -0,0 +1,224 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.core.management.base import BaseCommand
+
+# Réponses connues du serveur de test ; les autres noms reçoivent une traduction factice
+KNOWN_NAMES = {
+    'aloe vera': 'Aloès vera',
+    'malus domestica': 'Pommier domestique',
+    'acacia confusa': '(Acacia confus, Petit acacia philippin)',
+}
+
+# Clé du JSON reçu -> clé de la réponse (translate_plants_names, EnrichmentRunner)
+RESPONSE_KEYS = {'noms': 'traductions', 'elements': 'resultats'}
+
+
+def stub_translation(name):
+    """Traduction déterministe : connue, introuvable (noms en '-ii') ou factice"""
+    normalized = ' '.join(name.lower().split())
+    if normalized in KNOWN_NAMES:
+        return KNOWN_NAMES[normalized]
+    if normalized.endswith('ii'):
+        return ''
+    return f"Plante {name}"
+
+
+def count_tokens(text):
+    """Approximation du nombre de tokens (4 caractères par token)"""
+    return max(len(text) // 4, 1)
+
+
+def format_duration(seconds):
+    """Durée au format des en-têtes x-ratelimit-reset-* (ex. "1m30s", "250ms")"""
+    if seconds < 1:
+        return f"{int(seconds * 1000)}ms"
+    minutes, seconds = divmod(seconds, 60)
+    return f"{int(minutes)}m{seconds:.1f}s" if minutes else f"{seconds:.1f}s"
+
+
+class Quota:
+    """Quota par minute à remplissage continu (requêtes ou tokens), comme les limites OpenAI"""
+
+    def __init__(self, per_minute):
+        self.limit = per_minute
+        self.available = float(per_minute)
+        self.last_update = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.limit, self.available + (now - self.last_update) * self.limit / 60)
+        self.last_update = now
+
+    def reset_after(self, amount):
+        """Secondes avant que amount soit disponible"""
+        return max(amount - self.available, 0) * 60 / self.limit
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    POST /v1/chat/completions au format OpenAI, réponses JSON {"traductions": {...}}
+    (ou {"resultats": {...}} pour {"elements": {...}}).
+
+    Limites simulées : quotas de requêtes et de tokens par minute et nombre de requêtes
+    simultanées ; au-delà, réponse 429 avec retry-after-ms. Chaque réponse porte les
+    en-têtes x-ratelimit-* et l'usage réel (4 caractères par token).
+    """
+
+    server_version = "OpenAIStub/1.0"
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(404, {"error": {"message": f"Route inconnue : {self.path}", "type": "invalid_request_error"}})
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        messages = body.get('messages', [])
+        user_content = next((m['content'] for m in reversed(messages) if m.get('role') == 'user'), '')
+
+        try:
+            payload = json.loads(user_content)
+            request_key = next(key for key in RESPONSE_KEYS if key in payload)
+            content = json.dumps(
+                {RESPONSE_KEYS[request_key]: {index: stub_translation(name) for index, name in payload[request_key].items()}},
+                ensure_ascii=False
+            )
+        except (ValueError, AttributeError, TypeError, StopIteration):
+            # Requête à un seul nom, en texte libre
+            content = stub_translation(user_content.rsplit(':', 1)[-1].strip())
+
+        prompt_tokens = sum(count_tokens(m.get('content', '')) for m in messages)
+        completion_tokens = count_tokens(content)
+        total_tokens = prompt_tokens + completion_tokens
+
+        # Admission : quotas par minute et requêtes simultanées, 429 sinon
+        server = self.server
+        with server.lock:
+            server.rpm.refill()
+            server.tpm.refill()
+            overloaded = server.max_concurrency and server.in_flight >= server.max_concurrency
+            if server.rpm.available < 1 or server.tpm.available < total_tokens or overloaded:
+                server.rejected += 1
+                wait = max(server.rpm.reset_after(1), server.tpm.reset_after(total_tokens), 0.05 if overloaded else 0)
+                headers = self.limit_headers()
+                headers['retry-after-ms'] = int(wait * 1000)
+                kind = 'concurrency' if overloaded else ('requests' if server.rpm.available < 1 else 'tokens')
+                reject = True
+            else:
+                server.rpm.available -= 1
+                server.tpm.available -= total_tokens
+                server.in_flight += 1
+                server.peak_in_flight = max(server.peak_in_flight, server.in_flight)
+                headers = self.limit_headers()
+                reject = False
+        if reject:
+            self.send_json(429, {"error": {
+                "message": f"Rate limit reached ({kind}), please try again later.",
+                "type": kind, "code": "rate_limit_exceeded",
+            }}, headers)
+            return
+
+        try:
+            if server.latency:
+                time.sleep(server.latency)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+                server.requests += 1
+                server.tokens += total_tokens
+
+        self.send_json(200, {
+            "id": f"chatcmpl-stub-{self.server.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get('model', 'stub'),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": total_tokens,
+            },
+        }, headers)
+
+    def limit_headers(self):
+        """En-têtes x-ratelimit-* (appelé sous server.lock)"""
+        rpm, tpm = self.server.rpm, self.server.tpm
+        return {
+            'x-ratelimit-limit-requests': rpm.limit,
+            'x-ratelimit-limit-tokens': tpm.limit,
+            'x-ratelimit-remaining-requests': int(rpm.available),
+            'x-ratelimit-remaining-tokens': int(tpm.available),
+            'x-ratelimit-reset-requests': format_duration(rpm.reset_after(rpm.limit)),
+            'x-ratelimit-reset-tokens': format_duration(tpm.reset_after(tpm.limit)),
+        }
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def create_server(host='127.0.0.1', port=0, latency=0, rpm=500, tpm=200000, max_concurrency=0, verbose=False):
+    """Serveur de test (non démarré) ; port 0 : port libre choisi par le système"""
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.latency = latency
+    server.verbose = verbose
+    server.lock = threading.Lock()
+    server.rpm = Quota(rpm)
+    server.tpm = Quota(tpm)
+    server.max_concurrency = max_concurrency
+    server.in_flight = 0
+    server.peak_in_flight = 0
+    server.requests = 0
+    server.rejected = 0
+    server.tokens = 0
+    return server
+
+
+class Command(BaseCommand):
+    help = "Serveur local compatible OpenAI (chat completions) pour tester les commandes de traduction hors ligne"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency', type=float, default=0, help="Délai (s) ajouté à chaque réponse")
+        parser.add_argument('--rpm', type=int, default=500, help="Limite simulée de requêtes par minute")
+        parser.add_argument('--tpm', type=int, default=200000, help="Limite simulée de tokens par minute")
+        parser.add_argument('--max-concurrency', type=int, default=0,
+                            help="Requêtes simultanées au-delà desquelles le serveur répond 429 (0 : illimité)")
+        parser.add_argument('--verbose', action='store_true', help="Journalise chaque requête")
+
+    def handle(self, *args, **options):
+        server = create_server(
+            options['host'], options['port'], latency=options['latency'], rpm=options['rpm'], tpm=options['tpm'],
+            max_concurrency=options['max_concurrency'], verbose=options['verbose'],
+        )
+
+        url = f"http://{options['host']}:{options['port']}/v1"
+        self.stdout.write(self.style.SUCCESS(
+            f"Serveur de test OpenAI sur {url} (OPENAI_BASE_URL={url}) : {options['rpm']} requêtes/min, "
+            f"{options['tpm']} tokens/min, {options['max_concurrency'] or 'sans limite de'} requêtes simultanées"
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(self.style.SUCCESS(
+                f"\nArrêt du serveur : {server.requests} requêtes servies, {server.rejected} refusées (429), "
+                f"{server.tokens} tokens, pic de {server.peak_in_flight} requêtes simultanées"
+            ))
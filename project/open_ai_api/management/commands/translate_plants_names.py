@@ -1,292 +1,221 @@
-import time
 import logging
-import sys
 import asyncio
 from datetime import datetime
-from openai import AsyncOpenAI
 from django.core.management.base import BaseCommand
+from django.db.models import Q
 from metabolites.models import Plant
-from django.conf import settings
-from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor
-from asgiref.sync import sync_to_async
-
-client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
-
-BATCH_SIZE = 10  # Taille du lot pour bulk_update
-MAX_CONCURRENT_REQUESTS = 5  # Réduit le nombre de requêtes parallèles
-TPM_LIMIT = 30000  # Limite de tokens par minute
-TPM_BUFFER = 1000  # Buffer de sécurité
-
-class TokenBucket:
-    def __init__(self, tokens_per_minute):
-        self.capacity = tokens_per_minute
-        self.tokens = tokens_per_minute
-        self.last_update = time.time()
-        self.tokens_per_second = tokens_per_minute / 60
-
-    async def consume(self, tokens):
-        now = time.time()
-        time_passed = now - self.last_update
-        self.tokens = min(self.capacity, self.tokens + time_passed * self.tokens_per_second)
-        self.last_update = now
-
-        if self.tokens < tokens:
-            wait_time = (tokens - self.tokens) / self.tokens_per_second
-            await asyncio.sleep(wait_time)
-            self.tokens = tokens
-            return True
-
-        self.tokens -= tokens
-        return False
+from open_ai_api.enrichment import (
+    ITEMS_PER_REQUEST, MAX_CONCURRENT_REQUESTS, RPM_LIMIT, TPM_BUFFER, TPM_LIMIT, WRITE_BATCH_SIZE,
+    ChatClient, EnrichmentRunner, normalize_text,
+)
+from open_ai_api.models import TranslationMemory
 
-class Command(BaseCommand):
-    help = "Traduit les noms de plantes en français via OpenAI"
-
-    def __init__(self):
-        super().__init__()
-        self.token_bucket = TokenBucket(TPM_LIMIT - TPM_BUFFER)
-
-    def setup_logger(self):
-        # Création du nom de fichier avec la date
-        log_filename = f"logs/translation_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
-        
-        # Configuration du logger
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(log_filename, encoding='utf-8'),
-            ]
-        )
-        return logging.getLogger(__name__)
+JOB = "translate_plants_names"  # Nom du point de reprise (RunCheckpoint)
+MAX_LENGTH = 220  # Longueur maximale d'une traduction
 
-    async def translate_plant(self, plant, safe_print, logger):
-        max_retries = 5
-        retry_delay = 5  # Augmenté à 5 secondes
-        
-        for attempt in range(max_retries):
-            try:
-                logger.debug(f"Début de la traduction de {plant.name} (tentative {attempt + 1}/{max_retries})")
-                
-                # Estimation des tokens nécessaires (prompt + réponse potentielle)
-                estimated_tokens = len(plant.name) * 2 + 500
-                
-                # Attendre si nécessaire pour respecter le quota de tokens
-                await self.token_bucket.consume(estimated_tokens)
-                
-                # Ajout d'un timeout de 30 secondes pour la requête
-                try:
-                    response = await asyncio.wait_for(
-                        client.chat.completions.create(
-                            model="gpt-4o-mini",
-                            temperature=0,
-                            messages=[
-                                {"role": "system", "content": f"""Tu es un traducteur expert en botanique. Règles ABSOLUES : 
+SYSTEM_PROMPT = """Tu es un traducteur expert en botanique. Tu reçois un objet JSON {"noms": {"1": "nom latin", ...}}.
+Pour CHAQUE numéro, applique ces règles ABSOLUES :
 
 1️⃣ Si tu es 100% certain du nom français officiel (source : POWO, Tela Botanica, The Plant List) :
-   - Retourne UNIQUEMENT le nom en français
+   - Donne UNIQUEMENT le nom en français
    - PAS de texte explicatif
-   - PAS de formatage spécial
 
 2️⃣ Si tu n'es pas 100% certain mais as des suggestions basées sur des sources fiables :
-   - Retourne UNIQUEMENT les suggestions entre parenthèses, séparées par des virgules
+   - Donne UNIQUEMENT les suggestions entre parenthèses, séparées par des virgules
    - Format : (suggestion1, suggestion2, ...)
-   - PAS de texte explicatif
 
 3️⃣ Si tu ne trouves pas de nom officiel :
-   - Retourne UNIQUEMENT une chaîne vide
+   - Donne UNIQUEMENT une chaîne vide
 
 🔴 INTERDIT :
 - Inventer un nom
 - Proposer des noms basés uniquement sur des ressemblances linguistiques
 - Utiliser des synonymes non officiels
 - Ajouter des commentaires ou explications
-- Renvoyer une chaine de caractère de plus de 220 caractères
+- Donner une traduction de plus de 220 caractères
 - Répondre en anglais
 - Ajouter des flèches ou des symboles
 
-📌 Exemples EXACTS de réponses acceptées :
-Aloe vera → Aloès vera
-Malus domestica → Pommier domestique
-Acacia confusa → (Acacia confus, Petit acacia philippin)
-Plante inconnue →"""},
-                                {"role": "user", "content": f"Traduis ce nom de plante en français : {plant.name}"}
-                            ]
-                        ),
-                        timeout=30.0
-                    )
-                except asyncio.TimeoutError:
-                    logger.error(f"Timeout lors de la traduction de {plant.name}")
-                    safe_print(f"⚠️ {plant.name:<40} → Timeout")
-                    self.error_count += 1
-                    return None
-
-                translated_name = response.choices[0].message.content.strip()
-                logger.debug(f"Réponse reçue pour {plant.name}: {translated_name}")
-
-                # Validation de la réponse
-                if len(translated_name) > 220:
-                    safe_print(f"⚠️ {plant.name:<40} → Réponse trop longue, ignorée")
-                    logger.warning(f"Réponse trop longue pour {plant.name}: {translated_name}")
-                    self.error_count += 1
-                    return None
-
-                # Vérifie si la réponse contient le prompt système ou est en anglais
-                if "Tu es un traducteur expert en botanique" in translated_name or "If you are" in translated_name:
-                    safe_print(f"⚠️ {plant.name:<40} → Réponse invalide (anglais ou prompt), ignorée")
-                    logger.warning(f"Réponse invalide pour {plant.name}: {translated_name}")
-                    self.error_count += 1
-                    return None
-
-                # Vérifie si c'est une suggestion (entre parenthèses) ou une traduction certaine
-                is_suggestion = translated_name.startswith('(') and translated_name.endswith(')')
-
-                if translated_name:
-                    if is_suggestion:
-                        safe_print(f"? {plant.name:<40} → {translated_name}")
-                        logger.info(f"Suggestions de traduction : {plant.name} → {translated_name}")
-                        self.error_count += 1  # On compte comme une "erreur" car pas 100% sûr
-                    else:
-                        safe_print(f"+ {plant.name:<40} → {translated_name}")
-                        logger.info(f"Nouvelle traduction : {plant.name} → {translated_name}")
-                        self.success_count += 1
-                    
-                    # Nettoyage et troncature de la traduction avant de la sauvegarder
-                    cleaned_name = translated_name.replace(f"{plant.name} → ", "").strip()
-                    plant.french_name = cleaned_name[:220]  # Limite à 220 caractères
-                    return plant
-                else:
-                    safe_print(f"- {plant.name:<40} → Non trouvé")
-                    logger.warning(f"Traduction non trouvée : {plant.name}")
-                    self.error_count += 1
-                    return None
-
-            except Exception as e:
-                logger.error(f"Erreur lors de la traduction de {plant.name}: {str(e)}")
-                if "rate_limit" in str(e).lower():
-                    if attempt < max_retries - 1:
-                        wait_time = retry_delay * (3 ** attempt)  # backoff plus agressif (3 au lieu de 2)
-                        safe_print(f"Rate limit atteint, attente de {wait_time}s avant réessai ({attempt + 1}/{max_retries})...")
-                        await asyncio.sleep(wait_time)
-                        continue
-                
-                error_message = f"❌ Erreur sur {plant.name} : {str(e)}"
-                safe_print(error_message)
-                logger.error(error_message)
-                self.error_count += 1
-                await asyncio.sleep(1)  # Délai doublé entre les requêtes
-                return None
-
-            # Si on arrive ici, la requête a réussi
-            break
-
-    @staticmethod
-    async def save_plants_batch(plants_to_update):
-        """Sauvegarde un lot de plantes en utilisant bulk_update"""
-        if plants_to_update:
-            await sync_to_async(Plant.objects.bulk_update)(plants_to_update, ['french_name'])
+📌 Réponds UNIQUEMENT par un objet JSON avec une entrée par numéro reçu, par exemple :
+{"noms": {"1": "Aloe vera", "2": "Malus domestica", "3": "Acacia confusa", "4": "Plante inconnue"}}
+→ {"traductions": {"1": "Aloès vera", "2": "Pommier domestique", "3": "(Acacia confus, Petit acacia philippin)", "4": ""}}"""
 
-    async def handle_async(self, *args, **kwargs):
-        # Initialisation des compteurs
+
+def genus_of(normalized_name):
+    return normalized_name.split(' ', 1)[0] if normalized_name else ''
+
+
+def classify(name, translated_name):
+    """
+    Statut d'une traduction reçue (TranslationMemory) et valeur nettoyée,
+    None si la réponse est invalide (trop longue, en anglais, prompt recopié)
+    """
+    translated_name = translated_name.replace(f"{name} → ", "").strip()
+    if len(translated_name) > MAX_LENGTH:
+        return None
+    if "Tu es un traducteur expert en botanique" in translated_name or "If you are" in translated_name:
+        return None
+    if not translated_name:
+        return TranslationMemory.NOT_FOUND, ''
+    if translated_name.startswith('(') and translated_name.endswith(')'):
+        return TranslationMemory.SUGGESTION, translated_name
+    return TranslationMemory.TRANSLATED, translated_name
+
+
+class PlantNameTranslator(EnrichmentRunner):
+    """
+    Traduction des noms latins (Plant.french_name) : réponses classées par statut
+    (traduction, suggestions, non trouvé) et mémorisées par genre et nom normalisé
+    dans TranslationMemory.
+    """
+
+    request_key = 'noms'
+    response_key = 'traductions'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         self.success_count = 0
-        self.error_count = 0
-        self.skipped_count = 0
-        
+        self.suggestion_count = 0
+        self.not_found_count = 0
+
+    def system_prompt(self):
+        return self.prompt
+
+    def cache_key(self, text):
+        normalized_name = normalize_text(text)
+        return genus_of(normalized_name), normalized_name
+
+    def parse(self, text, value):
+        return classify(text, value) if isinstance(value, str) else None
+
+    def load_cache(self, keys):
+        """Entrées de la mémoire de traduction pour les clés (genre, nom normalisé), par genre"""
+        memory = {}
+        genera = sorted({genus for genus, _ in keys})
+        for start in range(0, len(genera), 500):
+            for entry in TranslationMemory.objects.filter(genus__in=genera[start:start + 500]):
+                memory[(entry.genus, entry.normalized_name)] = (entry.status, entry.french_name)
+        return {key: memory[key] for key in keys if key in memory}
+
+    def save_cache(self, results):
+        TranslationMemory.objects.bulk_create(
+            [
+                TranslationMemory(
+                    genus=key[0], normalized_name=key[1], source_name=name,
+                    french_name=french_name, status=status, model=self.chat.model,
+                )
+                for key, name, (status, french_name) in results
+            ],
+            batch_size=self.write_batch_size,
+            update_conflicts=True, unique_fields=['genus', 'normalized_name'],
+            update_fields=['source_name', 'french_name', 'status', 'model', 'updated_at'],
+        )
+
+    def apply(self, plants, name, answer, cached):
+        """Affecte une traduction (reçue ou mémorisée) aux plantes de même nom normalisé"""
+        status, french_name = answer
+        origin = " (mémoire)" if cached else ""
+        if status == TranslationMemory.NOT_FOUND:
+            self.echo(f"- {name:<40} → Non trouvé{origin}")
+            self.logger.warning(f"Traduction non trouvée{origin} : {name}")
+            self.not_found_count += len(plants)
+            return []
+        if status == TranslationMemory.SUGGESTION:
+            self.echo(f"? {name:<40} → {french_name}{origin}")
+            self.logger.info(f"Suggestions de traduction{origin} : {name} → {french_name}")
+            self.suggestion_count += len(plants)
+        else:
+            self.echo(f"+ {name:<40} → {french_name}{origin}")
+            self.logger.info(f"Nouvelle traduction{origin} : {name} → {french_name}")
+            self.success_count += len(plants)
+        for plant in plants:
+            plant.french_name = french_name[:MAX_LENGTH]  # Limite à 220 caractères
+        return plants
+
+
+class Command(BaseCommand):
+    help = "Traduit les noms de plantes en français via OpenAI"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int,
+                            help="Nombre de plantes à traduire (0 pour toutes ; demandé si absent)")
+        parser.add_argument('--resume', action='store_true',
+                            help="Reprend le dernier run interrompu (point de reprise RunCheckpoint)")
+        parser.add_argument('--write-batch-size', type=int, default=WRITE_BATCH_SIZE,
+                            help="Nombre de plantes écrites par transaction")
+        parser.add_argument('--names-per-request', type=int, default=ITEMS_PER_REQUEST,
+                            help="Nombre de noms latins envoyés dans une même requête")
+        parser.add_argument('--base-url', default=None,
+                            help="Point d'accès compatible OpenAI (défaut : OPENAI_BASE_URL, ex. openai_stub_server)")
+        parser.add_argument('--tpm', type=int, default=TPM_LIMIT - TPM_BUFFER,
+                            help="Budget de tokens par minute (usage réel des réponses)")
+        parser.add_argument('--rpm', type=int, default=RPM_LIMIT, help="Budget de requêtes par minute")
+        parser.add_argument('--max-concurrency', type=int, default=MAX_CONCURRENT_REQUESTS,
+                            help="Plafond des requêtes simultanées, ajustées en AIMD sur les 429 et timeouts")
+
+    def setup_logger(self):
+        # Création du nom de fichier avec la date
+        log_filename = f"logs/translation_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+
+        # Configuration du logger
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s - %(levelname)s - %(message)s',
+            handlers=[
+                logging.FileHandler(log_filename, encoding='utf-8'),
+            ]
+        )
+        return logging.getLogger(__name__)
+
+    async def handle_async(self, *args, **kwargs):
         # Setup du logger
         logger = self.setup_logger()
         logger.info("Démarrage de la traduction des plantes")
 
         self.stdout.write(self.style.SUCCESS("\n🌿 TRADUCTION DES NOMS DES PLANTES"))
 
-        plants_count = input("\nCombien de plantes voulez-vous traduire ? (0 pour toutes) : ")
+        plants_count = kwargs['limit']
+        if plants_count is None:
+            plants_count = input("\nCombien de plantes voulez-vous traduire ? (0 pour toutes) : ")
         plants_count = int(plants_count)
 
-        # Récupération des plantes de manière asynchrone
-        if plants_count == 0:
-            plants = await sync_to_async(list)(Plant.objects.filter().order_by('name'))
-        else:
-            plants = await sync_to_async(list)(Plant.objects.filter().order_by('name')[:plants_count])
+        chat = ChatClient(
+            base_url=kwargs['base_url'], tpm=kwargs['tpm'], rpm=kwargs['rpm'],
+            max_concurrency=kwargs['max_concurrency'], logger=logger,
+        )
+        untranslated = Q(french_name__isnull=True) | Q(french_name='')
+        translator = PlantNameTranslator(
+            JOB, Plant.objects.filter(untranslated), 'french_name', SYSTEM_PROMPT, chat=chat,
+            items_per_request=kwargs['names_per_request'], write_batch_size=kwargs['write_batch_size'],
+            limit=plants_count, resume=kwargs['resume'], logger=logger, desc="🔄 Traduction",
+        )
 
-        already_translated = sum(1 for plant in plants if plant.french_name)
-        to_translate = len(plants) - already_translated
+        # Point de reprise : plantes d'id <= last_id traitées, sauf celles d'in_flight
+        resumed, to_translate = await translator.prepare()
+        if kwargs['resume'] and not resumed:
+            self.stdout.write(self.style.WARNING("Aucun run interrompu à reprendre : nouveau run"))
+        skipped_count = await Plant.objects.exclude(untranslated).acount()
 
         stats_message = f"""
 📊 Statistiques :
-   • Total : {len(plants)} plantes
-   • Déjà traduites : {already_translated} plantes
-   • À traduire : {to_translate} plantes
+   • Déjà traduites : {skipped_count} plantes
+   • À traduire : {to_translate} plantes{f" (reprise après l'id {translator.scan_position}, {len(translator.in_flight)} en cours)" if resumed else ""}
 """
         self.stdout.write(self.style.SUCCESS(stats_message))
         logger.info(stats_message)
 
         print("\n")  # Ajoute de l'espace avant de commencer
-        
-        # Configuration de la barre de progression
-        pbar = tqdm(total=len(plants), 
-                   desc="🔄 Traduction", 
-                   bar_format='{desc} |{bar:30}| {percentage:3.0f}% [{n_fmt}/{total_fmt}]',
-                   colour='green',
-                   position=0,
-                   leave=True,
-                   file=sys.stdout,
-                   dynamic_ncols=True)
-
-        # Fonction pour afficher les messages au-dessus de la barre
-        def safe_print(message):
-            # Efface la ligne de la barre de progression
-            sys.stdout.write('\033[1A\033[K')
-            # Affiche le message
-            print(message)
-            # Réaffiche la barre de progression
-            pbar.refresh()
-
-        plants_to_update = []
-        tasks = []
 
-        for plant in plants:
-            if plant.french_name:
-                safe_print(f"✓ {plant.name:<40} → {plant.french_name}")
-                logger.info(f"Déjà traduit : {plant.name} → {plant.french_name}")
-                self.skipped_count += 1
-                pbar.update(1)
-            else:
-                tasks.append(self.translate_plant(plant, safe_print, logger))
-                
-                # Traitement par lots quand on atteint MAX_CONCURRENT_REQUESTS
-                if len(tasks) >= MAX_CONCURRENT_REQUESTS:
-                    # Exécute les traductions en parallèle
-                    completed_plants = await asyncio.gather(*tasks)
-                    
-                    # Filtre les None (erreurs) et ajoute au lot
-                    plants_to_update.extend([p for p in completed_plants if p])
-                    
-                    # Si le lot est assez grand, sauvegarde
-                    if len(plants_to_update) >= BATCH_SIZE:
-                        await self.save_plants_batch(plants_to_update)
-                        plants_to_update = []
-                    
-                    tasks = []
-                    pbar.update(MAX_CONCURRENT_REQUESTS)
-
-        # Traite les plantes restantes
-        if tasks:
-            completed_plants = await asyncio.gather(*tasks)
-            plants_to_update.extend([p for p in completed_plants if p])
-            pbar.update(len(tasks))
-
-        # Sauvegarde le dernier lot
-        if plants_to_update:
-            await self.save_plants_batch(plants_to_update)
+        metrics = await translator.run()
 
         # Affichage du récapitulatif final
+        failed_count = translator.error_count + translator.suggestion_count + translator.not_found_count
         final_stats = f"""
 ✨ Récapitulatif de la traduction :
-   • Plantes déjà traduites : {self.skipped_count}
-   • Nouvelles traductions : {self.success_count}
-   • Échecs : {self.error_count}
-   • Total traité : {self.skipped_count + self.success_count + self.error_count}
-"""
+   • Plantes déjà traduites : {skipped_count}
+   • Nouvelles traductions : {translator.success_count}
+   • Échecs : {failed_count} (dont {translator.suggestion_count} suggestions, {translator.not_found_count} non trouvées)
+""" + EnrichmentRunner.summary(metrics)
         print("\n")  # Ajoute de l'espace après la barre de progression
         self.stdout.write(self.style.SUCCESS(final_stats))
         logger.info("Fin de la traduction" + final_stats)
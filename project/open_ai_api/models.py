@@ -1,3 +1,72 @@
 from django.db import models
 
-# Create your models here.
+
+class TranslationMemory(models.Model):
+    """
+    Mémoire de traduction des noms latins de plantes (translate_plants_names).
+
+    Clé : genre et nom normalisé (voir normalize_text) ; les réponses « non trouvé » sont
+    aussi conservées pour qu'un nouvel import ne paie que les noms jamais vus.
+    """
+    TRANSLATED = 'translated'
+    SUGGESTION = 'suggestion'
+    NOT_FOUND = 'not_found'
+    STATUS_CHOICES = [
+        (TRANSLATED, 'Traduction'),
+        (SUGGESTION, 'Suggestions'),
+        (NOT_FOUND, 'Non trouvé'),
+    ]
+
+    genus = models.CharField(max_length=100)
+    normalized_name = models.CharField(max_length=200)
+    source_name = models.CharField(max_length=200)
+    french_name = models.CharField(max_length=255, blank=True, default='')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES)
+    model = models.CharField(max_length=50, blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['genus', 'normalized_name']
+
+    def __str__(self):
+        return f"{self.source_name} → {self.french_name or '-'} ({self.status})"
+
+
+class RunCheckpoint(models.Model):
+    """
+    Point de reprise d'un traitement long par lots (EnrichmentRunner, option --resume).
+
+    Tous les objets d'id <= last_id sont traités, sauf ceux d'in_flight (envoyés mais pas
+    encore écrits) ; il est enregistré dans la même transaction que chaque lot d'écritures.
+    """
+    job = models.CharField(max_length=100, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    in_flight = models.JSONField(default=list)
+    completed = models.BooleanField(default=False)
+    started_at = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        state = "terminé" if self.completed else f"{len(self.in_flight)} en cours"
+        return f"{self.job} : id {self.last_id} ({state})"
+
+
+class EnrichmentCache(models.Model):
+    """
+    Réponses mémorisées d'EnrichmentRunner : une par tâche et par texte source normalisé.
+
+    La clé inclut une empreinte du prompt : modifier le prompt invalide les réponses
+    mémorisées. Une valeur vide (« ne sait pas ») est aussi conservée.
+    """
+    job = models.CharField(max_length=100)
+    key = models.CharField(max_length=40)
+    source = models.TextField()
+    value = models.TextField(blank=True, default='')
+    model = models.CharField(max_length=50, blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['job', 'key']
+
+    def __str__(self):
+        return f"{self.job} : {self.source[:50]} → {self.value[:50] or '-'}"
@@ -0,0 +1,155 @@
+import asyncio
+import random
+import re
+import time
+
+# Durées des en-têtes x-ratelimit-reset-* (ex. "1s", "6m0s", "250ms")
+_DURATION = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_duration(value):
+    """Durée en secondes d'un en-tête x-ratelimit-reset-* ou retry-after, None si absente"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _UNITS[unit] for amount, unit in parts)
+
+
+def retry_after(headers):
+    """Délai demandé par le serveur (retry-after-ms, retry-after), None s'il n'en donne pas"""
+    if not headers:
+        return None
+    if headers.get('retry-after-ms') is not None:
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    return parse_duration(headers.get('retry-after'))
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """Attente avant la tentative attempt (0 = première reprise) : exponentielle avec gigue complète"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBudget:
+    """
+    Budget par minute (tokens, ou requêtes avec kind='requests') partagé par les requêtes concurrentes.
+
+    reserve() réserve une estimation avant l'envoi (attente exacte, sous verrou, jusqu'à
+    ce que le budget la couvre) ; settle() corrige ensuite avec l'usage réel de la
+    réponse ; sync() aligne le budget sur les en-têtes x-ratelimit-*-<kind> du serveur
+    (limite annoncée si elle est inférieure, tokens restants). Le solde peut devenir
+    négatif si l'usage dépasse l'estimation : les réservations suivantes attendent d'autant.
+    """
+
+    def __init__(self, tokens_per_minute, kind='tokens'):
+        self.kind = kind
+        self.capacity = tokens_per_minute
+        self.tokens = float(tokens_per_minute)
+        self.tokens_per_second = tokens_per_minute / 60
+        self.last_update = time.monotonic()
+        self.waited = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.tokens_per_second)
+        self.last_update = now
+
+    async def reserve(self, tokens):
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait_time = (tokens - self.tokens) / self.tokens_per_second
+                self.waited += wait_time
+                await asyncio.sleep(wait_time)
+
+    def settle(self, reserved, used):
+        """Rend (ou reprend) l'écart entre la réservation et l'usage réel"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + reserved - used)
+
+    def sync(self, headers):
+        """Le serveur fait foi : ni sa limite par minute ni ce qu'il annonce restant ne sont dépassés"""
+        if not headers:
+            return
+        self._refill()
+        limit = _header_number(headers, f'x-ratelimit-limit-{self.kind}')
+        if limit and limit < self.capacity:
+            self.capacity = int(limit)
+            self.tokens_per_second = limit / 60
+        remaining = _header_number(headers, f'x-ratelimit-remaining-{self.kind}')
+        if remaining is not None:
+            self.tokens = min(self.tokens, remaining)
+
+
+def _header_number(headers, name):
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class AIMDLimiter:
+    """
+    Nombre de requêtes simultanées ajusté en AIMD (comme la fenêtre de congestion TCP) :
+    +1 par « fenêtre » de requêtes réussies, division par deux sur un 429 ou un timeout.
+
+    Une seule réduction par fenêtre : les échecs des requêtes parties avant la dernière
+    réduction ne la répètent pas. La croissance est suspendue quand les en-têtes
+    x-ratelimit-remaining-* annoncent un quota presque épuisé.
+    """
+
+    def __init__(self, initial=2, minimum=1, maximum=20, low_remaining=0.1):
+        self.limit = float(max(min(initial, maximum), minimum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.low_remaining = low_remaining
+        self.in_flight = 0
+        self.peak = 0
+        self.decreases = 0
+        self._epoch = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        """Attend une place ; retourne l'époque (fenêtre) de la requête, à rendre à release()"""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            return self._epoch
+
+    async def release(self, epoch, congested=False, headers=None):
+        async with self._condition:
+            self.in_flight -= 1
+            if congested:
+                if epoch == self._epoch:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._epoch += 1
+                    self.decreases += 1
+            elif not self._quota_low(headers):
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def _quota_low(self, headers):
+        if not headers:
+            return False
+        for kind in ('requests', 'tokens'):
+            remaining = _header_number(headers, f'x-ratelimit-remaining-{kind}')
+            limit = _header_number(headers, f'x-ratelimit-limit-{kind}')
+            if remaining is not None and limit and remaining / limit < self.low_remaining:
+                return True
+        return False
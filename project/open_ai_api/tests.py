@@ -1,3 +1,242 @@
-from django.test import TestCase
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import redirect_stdout
+from io import StringIO
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db.models import Q
+from django.test import TransactionTestCase
+
+from metabolites.models import Plant
+from .enrichment import ChatClient, EnrichmentRunner
+from .management.commands.openai_stub_server import create_server
+from .management.commands.translate_plants_names import JOB, SYSTEM_PROMPT, PlantNameTranslator
+from .models import EnrichmentCache, RunCheckpoint, TranslationMemory
+
+# Journal des runs de test (avertissements « non trouvé » attendus)
+test_logger = logging.getLogger('open_ai_api.tests')
+test_logger.addHandler(logging.NullHandler())
+test_logger.propagate = False
+
+
+class RecordingChatClient(ChatClient):
+    """
+    ChatClient qui note les textes dont la réponse a été reçue (donc payée) ;
+    on_paid(nombre de lots payés) est appelé après chaque réponse
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.paid_texts = []
+        self.paid_batches = 0
+        self.on_paid = None
+
+    async def complete_json(self, system_prompt, payload, texts):
+        content = await super().complete_json(system_prompt, payload, texts)
+        self.paid_texts.extend(texts)
+        self.paid_batches += 1
+        if self.on_paid:
+            self.on_paid(self.paid_batches)
+        return content
+
+
+class StubServerTestCase(TransactionTestCase):
+    """
+    Serveur openai_stub_server lancé dans un thread pour chaque test.
+
+    TransactionTestCase : les requêtes ORM du runner passent par sync_to_async (autre thread,
+    autre connexion) et doivent voir les données du test.
+    """
+
+    server_options = {}
+
+    def setUp(self):
+        self.server = create_server(**self.server_options)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def create_plants(self, names):
+        Plant.objects.bulk_create([Plant(name=name) for name in names])
+
+    def chat(self, **kwargs):
+        return RecordingChatClient(base_url=self.base_url, logger=test_logger, **kwargs)
+
+    def translator(self, chat, **kwargs):
+        untranslated = Q(french_name__isnull=True) | Q(french_name='')
+        return PlantNameTranslator(
+            JOB, Plant.objects.filter(untranslated), 'french_name', SYSTEM_PROMPT, chat=chat,
+            logger=test_logger, **kwargs
+        )
+
+    def run_quietly(self, runner):
+        """Lance le runner sans la barre de progression ni les messages par objet"""
+        with redirect_stdout(StringIO()):
+            return asyncio.run(runner.run())
+
+    def run_interrupted(self, runner, after_batches):
+        """
+        Annule le run, comme Ctrl-C sous asyncio.run, dès que after_batches lots sont payés :
+        la réponse de ce lot est reçue mais pas encore traitée par le run
+        """
+        async def main():
+            task = asyncio.create_task(runner.run())
+            runner.chat.on_paid = lambda paid_batches: paid_batches == after_batches and task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+        with redirect_stdout(StringIO()):
+            asyncio.run(main())
+
+
+class TranslatePlantsNamesTests(StubServerTestCase):
+
+    def test_names_batched_and_memorised(self):
+        names = [f"Genus{index % 7} species{index}" for index in range(120)] + ['Aloe vera', 'Ficus carii']
+        self.create_plants(names)
+        chat = self.chat()
+
+        metrics = self.run_quietly(self.translator(chat, items_per_request=50))
+
+        # 122 noms en 3 requêtes de 50 noms au plus
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(sorted(chat.paid_texts), sorted(names))
+        self.assertEqual(metrics['items'], 122)
+        self.assertEqual(Plant.objects.get(name='Aloe vera').french_name, 'Aloès vera')
+        self.assertEqual(Plant.objects.get(name='Genus3 species10').french_name, 'Plante Genus3 species10')
+        self.assertIn(Plant.objects.get(name='Ficus carii').french_name, (None, ''))
+
+        # Les réponses « non trouvé » sont aussi mémorisées
+        self.assertEqual(TranslationMemory.objects.count(), 122)
+        memory = TranslationMemory.objects.get(genus='ficus', normalized_name='ficus carii')
+        self.assertEqual(memory.status, TranslationMemory.NOT_FOUND)
+        self.assertEqual(TranslationMemory.objects.get(normalized_name='aloe vera').status, TranslationMemory.TRANSLATED)
+
+    def test_rerun_pays_only_unseen_names(self):
+        self.create_plants(['Aloe vera', 'Malus domestica', 'Ficus carii'])
+        self.run_quietly(self.translator(self.chat()))
+
+        # Nouvel import : mêmes noms à la casse et aux espaces près, plus deux noms inédits
+        Plant.objects.all().delete()
+        self.create_plants(['ALOE  vera', 'malus Domestica', 'Ficus carii', 'Rosa canina', 'Salvia officinalis'])
+        chat = self.chat()
+        metrics = self.run_quietly(self.translator(chat))
+
+        self.assertEqual(sorted(chat.paid_texts), ['Rosa canina', 'Salvia officinalis'])
+        self.assertEqual(metrics['cache_hits'], 3)
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(Plant.objects.get(name='ALOE  vera').french_name, 'Aloès vera')
+        self.assertEqual(Plant.objects.get(name='malus Domestica').french_name, 'Pommier domestique')
+        self.assertEqual(Plant.objects.get(name='Rosa canina').french_name, 'Plante Rosa canina')
+
+
+class RateLimitedStubTests(StubServerTestCase):
+    """Le serveur refuse (429) au-delà de 2 requêtes simultanées et annonce des quotas bas"""
+
+    server_options = {'latency': 0.05, 'max_concurrency': 2, 'rpm': 100, 'tpm': 20000}
+
+    def test_concurrency_adapts_to_429(self):
+        names = [f"Genus{index % 5} species{index}" for index in range(60)]
+        self.create_plants(names)
+        chat = self.chat(max_concurrency=8)
+
+        metrics = self.run_quietly(self.translator(chat, items_per_request=2))
+
+        # Tous les lots aboutissent malgré les refus, réduits par l'AIMD
+        self.assertEqual(sorted(chat.paid_texts), sorted(names))
+        self.assertFalse(Plant.objects.filter(Q(french_name__isnull=True) | Q(french_name='')).exists())
+        self.assertLessEqual(self.server.peak_in_flight, 2)
+        self.assertGreater(self.server.rejected, 0)
+        self.assertEqual(metrics['rate_limited'], self.server.rejected)
+        self.assertGreater(metrics['concurrency']['decreases'], 0)
+        self.assertEqual(metrics['requests'], self.server.requests + self.server.rejected)
+
+        # Tokens comptés d'après l'usage des réponses, pas l'estimation
+        self.assertEqual(metrics['tokens'], self.server.tokens)
+
+    def test_budgets_follow_server_headers(self):
+        self.create_plants(['Aloe vera', 'Rosa canina'])
+        chat = self.chat(tpm=29000, rpm=500)
+
+        self.run_quietly(self.translator(chat))
+
+        self.assertEqual(chat.budget.capacity, 20000)
+        self.assertEqual(chat.request_budget.capacity, 100)
+
+
+class InterruptedRunTests(StubServerTestCase):
+    """Run annulé pendant que des lots sont en cours, puis repris (--resume)"""
+
+    server_options = {'latency': 0.02}
+
+    def test_interrupted_translation_resumes_without_paying_twice(self):
+        names = [f"Genus{index % 6} species{index}" for index in range(40)]
+        self.create_plants(names)
+        untranslated = Q(french_name__isnull=True) | Q(french_name='')
+
+        interrupted = self.chat()
+        self.run_interrupted(self.translator(interrupted, items_per_request=4), after_batches=3)
+
+        # Réponses reçues avant l'interruption écrites avec le point de reprise
+        paid = interrupted.paid_texts
+        self.assertGreaterEqual(len(paid), 12)
+        self.assertFalse(Plant.objects.filter(untranslated, name__in=paid).exists())
+        checkpoint = RunCheckpoint.objects.get(job=JOB)
+        self.assertFalse(checkpoint.completed)
+        self.assertTrue(Plant.objects.filter(untranslated).exists())
+
+        resumed = self.chat()
+        translator = self.translator(resumed, items_per_request=4, resume=True)
+        self.assertEqual(asyncio.run(translator.prepare()), (True, len(names) - len(paid)))
+        metrics = self.run_quietly(translator)
+
+        self.assertEqual(set(paid) & set(resumed.paid_texts), set())
+        self.assertEqual(sorted(paid + resumed.paid_texts), sorted(names))
+        self.assertFalse(Plant.objects.filter(untranslated).exists())
+        self.assertTrue(metrics['completed'])
+        self.assertTrue(RunCheckpoint.objects.get(job=JOB).completed)
+
+    def test_interrupted_enrich_field_resumes_without_paying_twice(self):
+        names = [f"Genus{index % 6} species{index}" for index in range(40)]
+        self.create_plants(names)
+        job = 'metabolites.plant.french_name'
+        prompt = "Donne le nom français de chaque plante."
+        untranslated = Q(french_name__isnull=True) | Q(french_name='')
+
+        interrupted = self.chat()
+        runner = EnrichmentRunner(
+            job, Plant.objects.filter(untranslated), 'french_name', prompt, chat=interrupted,
+            items_per_request=4, logger=test_logger,
+        )
+        self.run_interrupted(runner, after_batches=3)
+        paid = interrupted.paid_texts
+        self.assertFalse(Plant.objects.filter(untranslated, name__in=paid).exists())
+        self.assertEqual(EnrichmentCache.objects.filter(job=job).count(), len(paid))
+
+        # Reprise par la commande : seuls les noms non payés sont envoyés
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        metrics_output = os.path.join(output_dir, 'metrics.json')
+        with redirect_stdout(StringIO()):
+            call_command(
+                'enrich_field', 'metabolites.Plant', 'name', 'french_name', prompt=prompt, resume=True,
+                items_per_request=4, base_url=self.base_url, metrics_output=metrics_output, stdout=StringIO(),
+            )
+        with open(metrics_output, encoding='utf-8') as f:
+            metrics = json.load(f)
+
+        self.assertEqual(metrics['items'], len(names) - len(paid))
+        self.assertEqual(metrics['items_charged'], len(names) - len(paid))
+        self.assertTrue(metrics['completed'])
+        self.assertEqual(EnrichmentCache.objects.filter(job=job).count(), len(names))
+        self.assertEqual(
+            dict(Plant.objects.values_list('name', 'french_name')), {name: f"Plante {name}" for name in names}
+        )
@@ -0,0 +1,356 @@
+import logging
+import math
+import os
+import pickle
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache
+
+logger = logging.getLogger('metabolites')
+
+_MISSING = object()
+
+# Calculs en cours dans le processus (single-flight) : clé -> _Flight
+_flights = {}
+_flights_lock = threading.Lock()
+
+# LRU locales du processus, partagées par les instances (une par thread) de même LOCATION, comme LocMemCache
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class _LocalStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # clé -> (expiration, valeur sérialisée)
+        self.bytes = 0
+        self.counters = defaultdict(lambda: {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'sets': 0})
+        self.evictions = 0
+
+
+class TwoTierCache(BaseCache):
+    """
+    Cache à deux niveaux : une petite LRU locale au processus devant un cache partagé par tous
+    les workers (entrée SHARED_ALIAS de CACHES, fichiers ou Redis). Un résultat n'est calculé
+    qu'une fois par déploiement, puis servi depuis la mémoire du worker.
+
+    OPTIONS :
+        SHARED_ALIAS : alias du cache partagé ('shared')
+        LOCAL_MAX_ENTRIES / LOCAL_MAX_BYTES : taille maximale de la LRU locale
+        LOCAL_TIMEOUT : durée de vie maximale d'une entrée locale (secondes), qui borne le délai
+            avant qu'un worker voie une suppression faite par un autre
+
+    Les valeurs locales sont conservées sérialisées (comme LocMemCache) : leur taille est
+    comptabilisée et les modifications faites par l'appelant n'altèrent pas le cache.
+    Les compteurs de succès et d'échecs sont tenus par espace de noms (préfixe de la clé avant ':').
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._shared_alias = options.get('SHARED_ALIAS', 'shared')
+        self._max_entries = int(options.get('LOCAL_MAX_ENTRIES', 500))
+        self._max_bytes = int(options.get('LOCAL_MAX_BYTES', 64 * 1024 * 1024))
+        self._local_timeout = float(options.get('LOCAL_TIMEOUT', 60))
+
+        with _stores_lock:
+            self._store = _stores.setdefault(location, _LocalStore())
+
+    @property
+    def shared(self):
+        return caches[self._shared_alias]
+
+    @staticmethod
+    def _namespace(key):
+        return key.split(':', 1)[0] if ':' in key else 'default'
+
+    def _count(self, key, counter):
+        with self._store.lock:
+            self._store.counters[self._namespace(key)][counter] += 1
+
+    def _relative_timeout(self, timeout):
+        """Durée de vie en secondes (None : sans expiration), comme get_backend_timeout mais relative"""
+        if timeout is DEFAULT_TIMEOUT:
+            return self.default_timeout
+        return timeout
+
+    # LRU locale
+
+    def _local_get(self, local_key):
+        with self._store.lock:
+            entry = self._store.entries.get(local_key)
+            if entry is None:
+                return _MISSING
+            expires_at, pickled = entry
+            if expires_at <= time.time():
+                self._local_remove(local_key)
+                return _MISSING
+            self._store.entries.move_to_end(local_key)
+        return pickle.loads(pickled)
+
+    def _local_set(self, local_key, value, timeout):
+        lifetime = self._local_timeout if timeout is None else min(self._local_timeout, timeout)
+        if lifetime <= 0:
+            self._local_delete(local_key)
+            return
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(pickled) > self._max_bytes:
+            self._local_delete(local_key)
+            return
+        with self._store.lock:
+            self._local_remove(local_key)
+            self._store.entries[local_key] = (time.time() + lifetime, pickled)
+            self._store.bytes += len(pickled)
+            while len(self._store.entries) > self._max_entries or self._store.bytes > self._max_bytes:
+                oldest_key = next(iter(self._store.entries))
+                self._local_remove(oldest_key)
+                self._store.evictions += 1
+
+    def _local_remove(self, local_key):
+        """Retire une entrée locale (verrou déjà pris)"""
+        entry = self._store.entries.pop(local_key, None)
+        if entry is not None:
+            self._store.bytes -= len(entry[1])
+
+    def _local_delete(self, local_key):
+        with self._store.lock:
+            self._local_remove(local_key)
+
+    # API du cache Django
+
+    def get(self, key, default=None, version=None):
+        local_key = self.make_and_validate_key(key, version=version)
+        value = self._local_get(local_key)
+        if value is not _MISSING:
+            self._count(key, 'local_hits')
+            return value
+
+        value = self.shared.get(key, _MISSING, version=version)
+        if value is _MISSING:
+            self._count(key, 'misses')
+            return default
+        self._count(key, 'shared_hits')
+        self._local_set(local_key, value, None)
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        local_key = self.make_and_validate_key(key, version=version)
+        self.shared.set(key, value, timeout=timeout, version=version)
+        self._local_set(local_key, value, self._relative_timeout(timeout))
+        self._count(key, 'sets')
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        # Atomique seulement si le cache partagé l'est (pas FileBasedCache) : verrous via acquire_lock
+        local_key = self.make_and_validate_key(key, version=version)
+        if not self.shared.add(key, value, timeout=timeout, version=version):
+            return False
+        self._local_set(local_key, value, self._relative_timeout(timeout))
+        self._count(key, 'sets')
+        return True
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        self._local_delete(self.make_and_validate_key(key, version=version))
+        return self.shared.touch(key, timeout=timeout, version=version)
+
+    def delete(self, key, version=None):
+        self._local_delete(self.make_and_validate_key(key, version=version))
+        return self.shared.delete(key, version=version)
+
+    def has_key(self, key, version=None):
+        local_key = self.make_and_validate_key(key, version=version)
+        if self._local_get(local_key) is not _MISSING:
+            return True
+        return self.shared.has_key(key, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        # Incrément atomique dans le cache partagé uniquement
+        self._local_delete(self.make_and_validate_key(key, version=version))
+        return self.shared.incr(key, delta, version=version)
+
+    def clear(self):
+        self.clear_local()
+        self.shared.clear()
+
+    def clear_local(self):
+        """Vide la LRU du processus seulement"""
+        with self._store.lock:
+            self._store.entries.clear()
+            self._store.bytes = 0
+
+    def stats(self):
+        """Compteurs par espace de noms et occupation de la LRU locale"""
+        with self._store.lock:
+            return {
+                'namespaces': {namespace: dict(counters) for namespace, counters in self._store.counters.items()},
+                'local_entries': len(self._store.entries),
+                'local_bytes': self._store.bytes,
+                'local_evictions': self._store.evictions,
+            }
+
+
+def acquire_lock(cache, key, timeout):
+    """
+    Pose un verrou entre workers, retourne son jeton (None s'il est déjà pris).
+
+    Le verrou est posé dans le cache partagé seulement, jamais dans la LRU locale d'un TwoTierCache.
+    FileBasedCache.add n'étant pas atomique (lecture puis écriture du fichier), le verrou est alors
+    un fichier créé avec O_EXCL ; sinon cache.add (SET NX avec Redis).
+    """
+    if isinstance(cache, TwoTierCache):
+        cache = cache.shared
+    token = uuid.uuid4().hex
+    if isinstance(cache, FileBasedCache):
+        return token if _acquire_file_lock(cache, key, timeout, token) else None
+    return token if cache.add(key, token, timeout) else None
+
+
+def release_lock(cache, key, token):
+    """Retire le verrou s'il appartient encore au jeton (il a pu expirer et être repris)"""
+    if isinstance(cache, TwoTierCache):
+        cache = cache.shared
+    if isinstance(cache, FileBasedCache):
+        path = _file_lock_path(cache, key)
+        try:
+            with open(path, encoding='ascii') as f:
+                owned = f.read() == token
+            if owned:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+    elif cache.get(key) == token:
+        cache.delete(key)
+
+
+def _file_lock_path(cache, key):
+    # Suffixe .lock : ni lu comme une entrée ni supprimé par clear() et l'élagage (fichiers .djcache)
+    return os.path.splitext(cache._key_to_file(key))[0] + '.lock'
+
+
+def _acquire_file_lock(cache, key, timeout, token):
+    path = _file_lock_path(cache, key)
+    cache._createdir()
+    for _ in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+        except FileExistsError:
+            # Verrou expiré (worker arrêté pendant le calcul) : supprimé, puis une seconde tentative
+            try:
+                expired = os.path.getmtime(path) + timeout <= time.time()
+            except FileNotFoundError:
+                continue
+            if not expired:
+                return False
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        with os.fdopen(fd, 'w', encoding='ascii') as f:
+            f.write(token)
+        return True
+    return False
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = _MISSING
+
+
+def _should_refresh_early(entry, beta):
+    """
+    Rafraîchissement anticipé probabiliste (XFetch) : la probabilité croît à l'approche de
+    l'expiration, d'autant plus tôt que le calcul est long.
+    """
+    if entry['expires_at'] is None:
+        return False
+    return time.time() - entry['delta'] * beta * math.log(1.0 - random.random()) >= entry['expires_at']
+
+
+def _compute_and_store(cache, key, compute, timeout):
+    start_time = time.time()
+    value = compute()
+    delta = time.time() - start_time
+    expires_at = None if timeout is None else time.time() + timeout
+    cache.set(key, {'value': value, 'delta': delta, 'expires_at': expires_at}, timeout)
+    logger.debug(f"Cache rempli en {delta:.3f}s - {key}")
+    return value
+
+
+def _fill_across_workers(cache, key, compute, timeout, lock_timeout, wait_interval):
+    """
+    Un seul worker calcule (verrou atomique dans le cache partagé, acquire_lock) ;
+    les autres attendent la valeur, et ne calculent eux-mêmes qu'à l'expiration du verrou.
+    """
+    lock_key = f'{key}:lock'
+    deadline = time.time() + lock_timeout
+    while True:
+        token = acquire_lock(cache, lock_key, lock_timeout)
+        if token:
+            try:
+                # Valeur stockée par le détenteur précédent du verrou depuis la dernière lecture
+                entry = cache.get(key)
+                if entry is not None:
+                    return entry['value']
+                return _compute_and_store(cache, key, compute, timeout)
+            finally:
+                release_lock(cache, lock_key, token)
+
+        time.sleep(wait_interval)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry['value']
+        if time.time() >= deadline:
+            logger.warning(f"Attente du calcul expirée, calcul local - {key}")
+            return _compute_and_store(cache, key, compute, timeout)
+
+
+def single_flight(key, compute, timeout, beta=1.0, lock_timeout=60, wait_interval=0.05, alias='default'):
+    """
+    Retourne la valeur en cache de key, ou la calcule avec compute() sans avalanche de calculs :
+
+    - dans le processus, les appels concurrents pour une même clé attendent un seul calcul ;
+    - entre workers, un verrou dans le cache partagé désigne celui qui calcule ;
+    - avant l'expiration, un seul appelant recalcule la valeur par anticipation (les autres
+      continuent de recevoir la valeur courante), pour que l'expiration ne provoque pas de pic.
+    """
+    cache = caches[alias]
+    entry = cache.get(key)
+    if entry is not None:
+        if not _should_refresh_early(entry, beta):
+            return entry['value']
+        token = acquire_lock(cache, f'{key}:lock', lock_timeout)
+        if not token:
+            return entry['value']
+        logger.debug(f"Rafraîchissement anticipé - {key}")
+        try:
+            return _compute_and_store(cache, key, compute, timeout)
+        finally:
+            release_lock(cache, f'{key}:lock', token)
+
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        flight.done.wait(lock_timeout)
+        if flight.value is not _MISSING:
+            return flight.value
+        # Le calcul partagé a échoué ou n'a pas abouti à temps
+        return _fill_across_workers(cache, key, compute, timeout, lock_timeout, wait_interval)
+
+    try:
+        flight.value = _fill_across_workers(cache, key, compute, timeout, lock_timeout, wait_interval)
+        return flight.value
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+        flight.done.set()
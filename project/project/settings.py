@@ -86,6 +86,8 @@ if MySQL:
                     'init_command': "SET sql_mode='STRICT_TRANS_TABLES'",
                     'charset': 'utf8mb4',
                     'use_unicode': True,
+                    # LOAD DATA LOCAL INFILE (imports --loader native)
+                    'local_infile': 1,
                 }
             }
         }
@@ -102,6 +104,8 @@ if MySQL:
                     'init_command': "SET sql_mode='STRICT_TRANS_TABLES'",
                     'charset': 'utf8mb4',
                     'use_unicode': True,
+                    # LOAD DATA LOCAL INFILE (imports --loader native)
+                    'local_infile': 1,
                 }
             }
         }
@@ -268,8 +272,50 @@ DEFAULT_FROM_EMAIL = 'contact@agencecodemaster.com'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# MOTEUR D'INCIDENCE (métabolites en commun calculés en mémoire) #
+USE_INCIDENCE_ENGINE = env.bool('USE_INCIDENCE_ENGINE', default=True)
+
+# VOISINS PRÉCALCULÉS (commande build_plant_pairs) #
+USE_PLANT_PAIR_STATS = env.bool('USE_PLANT_PAIR_STATS', default=True)
+PLANT_PAIR_TOP_K = 200  # voisins conservés par plante et par critère de tri
+
+# MATRICE DES ACIDES AMINÉS (similarité des profils) #
+AMINO_ACID_MATRIX_TTL = 600  # secondes avant rechargement de la matrice
+
+# CACHE (LRU locale à chaque worker devant un cache partagé : Redis si REDIS_URL, sinon fichiers) #
+REDIS_URL = env('REDIS_URL', default='')
+CACHES = {
+    'default': {
+        'BACKEND': 'project.cache.TwoTierCache',
+        'LOCATION': 'metabolites',
+        'KEY_PREFIX': 'metabolites',
+        'OPTIONS': {
+            'SHARED_ALIAS': 'shared',
+            'LOCAL_MAX_ENTRIES': 500,
+            'LOCAL_MAX_BYTES': 64 * 1024 * 1024,
+            'LOCAL_TIMEOUT': 60,  # secondes avant relecture dans le cache partagé
+        },
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    } if REDIS_URL else {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': env('CACHE_DIR', default=str(BASE_DIR / 'cache')),
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
+}
+
+# CACHE DES RÉSULTATS (clés versionnées par la génération du jeu de données) #
+GENERATION_CACHE_TIMEOUT = 86400  # secondes ; les générations dépassées ne sont plus lues et expirent
+
+# CONSULTATIONS (AccessCount, priorités de warm_caches) #
+ACCESS_COUNT_SAMPLING = 10  # une consultation sur N est écrite en base, comptée N fois
+
 # OPENAI API #
 OPENAI_API_KEY = env('OPENAI_API_KEY')
+# Point d'accès compatible OpenAI (vide : API OpenAI ; serveur local de test : commande openai_stub_server)
+OPENAI_BASE_URL = env('OPENAI_BASE_URL', default=None)
 
 
 # Configuration des logs
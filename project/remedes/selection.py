@@ -0,0 +1,299 @@
+import logging
+
+from django.conf import settings
+from django.db import connection
+
+from metabolites.generation import cached_for_generation
+from metabolites.incidence import get_incidence_engine
+from metabolites.models import Metabolite
+
+logger = logging.getLogger('remedes')
+
+# Tri par défaut des plantes proposées pour chaque activité
+DEFAULT_SORT_PARAMS = [('common_activity_metabolites', 'desc')]
+
+
+def saved_sort_params(remede):
+    """Tri et exclusion des ubiquitaires sauvegardés avec le remède : (sort_params, exclude_ubiquitous)"""
+    saved = remede.sort_params or {}
+    sort_params = []
+    for i in range(4):
+        field = saved.get(f'sort{i}')
+        direction = saved.get(f'direction{i}')
+        if field and direction:
+            sort_params.append((field, direction))
+    return sort_params, saved.get('exclude_ubiquitous', False)
+
+
+def saved_metabolite_ids(remede):
+    """Métabolites requis sauvegardés avec le remède"""
+    saved = remede.sort_params or {}
+    metabolite_ids = []
+    for i in range(1, 4):
+        try:
+            if saved.get(f'metabolite{i}'):
+                metabolite_ids.append(int(saved[f'metabolite{i}']))
+        except (ValueError, TypeError):
+            pass
+    return metabolite_ids
+
+
+def get_plants_by_activity(remede, sort_params, exclude_ubiquitous, selected_metabolites):
+    """
+    Plantes proposées pour chaque activité du remède, en cache pour chaque combinaison de paramètres
+    et la génération courante du jeu de données (calculées une seule fois même sous requêtes concurrentes)
+    """
+    def compute():
+        if getattr(settings, 'USE_INCIDENCE_ENGINE', True):
+            try:
+                engine = get_incidence_engine()
+                if engine is not None:
+                    return _rank_plants_for_remede(engine, remede, sort_params, exclude_ubiquitous, selected_metabolites)
+            except Exception as e:
+                logger.error(f"Moteur d'incidence indisponible, repli sur SQL: {e}")
+        logger.debug("Exécution des requêtes SQL")
+        return _select_plants_sql(remede, sort_params, exclude_ubiquitous, selected_metabolites)
+
+    return cached_for_generation(
+        'remede_plants',
+        compute,
+        target_plant_id=remede.target_plant_id,
+        activity_ids=sorted(remede.activities.values_list('id', flat=True)),
+        sort_params=[list(param) for param in sort_params],
+        exclude_ubiquitous=bool(exclude_ubiquitous),
+        selected_metabolites=sorted(m.id for m in selected_metabolites),
+    )
+
+
+def _rank_plants_for_remede(engine, remede, sort_params, exclude_ubiquitous, selected_metabolites, per_activity=20):
+    """
+    Plantes proposées pour chaque activité du remède, classées en mémoire par le moteur d'incidence
+    (un seul tri multi-clés, le premier paramètre étant prioritaire). Même structure que la version SQL.
+    """
+    metabolite_filters = [m.id for m in selected_metabolites]
+    plants_by_activity = {}
+    activity_names = {}
+
+    for activity in remede.activities.all():
+        candidates = engine.remede_candidates(
+            remede.target_plant_id, activity.id,
+            exclude_ubiquitous=exclude_ubiquitous, metabolite_filters=metabolite_filters
+        )
+        positions = candidates.page(sort_params, 1, per_activity)
+        total_activity, common_activity, total_concentration = candidates.activity
+        percentages = candidates.column('common_percentage')
+        meta_percentage_scores = candidates.column('meta_percentage_score')
+        meta_root_scores = candidates.column('meta_root_score')
+
+        results = []
+        for index in positions:
+            plant_id = int(candidates.ids[index])
+            common_ids, complementary_ids = engine.activity_metabolite_ids(
+                plant_id, remede.target_plant_id, activity.id, exclude_ubiquitous=exclude_ubiquitous
+            )
+            total_metabolites_count = int(candidates.totals[index])
+            results.append({
+                'id': plant_id,
+                'name': candidates.names[index],
+                'french_name': candidates.french_names[index],
+                'total_metabolites_count': total_metabolites_count,
+                'common_metabolites_count': int(candidates.common[index]),
+                'activity_metabolites_count': int(total_activity[index]),
+                'common_activity_metabolites_count': int(common_activity[index]),
+                'total_concentration': float(total_concentration[index]),
+                'common_metabolites_names': common_ids,
+                'complementary_metabolites_names': complementary_ids,
+                'common_percentage': float(percentages[index]),
+                'meta_percentage_score': float(meta_percentage_scores[index]),
+                'meta_root_score': float(meta_root_scores[index]),
+                'percentage_type': 'blue' if candidates.reference_count >= total_metabolites_count else 'green',
+            })
+            activity_names.update(dict.fromkeys(common_ids + complementary_ids))
+        plants_by_activity[activity.name] = results
+
+    # Noms des métabolites des plantes retenues, en une seule requête
+    activity_names.update(Metabolite.objects.filter(id__in=list(activity_names)).values_list('id', 'name'))
+    for results in plants_by_activity.values():
+        for result in results:
+            for key in ('common_metabolites_names', 'complementary_metabolites_names'):
+                result[key] = sorted(activity_names[metabolite_id] for metabolite_id in result[key])
+    return plants_by_activity
+
+
+def _select_plants_sql(remede, sort_params, exclude_ubiquitous, selected_metabolites):
+    """Plantes proposées pour chaque activité du remède, classées par MySQL (tables temporaires)"""
+    with connection.cursor() as cursor:
+        # Nettoyer les tables temporaires potentiellement existantes
+        cursor.execute("DROP TEMPORARY TABLE IF EXISTS temp_target_metabolites")
+        cursor.execute("DROP TEMPORARY TABLE IF EXISTS temp_selected_metabolites")
+            
+        # Créer des tables temporaires pour améliorer les performances
+        # 1. Métabolites de la plante cible
+        cursor.execute("""
+            CREATE TEMPORARY TABLE temp_target_metabolites AS
+            SELECT DISTINCT mp.metabolite_id
+            FROM metabolites_metaboliteplant mp
+            JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
+            WHERE mp.plant_id = %s
+            AND (%s = FALSE OR m.is_ubiquitous = FALSE)
+        """, [remede.target_plant_id, exclude_ubiquitous])
+        cursor.execute("CREATE INDEX idx_temp_target_metabolites ON temp_target_metabolites(metabolite_id)")
+            
+        # 2. Métabolites sélectionnés pour le filtrage
+        if selected_metabolites:
+            placeholders = ', '.join(['%s'] * len(selected_metabolites))
+            cursor.execute(f"""
+                CREATE TEMPORARY TABLE temp_selected_metabolites AS
+                SELECT DISTINCT id as metabolite_id
+                FROM metabolites_metabolite
+                WHERE id IN ({placeholders})
+            """, [m.id for m in selected_metabolites])
+            cursor.execute("CREATE INDEX idx_temp_selected_metabolites ON temp_selected_metabolites(metabolite_id)")
+            
+        # Parties de requête communes pour chaque activité
+        base_query = """
+            WITH plant_metabolites AS (
+                SELECT 
+                    p.id,
+                    p.name,
+                    p.french_name,
+                    COUNT(DISTINCT mp.metabolite_id) as total_metabolites_count,
+                    COUNT(DISTINCT CASE WHEN ttm.metabolite_id IS NOT NULL THEN mp.metabolite_id END) as common_metabolites_count,
+                    COUNT(DISTINCT CASE WHEN ma.activity_id = %s THEN mp.metabolite_id END) as activity_metabolites_count,
+                    COUNT(DISTINCT CASE WHEN ttm.metabolite_id IS NOT NULL AND ma.activity_id = %s THEN mp.metabolite_id END) as common_activity_metabolites_count,
+                    COALESCE(SUM(CASE 
+                        WHEN ma.activity_id = %s 
+                        THEN COALESCE(mp.high, mp.low, 0) 
+                    END), 0) as total_concentration,
+                    GROUP_CONCAT(
+                        CASE WHEN ttm.metabolite_id IS NOT NULL AND ma.activity_id = %s 
+                        THEN m.name 
+                        END
+                        ORDER BY m.name
+                        SEPARATOR '|||'
+                    ) as common_metabolites_names,
+                    GROUP_CONCAT(
+                        CASE WHEN ma.activity_id = %s AND ttm.metabolite_id IS NULL 
+                        THEN m.name 
+                        END
+                        ORDER BY m.name
+                        SEPARATOR '|||'
+                    ) as complementary_metabolites_names,
+                    ROUND(
+                        COUNT(DISTINCT CASE WHEN ttm.metabolite_id IS NOT NULL THEN mp.metabolite_id END) * 100.0 / 
+                        NULLIF(COUNT(DISTINCT mp.metabolite_id), 0),
+                        1
+                    ) as common_percentage,
+                    ROUND(
+                        COUNT(DISTINCT CASE WHEN ttm.metabolite_id IS NOT NULL THEN mp.metabolite_id END) * 
+                        (COUNT(DISTINCT CASE WHEN ttm.metabolite_id IS NOT NULL THEN mp.metabolite_id END) * 100.0 / 
+                        NULLIF(COUNT(DISTINCT mp.metabolite_id), 0)) / 100,
+                        2
+                    ) as meta_percentage_score,
+                    ROUND(
+                        SQRT(COUNT(DISTINCT CASE WHEN ttm.metabolite_id IS NOT NULL THEN mp.metabolite_id END)) * 
+                        (COUNT(DISTINCT CASE WHEN ttm.metabolite_id IS NOT NULL THEN mp.metabolite_id END) * 100.0 / 
+                        NULLIF(COUNT(DISTINCT mp.metabolite_id), 0)) / 100,
+                        2
+                    ) as meta_root_score
+                FROM metabolites_plant p
+                JOIN metabolites_metaboliteplant mp ON mp.plant_id = p.id
+                JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
+                LEFT JOIN temp_target_metabolites ttm ON ttm.metabolite_id = mp.metabolite_id
+                LEFT JOIN metabolites_metaboliteactivity ma ON ma.metabolite_id = mp.metabolite_id
+                WHERE p.id != %s
+        """
+            
+        # Ajouter la condition pour les métabolites sélectionnés
+        if selected_metabolites:
+            metabolite_condition = """
+                AND (
+                    NOT EXISTS (SELECT 1 FROM temp_selected_metabolites)
+                    OR NOT EXISTS (
+                        SELECT 1 
+                        FROM temp_selected_metabolites tsm 
+                        WHERE NOT EXISTS (
+                            SELECT 1 
+                            FROM metabolites_metaboliteplant mp2 
+                            WHERE mp2.plant_id = p.id 
+                            AND mp2.metabolite_id = tsm.metabolite_id
+                        )
+                    )
+                )
+            """
+            base_query += metabolite_condition
+            
+        base_query += """
+                GROUP BY p.id, p.name, p.french_name
+            )
+            SELECT *
+            FROM plant_metabolites
+            ORDER BY 
+        """
+            
+        # Exécuter la requête pour chaque activité
+        plants_by_activity = {}
+        for activity in remede.activities.all():
+            # Construire les paramètres pour cette activité
+            activity_params = [
+                activity.id,  # Pour le premier COUNT CASE
+                activity.id,  # Pour le deuxième COUNT CASE
+                activity.id,  # Pour le CASE dans le SUM
+                activity.id,  # Pour le premier GROUP_CONCAT
+                activity.id,  # Pour le deuxième GROUP_CONCAT
+                remede.target_plant_id  # Pour la condition WHERE p.id !=
+            ]
+                
+            # Ajouter l'ordre de tri dynamique
+            order_clauses = []
+            for field, direction in sort_params:
+                if field == 'name':
+                    order_clauses.append(f"name {direction}")
+                elif field == 'common_metabolites':
+                    order_clauses.append(f"common_metabolites_count {direction}")
+                elif field == 'common_percentage':
+                    order_clauses.append(f"common_percentage {direction}")
+                elif field == 'meta_percentage_score':
+                    order_clauses.append(f"meta_percentage_score {direction}")
+                elif field == 'meta_root_score':
+                    order_clauses.append(f"meta_root_score {direction}")
+                elif field == 'common_activity_metabolites':
+                    order_clauses.append(f"common_activity_metabolites_count {direction}")
+                elif field == 'total_activity_metabolites':
+                    order_clauses.append(f"activity_metabolites_count {direction}")
+                elif field == 'total_concentration':
+                    order_clauses.append(f"total_concentration {direction}")
+                
+            query = base_query + (", ".join(order_clauses) if order_clauses else "common_activity_metabolites_count DESC")
+            query += " LIMIT 20"  # Augmentation à 20 pour avoir plus de plantes par activité
+                
+            try:
+                cursor.execute(query, activity_params)
+                    
+                # Traiter les résultats
+                columns = [col[0] for col in cursor.description]
+                results = [dict(zip(columns, row)) for row in cursor.fetchall()]
+                    
+                # Traiter les listes de métabolites
+                for result in results:
+                    result['common_metabolites_names'] = result['common_metabolites_names'].split('|||') if result['common_metabolites_names'] else []
+                    result['complementary_metabolites_names'] = result['complementary_metabolites_names'].split('|||') if result['complementary_metabolites_names'] else []
+                        
+                    # Déterminer le type de pourcentage
+                    target_metabolites_count = cursor.execute("""
+                        SELECT COUNT(*) FROM temp_target_metabolites
+                    """)
+                    target_count = cursor.fetchone()[0]
+                    result['percentage_type'] = 'blue' if target_count >= result['total_metabolites_count'] else 'green'
+                    
+                plants_by_activity[activity.name] = results
+                    
+            except Exception as e:
+                logger.error(f"Erreur dans la requête pour l'activité {activity.name}: {str(e)}")
+                plants_by_activity[activity.name] = []
+            
+        # Nettoyer les tables temporaires
+        cursor.execute("DROP TEMPORARY TABLE IF EXISTS temp_target_metabolites")
+        cursor.execute("DROP TEMPORARY TABLE IF EXISTS temp_selected_metabolites")
+    
+    return plants_by_activity
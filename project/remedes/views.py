@@ -1,7 +1,6 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.core.serializers.json import DjangoJSONEncoder
 from django.urls import reverse
-from django.core.cache import cache
 import json
 import logging
 from .models import Remede, Plant
@@ -9,7 +8,8 @@ from .forms import RemedeForm
 from django.http import HttpResponse, JsonResponse
 from django.db import connection
 from metabolites.utils import log_execution_time
-from metabolites.models import Metabolite
+from metabolites.models import Metabolite, AccessCount
+from .selection import DEFAULT_SORT_PARAMS, get_plants_by_activity, saved_sort_params
 import math
 from django.db.models import Q
 
@@ -142,6 +142,8 @@ def select_plants_for_remede(request, remede_id):
             
         return redirect('all_remedes')
     
+    AccessCount.record(AccessCount.KIND_REMEDE, remede.id)
+    
     # Récupérer les paramètres de tri
     sort_params = []
     exclude_ubiquitous = False
@@ -162,210 +164,16 @@ def select_plants_for_remede(request, remede_id):
     
     # Si aucun paramètre dans l'URL, utiliser ceux sauvegardés dans le modèle
     if not has_url_sort_params and remede.sort_params:
-        for i in range(4):
-            field = remede.sort_params.get(f'sort{i}')
-            direction = remede.sort_params.get(f'direction{i}')
-            if field and direction:
-                sort_params.append((field, direction))
-        
-        # Récupérer l'option d'exclusion sauvegardée
-        if 'exclude_ubiquitous' in remede.sort_params:
-            exclude_ubiquitous = remede.sort_params['exclude_ubiquitous']
+        sort_params, exclude_ubiquitous = saved_sort_params(remede)
     
     # Si toujours aucun paramètre de tri, utiliser la valeur par défaut
     if not sort_params:
-        sort_params = [('common_activity_metabolites', 'desc')]
+        sort_params = list(DEFAULT_SORT_PARAMS)
     
     selected_plants_ids = list(remede.plants.values_list('id', flat=True))
-    plants_by_activity = {}
     
-    # Clé de cache unique pour chaque combinaison de paramètres
-    cache_key = f'remede_plants_{remede_id}_{remede.target_plant.name}_{json.dumps(sort_params)}_{exclude_ubiquitous}_{json.dumps([m.id for m in selected_metabolites])}'
-    logger.debug(f"Clé de cache: {cache_key}")
-    
-    plants_by_activity = cache.get(cache_key)
-    
-    if plants_by_activity is None:
-        logger.debug("Cache miss - Exécution des requêtes SQL")
-        with connection.cursor() as cursor:
-            # Nettoyer les tables temporaires potentiellement existantes
-            cursor.execute("DROP TEMPORARY TABLE IF EXISTS temp_target_metabolites")
-            cursor.execute("DROP TEMPORARY TABLE IF EXISTS temp_selected_metabolites")
-            
-            # Créer des tables temporaires pour améliorer les performances
-            # 1. Métabolites de la plante cible
-            cursor.execute("""
-                CREATE TEMPORARY TABLE temp_target_metabolites AS
-                SELECT DISTINCT mp.metabolite_id
-                FROM metabolites_metaboliteplant mp
-                JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
-                WHERE mp.plant_name = %s
-                AND (%s = FALSE OR m.is_ubiquitous = FALSE)
-            """, [remede.target_plant.name, exclude_ubiquitous])
-            cursor.execute("CREATE INDEX idx_temp_target_metabolites ON temp_target_metabolites(metabolite_id)")
-            
-            # 2. Métabolites sélectionnés pour le filtrage
-            if selected_metabolites:
-                placeholders = ', '.join(['%s'] * len(selected_metabolites))
-                cursor.execute(f"""
-                    CREATE TEMPORARY TABLE temp_selected_metabolites AS
-                    SELECT DISTINCT id as metabolite_id
-                    FROM metabolites_metabolite
-                    WHERE id IN ({placeholders})
-                """, [m.id for m in selected_metabolites])
-                cursor.execute("CREATE INDEX idx_temp_selected_metabolites ON temp_selected_metabolites(metabolite_id)")
-            
-            # Parties de requête communes pour chaque activité
-            base_query = """
-                WITH plant_metabolites AS (
-                    SELECT 
-                        p.id,
-                        p.name,
-                        p.french_name,
-                        COUNT(DISTINCT mp.metabolite_id) as total_metabolites_count,
-                        COUNT(DISTINCT CASE WHEN ttm.metabolite_id IS NOT NULL THEN mp.metabolite_id END) as common_metabolites_count,
-                        COUNT(DISTINCT CASE WHEN ma.activity_id = %s THEN mp.metabolite_id END) as activity_metabolites_count,
-                        COUNT(DISTINCT CASE WHEN ttm.metabolite_id IS NOT NULL AND ma.activity_id = %s THEN mp.metabolite_id END) as common_activity_metabolites_count,
-                        COALESCE(SUM(CASE 
-                            WHEN ma.activity_id = %s 
-                            THEN COALESCE(mp.high, mp.low, 0) 
-                        END), 0) as total_concentration,
-                        GROUP_CONCAT(
-                            CASE WHEN ttm.metabolite_id IS NOT NULL AND ma.activity_id = %s 
-                            THEN m.name 
-                            END
-                            ORDER BY m.name
-                            SEPARATOR '|||'
-                        ) as common_metabolites_names,
-                        GROUP_CONCAT(
-                            CASE WHEN ma.activity_id = %s AND ttm.metabolite_id IS NULL 
-                            THEN m.name 
-                            END
-                            ORDER BY m.name
-                            SEPARATOR '|||'
-                        ) as complementary_metabolites_names,
-                        ROUND(
-                            COUNT(DISTINCT CASE WHEN ttm.metabolite_id IS NOT NULL THEN mp.metabolite_id END) * 100.0 / 
-                            NULLIF(COUNT(DISTINCT mp.metabolite_id), 0),
-                            1
-                        ) as common_percentage,
-                        ROUND(
-                            COUNT(DISTINCT CASE WHEN ttm.metabolite_id IS NOT NULL THEN mp.metabolite_id END) * 
-                            (COUNT(DISTINCT CASE WHEN ttm.metabolite_id IS NOT NULL THEN mp.metabolite_id END) * 100.0 / 
-                            NULLIF(COUNT(DISTINCT mp.metabolite_id), 0)) / 100,
-                            2
-                        ) as meta_percentage_score,
-                        ROUND(
-                            SQRT(COUNT(DISTINCT CASE WHEN ttm.metabolite_id IS NOT NULL THEN mp.metabolite_id END)) * 
-                            (COUNT(DISTINCT CASE WHEN ttm.metabolite_id IS NOT NULL THEN mp.metabolite_id END) * 100.0 / 
-                            NULLIF(COUNT(DISTINCT mp.metabolite_id), 0)) / 100,
-                            2
-                        ) as meta_root_score
-                    FROM metabolites_plant p
-                    JOIN metabolites_metaboliteplant mp ON mp.plant_name = p.name
-                    JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
-                    LEFT JOIN temp_target_metabolites ttm ON ttm.metabolite_id = mp.metabolite_id
-                    LEFT JOIN metabolites_metaboliteactivity ma ON ma.metabolite_id = mp.metabolite_id
-                    WHERE p.name != %s
-            """
-            
-            # Ajouter la condition pour les métabolites sélectionnés
-            if selected_metabolites:
-                metabolite_condition = """
-                    AND (
-                        NOT EXISTS (SELECT 1 FROM temp_selected_metabolites)
-                        OR NOT EXISTS (
-                            SELECT 1 
-                            FROM temp_selected_metabolites tsm 
-                            WHERE NOT EXISTS (
-                                SELECT 1 
-                                FROM metabolites_metaboliteplant mp2 
-                                WHERE mp2.plant_name = p.name 
-                                AND mp2.metabolite_id = tsm.metabolite_id
-                            )
-                        )
-                    )
-                """
-                base_query += metabolite_condition
-            
-            base_query += """
-                    GROUP BY p.id, p.name, p.french_name
-                )
-                SELECT *
-                FROM plant_metabolites
-                ORDER BY 
-            """
-            
-            # Exécuter la requête pour chaque activité
-            plants_by_activity = {}
-            for activity in remede.activities.all():
-                # Construire les paramètres pour cette activité
-                activity_params = [
-                    activity.id,  # Pour le premier COUNT CASE
-                    activity.id,  # Pour le deuxième COUNT CASE
-                    activity.id,  # Pour le CASE dans le SUM
-                    activity.id,  # Pour le premier GROUP_CONCAT
-                    activity.id,  # Pour le deuxième GROUP_CONCAT
-                    remede.target_plant.name  # Pour la condition WHERE p.name !=
-                ]
-                
-                # Ajouter l'ordre de tri dynamique
-                order_clauses = []
-                for field, direction in sort_params:
-                    if field == 'name':
-                        order_clauses.append(f"name {direction}")
-                    elif field == 'common_metabolites':
-                        order_clauses.append(f"common_metabolites_count {direction}")
-                    elif field == 'common_percentage':
-                        order_clauses.append(f"common_percentage {direction}")
-                    elif field == 'meta_percentage_score':
-                        order_clauses.append(f"meta_percentage_score {direction}")
-                    elif field == 'meta_root_score':
-                        order_clauses.append(f"meta_root_score {direction}")
-                    elif field == 'common_activity_metabolites':
-                        order_clauses.append(f"common_activity_metabolites_count {direction}")
-                    elif field == 'total_activity_metabolites':
-                        order_clauses.append(f"activity_metabolites_count {direction}")
-                    elif field == 'total_concentration':
-                        order_clauses.append(f"total_concentration {direction}")
-                
-                query = base_query + (", ".join(order_clauses) if order_clauses else "common_activity_metabolites_count DESC")
-                query += " LIMIT 20"  # Augmentation à 20 pour avoir plus de plantes par activité
-                
-                try:
-                    cursor.execute(query, activity_params)
-                    
-                    # Traiter les résultats
-                    columns = [col[0] for col in cursor.description]
-                    results = [dict(zip(columns, row)) for row in cursor.fetchall()]
-                    
-                    # Traiter les listes de métabolites
-                    for result in results:
-                        result['common_metabolites_names'] = result['common_metabolites_names'].split('|||') if result['common_metabolites_names'] else []
-                        result['complementary_metabolites_names'] = result['complementary_metabolites_names'].split('|||') if result['complementary_metabolites_names'] else []
-                        
-                        # Déterminer le type de pourcentage
-                        target_metabolites_count = cursor.execute("""
-                            SELECT COUNT(*) FROM temp_target_metabolites
-                        """)
-                        target_count = cursor.fetchone()[0]
-                        result['percentage_type'] = 'blue' if target_count >= result['total_metabolites_count'] else 'green'
-                    
-                    plants_by_activity[activity.name] = results
-                    
-                except Exception as e:
-                    logger.error(f"Erreur dans la requête pour l'activité {activity.name}: {str(e)}")
-                    plants_by_activity[activity.name] = []
-            
-            # Nettoyer les tables temporaires
-            cursor.execute("DROP TEMPORARY TABLE IF EXISTS temp_target_metabolites")
-            cursor.execute("DROP TEMPORARY TABLE IF EXISTS temp_selected_metabolites")
-            
-            # Mettre en cache pour 12h
-            cache.set(cache_key, plants_by_activity, 43200)
-            logger.debug("Résultats mis en cache")
-    else:
-        logger.debug("Cache hit - Utilisation des données en cache")
+    # En cache pour la génération courante du jeu de données, calculé une seule fois même sous requêtes concurrentes
+    plants_by_activity = get_plants_by_activity(remede, sort_params, exclude_ubiquitous, selected_metabolites)
 
     # Créer un dictionnaire temporaire pour stocker toutes les plantes
     all_plants_dict = {}
@@ -401,9 +209,9 @@ def select_plants_for_remede(request, remede_id):
                 SELECT DISTINCT mp.metabolite_id
                 FROM metabolites_metaboliteplant mp
                 JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
-                WHERE mp.plant_name = %s
+                WHERE mp.plant_id = %s
                 AND (%s = FALSE OR m.is_ubiquitous = FALSE)
-            """, [remede.target_plant.name, exclude_ubiquitous])
+            """, [remede.target_plant_id, exclude_ubiquitous])
             cursor.execute("CREATE INDEX idx_temp_target_metabolites_missing ON temp_target_metabolites_missing(metabolite_id)")
             
             # Requête pour récupérer les données des plantes manquantes pour chaque activité
@@ -436,7 +244,7 @@ def select_plants_for_remede(request, remede_id):
                             SEPARATOR '|||'
                         ) as complementary_metabolites_names
                     FROM metabolites_plant p
-                    JOIN metabolites_metaboliteplant mp ON mp.plant_name = p.name
+                    JOIN metabolites_metaboliteplant mp ON mp.plant_id = p.id
                     JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
                     LEFT JOIN temp_target_metabolites_missing ttm ON ttm.metabolite_id = mp.metabolite_id
                     LEFT JOIN metabolites_metaboliteactivity ma ON ma.metabolite_id = mp.metabolite_id
@@ -569,11 +377,11 @@ def remede_detail(request, remede_id):
                         SEPARATOR '|||'
                     ) as complementary_metabolites_names
                 FROM metabolites_plant p
-                JOIN metabolites_metaboliteplant mp ON mp.plant_name = p.name
+                JOIN metabolites_metaboliteplant mp ON mp.plant_id = p.id
                 JOIN metabolites_metabolite m ON m.id = mp.metabolite_id
                 LEFT JOIN metabolites_metaboliteplant mp_target ON 
                     mp_target.metabolite_id = mp.metabolite_id AND 
-                    mp_target.plant_name = %s
+                    mp_target.plant_id = %s
                 LEFT JOIN metabolites_metaboliteactivity ma ON ma.metabolite_id = mp.metabolite_id
                 WHERE p.id IN (SELECT id FROM metabolites_plant WHERE id IN %s)
                 GROUP BY p.id, p.name
@@ -590,7 +398,7 @@ def remede_detail(request, remede_id):
                     activity.id,  # Pour le premier GROUP_CONCAT
                     activity.id,  # Pour le premier CASE dans le deuxième GROUP_CONCAT
                     activity.id,  # Pour le EXISTS dans le deuxième GROUP_CONCAT
-                    remede.target_plant.name,  # Pour le JOIN avec mp_target
+                    remede.target_plant_id,  # Pour le JOIN avec mp_target
                     tuple(plant_ids),  # Pour la clause WHERE IN
                 ]
                 
@@ -26,11 +26,6 @@ def create_temp_numbering(request, plant_id):
     # Récupérer les paramètres de la requête
     data = json.loads(request.body)
     
-    # Récupérer la numérotation directement depuis le client
-    numbering = data.get('numbering', {})
-    if not numbering:
-        return JsonResponse({'error': 'Aucune numérotation fournie'}, status=400)
-    
     # Récupérer les paramètres de filtrage pour les stocker
     activity_filter = data.get('activity')
     exclude_ubiquitous = data.get('exclude_ubiquitous', False)
@@ -55,6 +50,24 @@ def create_temp_numbering(request, plant_id):
             except (ValueError, TypeError):
                 pass
     
+    # Numérotation fournie par le client, sinon calculée en un seul tri sur toutes les plantes en commun
+    numbering = data.get('numbering', {})
+    if not numbering:
+        plant = get_object_or_404(Plant, id=plant_id)
+        candidates = plant.get_common_plant_candidates(
+            activity_filter=activity_filter,
+            exclude_ubiquitous=exclude_ubiquitous,
+            search_text=search_text,
+            search_type=search_type,
+            metabolite_filters=metabolite_filters
+        )
+        numbering = {
+            str(candidate_id): number
+            for number, candidate_id in enumerate(candidates.ids[candidates.order(sort_params)].tolist(), start=1)
+        }
+    if not numbering:
+        return JsonResponse({'error': 'Aucune plante à numéroter'}, status=400)
+    
     # Sauvegarder la numérotation en session
     request.session[f'plant_{plant_id}_numbering'] = numbering
     request.session[f'plant_{plant_id}_numbering_id'] = None